@@ -0,0 +1,209 @@
+"""
+Running aggregators for reducing a report column in a single pass.
+
+Each aggregator keeps a fixed amount of state however many values it sees.
+Values of None are skipped.
+"""
+from abc import ABCMeta, abstractmethod
+
+
+class Aggregator(metaclass=ABCMeta):
+    """
+    Base class for aggregators.
+
+    pretty_name: the name shown in a report next to the result.
+    """
+    pretty_name = None
+
+    def add(self, value):
+        """
+        Add a value to the running state.
+        """
+        if value is not None:
+            self._add(float(value))
+
+    @abstractmethod
+    def _add(self, value):
+        pass
+
+    @abstractmethod
+    def result(self):
+        pass
+
+
+class SumAggregator(Aggregator):
+    pretty_name = "total"
+
+    def __init__(self):
+        self.total = 0.0
+
+    def _add(self, value):
+        self.total += value
+
+    def result(self):
+        return self.total
+
+
+class CountAggregator(Aggregator):
+    pretty_name = "count"
+
+    def __init__(self):
+        self.count = 0
+
+    def _add(self, value):
+        self.count += 1
+
+    def result(self):
+        return self.count
+
+
+class AverageAggregator(Aggregator):
+    """
+    The result is None until a value has been added.
+    """
+    pretty_name = "avg"
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def _add(self, value):
+        self.total += value
+        self.count += 1
+
+    def result(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+class MinAggregator(Aggregator):
+    pretty_name = "min"
+
+    def __init__(self):
+        self.minimum = None
+
+    def _add(self, value):
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+
+    def result(self):
+        return self.minimum
+
+
+class MaxAggregator(Aggregator):
+    pretty_name = "max"
+
+    def __init__(self):
+        self.maximum = None
+
+    def _add(self, value):
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def result(self):
+        return self.maximum
+
+
+class QuantileAggregator(Aggregator):
+    """
+    Approximates a quantile with the P-squared algorithm
+    (Jain and Chlamtac, 1985).
+
+    quantile: the quantile to track, between 0 and 1.
+
+    Five markers are kept and adjusted as values arrive,
+    so memory does not grow with the number of values.
+    The result is exact for five values or fewer.
+    """
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.pretty_name = "p{0:g}".format(quantile * 100)
+        self._heights = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0, 2 * quantile, 4 * quantile, 2 + 2 * quantile, 4]
+        self._increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def _add(self, value):
+        heights = self._heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self._positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        for i in range(1, 4):
+            offset = self._desired[i] - positions[i]
+            if ((offset >= 1 and positions[i + 1] - positions[i] > 1) or
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        q = self._heights
+        n = self._positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def _linear(self, i, step):
+        q = self._heights
+        n = self._positions
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    def result(self):
+        heights = self._heights
+        if not heights:
+            return None
+        if len(heights) < 5 or self._positions[4] == 4:
+            # Few enough values to interpolate between them exactly.
+            rank = self.quantile * (len(heights) - 1)
+            lower = int(rank)
+            upper = min(lower + 1, len(heights) - 1)
+            return heights[lower] + (heights[upper] - heights[lower]) * (
+                                                                rank - lower)
+        return heights[2]
+
+
+AGGREGATORS = {
+    "sum": SumAggregator,
+    "average": AverageAggregator,
+    "min": MinAggregator,
+    "max": MaxAggregator,
+    "count": CountAggregator,
+    "p50": lambda: QuantileAggregator(0.5),
+    "p95": lambda: QuantileAggregator(0.95),
+    "p99": lambda: QuantileAggregator(0.99),
+}
+
+
+def build_aggregator(method):
+    """
+    Return a new aggregator for a reduce method.
+
+    method: one of the keys of AGGREGATORS.
+    """
+    try:
+        return AGGREGATORS[method]()
+    except KeyError:
+        raise ValueError("Unknown reduce method: {0}".format(method))
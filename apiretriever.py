@@ -1,6 +1,15 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import threading
+
 import requests
-from siteretriever import ListingsRetriever, SiteRetriever
-from secure import PRIVATE_SETTINGS
+from cacheutils import write_json
+from connections import build_session
+from scheduler import FetchScheduler, RETRY_STATUSES
 
 
 def post_listings(url, listings):
@@ -13,11 +22,230 @@ def post_listings(url, listings):
         return response
 
 
-if __name__ == "__main__":
+class BatchUploader:
+    """
+    Uploads site dictionaries to an API in batches.
+
+    url: the url each batch is POSTed to.
+    batch_size: the number of sites in each batch.
+    max_in_flight: the most batches being uploaded at once.
+    checkpoint_path: an optional file to record the uploaded batches in.
+    An interrupted upload of a named source given the same checkpoint
+    resumes where it left off instead of starting over.
+    The checkpoint is removed once an upload finishes.
+    session: an optional requests.Session.
+    If none is given, a pooled session sized to max_in_flight is created.
+    scheduler: an optional scheduler.FetchScheduler to make the requests with.
+    If none is given, one that also retries 429 Too Many Requests is created.
+
+    Each batch is sent as gzip compressed JSON, {"sites": [...]},
+    with an Idempotency-Key header,
+    so a batch that is retried or sent again on resuming
+    can be recognized by the API.
+    The sites are read from the iterable as batches are needed,
+    so at most max_in_flight + 1 batches are held in memory.
+
+    The checkpoint records how many of the leading sites have been uploaded,
+    along with the few batches past them that finished early,
+    so it stays small however many sites there are.
+    """
+    def __init__(self, url, batch_size=100, max_in_flight=3,
+                 checkpoint_path=None, session=None, scheduler=None):
+        self.url = url
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.checkpoint_path = checkpoint_path
+        if session is None:
+            session = build_session(max_in_flight)
+        self.session = session
+        if scheduler is None:
+            scheduler = FetchScheduler(retries=3, backoff=0.5,
+                                       retry_statuses=RETRY_STATUSES | {429})
+        self.scheduler = scheduler
+        self.uploaded = 0
+        self.skipped = 0
+        self.retries = 0
+        self.source = None
+        self._uploaded_through = 0
+        self._done_ahead = {}
+        self._lock = threading.Lock()
+
+    def upload(self, site_dicts, source=None):
+        """
+        Upload the site dictionaries and return the number of batches sent.
+
+        site_dicts: an iterable of site dictionaries,
+        e.g. the sites of a stored crawl, CrawlStore.sites(run_id).
+        source: an optional name for the data, e.g. the id of the crawl run.
+        Each batch is then keyed by the source and its place in the data,
+        so it has the same key however often it is sent.
+        Without a source, a batch is keyed by its contents,
+        and the upload isn't checkpointed,
+        since there is nothing to tell it from an upload of other data.
+
+        An upload resumes from the checkpoint if it has the same url,
+        source and batch size, and is given the same sites in the same order.
+        The batches recorded in the checkpoint are skipped.
+        If a batch can't be uploaded, the batches in flight are finished
+        and the error is raised.
+        """
+        self._load_checkpoint(source)
+        print("Uploading sites data...")
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            in_flight = set()
+            try:
+                for offset, batch in self._iter_batches(site_dicts):
+                    if self._is_uploaded(offset, len(batch)):
+                        self.skipped += 1
+                        continue
+                    body = self._encode(batch)
+                    key = self._get_key(offset, len(batch), body)
+                    if len(in_flight) >= self.max_in_flight:
+                        done, in_flight = wait(in_flight,
+                                               return_when=FIRST_COMPLETED)
+                        self._check(done)
+                    in_flight.add(executor.submit(self._upload_batch, key,
+                                                  offset, len(batch), body))
+                    sent += 1
+            finally:
+                done, _ = wait(in_flight)
+            self._check(done)
+        self._remove_checkpoint()
+        print("Sites data uploaded: {0} batches sent, {1} already uploaded."
+              .format(sent, self.skipped))
+        return sent
+
+    def _iter_batches(self, site_dicts):
+        """
+        Yield (offset, batch) tuples,
+        where batch is a list of up to batch_size site dictionaries
+        and offset is the position of its first site in site_dicts.
+        """
+        site_dicts = iter(site_dicts)
+        offset = 0
+        while True:
+            batch = list(itertools.islice(site_dicts, self.batch_size))
+            if not batch:
+                return
+            yield offset, batch
+            offset += len(batch)
+
+    def _get_key(self, offset, length, body):
+        """
+        Return the idempotency key of a batch.
+        """
+        if self.source is None:
+            return hashlib.sha256(body).hexdigest()
+        identity = json.dumps([self.url, self.source, offset, length])
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
 
-    lr = ListingsRetriever()
-    listings = lr.get_listings()
+    def _is_uploaded(self, offset, length):
+        return (offset + length <= self._uploaded_through or
+                self._done_ahead.get(offset) == length)
+
+    @staticmethod
+    def _encode(batch):
+        """
+        Return a batch as gzip compressed JSON.
+
+        The same batch always encodes to the same bytes,
+        so its digest can serve as its idempotency key.
+        """
+        data = json.dumps({"sites": [dict(site_dict) for site_dict in batch]},
+                          sort_keys=True, default=str).encode("utf-8")
+        return gzip.compress(data, mtime=0)
+
+    def _upload_batch(self, key, offset, length, body):
+        """
+        POST one batch, retrying transient failures,
+        and record it in the checkpoint once the API has accepted it.
+        """
+        headers = {"Content-Type": "application/json",
+                   "Content-Encoding": "gzip",
+                   "Idempotency-Key": key}
+        response = self.scheduler.request(self.session, "POST", self.url,
+                                          on_retry=self._record_retry,
+                                          data=body, headers=headers)
+        response.raise_for_status()
+        with self._lock:
+            self.uploaded += 1
+            self._done_ahead[offset] = length
+            while self._uploaded_through in self._done_ahead:
+                self._uploaded_through += self._done_ahead.pop(
+                                                    self._uploaded_through)
+            self._save_checkpoint()
+
+    def _record_retry(self, url):
+        with self._lock:
+            self.retries += 1
+
+    @staticmethod
+    def _check(futures):
+        """
+        Raise the first error, if any, of finished uploads.
+        """
+        for future in futures:
+            future.result()
+
+    def _load_checkpoint(self, source):
+        """
+        Start an upload of source where the checkpoint left it,
+        or from the beginning if the checkpoint is of another upload.
+        """
+        self.source = source
+        self._uploaded_through = 0
+        self._done_ahead = {}
+        if self.checkpoint_path is None or source is None:
+            return
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if (checkpoint.get("url"), checkpoint.get("source"),
+                checkpoint.get("batch_size")) != (self.url, source,
+                                                  self.batch_size):
+            return
+        self._uploaded_through = checkpoint["uploaded_through"]
+        self._done_ahead = {offset: length
+                            for offset, length in checkpoint["done_ahead"]}
+
+    def _save_checkpoint(self):
+        """
+        Write the upload's progress to the checkpoint.
+        """
+        if self.checkpoint_path is None or self.source is None:
+            return
+        write_json(self.checkpoint_path,
+                   {"url": self.url, "source": self.source,
+                    "batch_size": self.batch_size,
+                    "uploaded_through": self._uploaded_through,
+                    "done_ahead": sorted(self._done_ahead.items())})
+
+    def _remove_checkpoint(self):
+        """
+        Remove the checkpoint of a finished upload,
+        so a later upload starts from the beginning.
+        """
+        if self.checkpoint_path is None or self.source is None:
+            return
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    # Usage: python apiretriever.py [crawl.db [run id]]
+    # A saved crawl is uploaded rather than a fresh one,
+    # so running this again after an interruption resumes the upload.
+    import sys
+    from crawlstore import CrawlStore
+    from secure import PRIVATE_SETTINGS
 
-    post_url = PRIVATE_SETTINGS["POST_SITES_LIST_URL"]
-    response = post_listings(post_url, listings)
-    print(response)
+    store = CrawlStore(sys.argv[1] if len(sys.argv) > 1 else "crawl.db")
+    run_id = sys.argv[2] if len(sys.argv) > 2 else store.get_runs()[-1]
+    uploader = BatchUploader(PRIVATE_SETTINGS["UPLOAD_SITES_URL"],
+                             checkpoint_path="upload_checkpoint.json")
+    uploader.upload(store.sites(run_id), source=run_id)
@@ -0,0 +1,436 @@
+"""
+Benchmarks for the retrievers and report builders.
+
+Run a benchmark with `python benchmark.py <name>`.
+`python benchmark.py --help` lists the available benchmarks.
+"""
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+from columnar import ColumnarReader
+from benchserver import SyntheticSiteServer, LISTINGS_PATH, LOGIN_PATH
+from instrumentation import Instrumentation
+from nameindex import NameIndex
+from parsepool import ParsePool
+from reportbuilder import (WordCountReportBuilder, HeaderReportBuilder,
+                           PerformanceReportBuilder, FrequencyReportBuilder,
+                           get_required_fields)
+from reportengine import ReportEngine
+from siteretriever import ListingsRetriever, SiteRetriever
+from sitestore import SiteRecordStore
+from test_data import alexa_text
+from wordcounter import count_words
+
+
+def measure(func, *args, repeat=5):
+    """
+    Return the best time in seconds and the peak traced memory in bytes
+    of calling func with args.
+
+    repeat: the number of timed calls.
+    """
+    best_time = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+
+    tracemalloc.start()
+    func(*args)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best_time, peak_memory
+
+
+def print_result(name, seconds, peak_memory):
+    print("{0:<32} {1:>10.4f}s {2:>12,} bytes peak".format(
+                                                name, seconds, peak_memory))
+
+
+def benchmark_wordcount(args):
+    """
+    Compare the streaming word counter against the BeautifulSoup path.
+    """
+    def soup_count(text):
+        return len(BeautifulSoup(text, 'html.parser').get_text().split())
+
+    def streaming_count(text):
+        chunks = (text[i:i + args.chunk_size]
+                  for i in range(0, len(text), args.chunk_size))
+        return count_words(chunks)
+
+    pages = [("alexa listings page", alexa_text),
+             ("alexa listings page x{0}".format(args.scale),
+              alexa_text * args.scale)]
+    for page_name, text in pages:
+        print("{0} ({1:,} characters)".format(page_name, len(text)))
+        assert soup_count(text) == streaming_count(text)
+        for name, func in [("BeautifulSoup", soup_count),
+                           ("StreamingWordCounter", streaming_count)]:
+            seconds, peak_memory = measure(func, text, repeat=args.repeat)
+            print_result(name, seconds, peak_memory)
+
+
+def build_synthetic_sites(num_sites):
+    """
+    Return a list of site dictionaries shaped like SiteRetriever's output.
+
+    Every header and cookie name is a separate string object,
+    as it would be when parsed from separate responses.
+    """
+    rng = random.Random(0)
+    header_names = (["Content-Type", "Set-Cookie", "Date", "Server",
+                     "Cache-Control", "Expires", "Vary", "Content-Encoding",
+                     "Strict-Transport-Security", "X-Frame-Options",
+                     "X-XSS-Protection", "X-Content-Type-Options"] +
+                    ["X-Custom-{0}".format(number) for number in range(40)])
+    cookie_names = ["session", "tracking_id", "consent", "locale"] + [
+                    "cookie_{0}".format(number) for number in range(40)]
+    sites = []
+    for number in range(num_sites):
+        headers = rng.sample(header_names, rng.randint(8, 16))
+        cookies = rng.sample(cookie_names, rng.randint(0, 6))
+        sites.append({
+            "site_name": "site{0}.example.com".format(number),
+            "headers": ["".join(list(name)) for name in headers],
+            "cookies": ["".join(list(name)) for name in cookies],
+            "word_count": rng.randint(0, 20000),
+            "time_to_complete": rng.random()})
+    return sites
+
+
+def benchmark_sitestore(args):
+    """
+    Compare the memory used by a list of site dicts and a SiteRecordStore.
+    """
+    for name, build in [("list of dicts", build_synthetic_sites),
+                        ("SiteRecordStore", lambda num_sites:
+                            SiteRecordStore.from_dicts(
+                                build_synthetic_sites(num_sites)))]:
+        tracemalloc.start()
+        sites = build(args.num_sites)
+        retained_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{0:<32} {1:>14,} bytes for {2:,} sites".format(
+                                    name, retained_memory, len(sites)))
+        del sites
+
+
+def benchmark_report_formats(args):
+    """
+    Compare writing and loading a large report in each machine-readable format.
+    """
+    def load_csv(filename):
+        with open(filename, newline="") as f:
+            return sum(int(row[2]) for row in
+                       itertools.islice(csv.reader(f), 1, None))
+
+    def load_jsonl(filename):
+        with open(filename) as f:
+            return sum(json.loads(line)["word_count"] for line in f)
+
+    def load_columnar(filename):
+        with ColumnarReader(filename) as reader:
+            word_counts = reader.column("word_count")
+            total = sum(word_counts)
+            word_counts.release()
+            return total
+
+    sites = SiteRecordStore.from_dicts(build_synthetic_sites(args.num_sites))
+    builder = WordCountReportBuilder(sites)
+    print("Word Count Report of {0:,} sites".format(args.num_sites))
+    with tempfile.TemporaryDirectory() as report_dir:
+        for file_format, load in [("csv", load_csv), ("jsonl", load_jsonl),
+                                  ("columnar", load_columnar)]:
+            filename = os.path.join(report_dir, builder.get_filename(
+                                                                file_format))
+            builder.get_filename = lambda file_format: filename
+            start = time.perf_counter()
+            builder.create_report(file_format)
+            written = time.perf_counter()
+            load(filename)
+            loaded = time.perf_counter()
+            print("{0:<10} write {1:>8.3f}s  load word_count {2:>8.4f}s  "
+                  "{3:>14,} bytes".format(file_format, written - start,
+                                          loaded - written,
+                                          os.path.getsize(filename)))
+
+
+def benchmark_startup(args):
+    """
+    Compare the time it takes to start python with the modules each command needs.
+    """
+    imports = [
+        ("python", "pass"),
+        ("main.py (command line only)", "import main"),
+        ("report", "import main, reportbuilder, reportengine, crawlstore, "
+                   "nameindex"),
+        ("crawl (network stack)", "import main, siteretriever, httpcache, "
+                                  "crawlstore, instrumentation, nameindex"),
+        ("every module (old main.py)", "import siteretriever, reportbuilder, "
+                                       "nameindex, reportengine, httpcache, "
+                                       "crawlstore, instrumentation")]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name, code in imports:
+        best_time = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=directory,
+                           check=True)
+            elapsed = time.perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+        print("{0:<32} {1:>10.4f}s".format(name, best_time))
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of this process, in bytes.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak_rss
+    return peak_rss * 1024
+
+
+def percentile(sorted_values, quantile):
+    """
+    Return the nearest-rank percentile of a sorted list,
+    or None if it is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(round(quantile * len(sorted_values))) - 1, 0)
+    return sorted_values[rank]
+
+
+def run_end_to_end(num_sites=100, max_workers=10, page_words=1000,
+                   latency=0.0, latency_jitter=0.0, num_headers=10,
+                   num_cookies=3, ssl_failure_rate=0.0, error_rate=0.0,
+                   parse_processes=None, prewarm=0, header_only=False):
+    """
+    Return the results of crawling a synthetic site server
+    and building every report from the crawl.
+
+    The arguments configure the server and the SiteRetriever.
+    parse_processes: if given, bodies are parsed in a parsepool.ParsePool
+    of that many processes.
+    prewarm: the number of sites ahead to connect to in the background.
+    header_only: if True, only the fields of the header report are fetched,
+    so the bodies aren't read.
+    """
+    config = {"num_sites": num_sites, "max_workers": max_workers,
+              "page_words": page_words, "latency": latency,
+              "latency_jitter": latency_jitter, "num_headers": num_headers,
+              "num_cookies": num_cookies,
+              "ssl_failure_rate": ssl_failure_rate, "error_rate": error_rate,
+              "parse_processes": parse_processes, "prewarm": prewarm,
+              "header_only": header_only}
+    server = SyntheticSiteServer(num_sites=num_sites, page_words=page_words,
+                                 latency=latency, latency_jitter=latency_jitter,
+                                 num_headers=num_headers,
+                                 num_cookies=num_cookies,
+                                 ssl_failure_rate=ssl_failure_rate,
+                                 error_rate=error_rate)
+    with server, tempfile.TemporaryDirectory() as report_dir:
+        lr = ListingsRetriever("bench@example.com", "secret",
+                               num_sites=num_sites)
+        lr.BASE_URL = server.base_url + LISTINGS_PATH
+        lr.LOGIN_URL = server.base_url + LOGIN_PATH
+        instrumentation = Instrumentation()
+        fields = None
+        if header_only:
+            fields = get_required_fields([HeaderReportBuilder([])])
+        parse_pool = None
+        if parse_processes:
+            parse_pool = ParsePool(processes=parse_processes)
+        sr = SiteRetriever(max_workers=max_workers,
+                           instrumentation=instrumentation,
+                           parse_pool=parse_pool, prewarm=prewarm,
+                           fields=fields)
+
+        # The retrievers report their progress on stdout.
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            listings = lr.get_listings()
+            listed = time.perf_counter()
+            sites = sr.build_sites_list(listings)
+            crawled = time.perf_counter()
+
+        render_seconds = {}
+        working_dir = os.getcwd()
+        os.chdir(report_dir)
+        try:
+            builders = [WordCountReportBuilder(sites),
+                        HeaderReportBuilder(sites),
+                        PerformanceReportBuilder(sites)]
+            index = NameIndex.from_sites(sites)
+            builders.extend(FrequencyReportBuilder(index, kind)
+                            for kind in NameIndex.KINDS)
+            for builder in builders:
+                render_start = time.perf_counter()
+                builder.create_report("html")
+                render_seconds[builder.header] = (time.perf_counter() -
+                                                  render_start)
+            render_start = time.perf_counter()
+            ReportEngine(builders[:3]).create_reports(sites, "html")
+            render_seconds["ReportEngine (standard reports)"] = (
+                                        time.perf_counter() - render_start)
+        finally:
+            os.chdir(working_dir)
+
+    latencies = sorted(site["time_to_complete"] for site in sites)
+    crawl_seconds = crawled - listed
+    return {"config": config,
+            "sites_listed": len(listings),
+            "sites_retrieved": len(sites),
+            "errors": dict(instrumentation.errors),
+            "listings_seconds": listed - start,
+            "crawl_seconds": crawl_seconds,
+            "sites_per_second": len(listings) / crawl_seconds,
+            "p50_latency": percentile(latencies, 0.5),
+            "p99_latency": percentile(latencies, 0.99),
+            "peak_rss_bytes": get_peak_rss(),
+            "render_seconds": render_seconds}
+
+
+def save_result(path, label, result):
+    """
+    Append a labelled result to a JSON lines file of benchmark results.
+    """
+    entry = {"label": label,
+             "timestamp": time.time(),
+             "python": platform.python_version(),
+             "result": result}
+    with open(path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def load_previous_result(path, config):
+    """
+    Return the most recent saved entry with the same config,
+    or None if there isn't one.
+    """
+    previous = None
+    try:
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["result"]["config"] == config:
+                    previous = entry
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def print_end_to_end_result(result, previous=None):
+    """
+    Print a result, with the change from a previous entry if given.
+    """
+    def change(key):
+        if previous is None or not previous["result"].get(key):
+            return ""
+        old_value = previous["result"][key]
+        return " ({0:+.1f}% vs {1})".format(
+            100 * (result[key] - old_value) / old_value, previous["label"])
+
+    print("sites retrieved:   {0} of {1} {2}".format(
+        result["sites_retrieved"], result["sites_listed"], result["errors"]))
+    print("sites/sec:         {0:.1f}{1}".format(
+        result["sites_per_second"], change("sites_per_second")))
+    for key in ["p50_latency", "p99_latency"]:
+        print("{0:<18} {1:.4f}s{2}".format(
+                        key.replace("_", " ") + ":", result[key], change(key)))
+    print("peak RSS:          {0:,} bytes{1}".format(
+        result["peak_rss_bytes"], change("peak_rss_bytes")))
+    for name, seconds in result["render_seconds"].items():
+        print("render {0:<40} {1:.4f}s".format(name + ":", seconds))
+
+
+def benchmark_end_to_end(args):
+    """
+    Crawl a local synthetic site server and build every report.
+    """
+    result = run_end_to_end(
+        num_sites=args.num_sites, max_workers=args.max_workers,
+        page_words=args.page_words, latency=args.latency,
+        latency_jitter=args.latency_jitter, num_headers=args.num_headers,
+        num_cookies=args.num_cookies, ssl_failure_rate=args.ssl_failure_rate,
+        error_rate=args.error_rate, parse_processes=args.parse_processes,
+        prewarm=args.prewarm, header_only=args.header_only)
+    previous = load_previous_result(args.results, result["config"])
+    print_end_to_end_result(result, previous)
+    if not args.no_save:
+        save_result(args.results, args.label, result)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    wordcount = subparsers.add_parser(
+        "wordcount", help=benchmark_wordcount.__doc__.strip())
+    wordcount.add_argument("--scale", type=int, default=50)
+    wordcount.add_argument("--chunk-size", type=int, default=8192)
+    wordcount.add_argument("--repeat", type=int, default=5)
+    wordcount.set_defaults(func=benchmark_wordcount)
+
+    sitestore = subparsers.add_parser(
+        "sitestore", help=benchmark_sitestore.__doc__.strip())
+    sitestore.add_argument("--num-sites", type=int, default=100000)
+    sitestore.set_defaults(func=benchmark_sitestore)
+
+    report_formats = subparsers.add_parser(
+        "report-formats", help=benchmark_report_formats.__doc__.strip())
+    report_formats.add_argument("--num-sites", type=int, default=1000000)
+    report_formats.set_defaults(func=benchmark_report_formats)
+
+    startup = subparsers.add_parser(
+        "startup", help=benchmark_startup.__doc__.strip())
+    startup.add_argument("--repeat", type=int, default=10)
+    startup.set_defaults(func=benchmark_startup)
+
+    end_to_end = subparsers.add_parser(
+        "end-to-end", help=benchmark_end_to_end.__doc__.strip())
+    end_to_end.add_argument("--num-sites", type=int, default=100)
+    end_to_end.add_argument("--max-workers", type=int, default=10)
+    end_to_end.add_argument("--page-words", type=int, default=1000)
+    end_to_end.add_argument("--latency", type=float, default=0.0)
+    end_to_end.add_argument("--latency-jitter", type=float, default=0.0)
+    end_to_end.add_argument("--num-headers", type=int, default=10)
+    end_to_end.add_argument("--num-cookies", type=int, default=3)
+    end_to_end.add_argument("--ssl-failure-rate", type=float, default=0.0)
+    end_to_end.add_argument("--error-rate", type=float, default=0.0)
+    end_to_end.add_argument("--parse-processes", type=int, default=None)
+    end_to_end.add_argument("--prewarm", type=int, default=0)
+    end_to_end.add_argument("--header-only", action="store_true")
+    end_to_end.add_argument("--label", default="unlabelled",
+                            help="a name for this run, e.g. a version")
+    end_to_end.add_argument("--results", default="benchmark_results.jsonl",
+                            help="the file results are saved to and "
+                                 "compared against")
+    end_to_end.add_argument("--no-save", action="store_true")
+    end_to_end.set_defaults(func=benchmark_end_to_end)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,242 @@
+"""
+A local stand-in for Alexa and the sites it lists, for benchmarking.
+
+SyntheticSiteServer serves:
+a login endpoint and top sites listing pages shaped like Alexa's,
+and a synthetic landing page for every listed site.
+
+The listed sites are paths on the server itself
+(e.g. 127.0.0.1:8000/sites/1),
+so ListingsRetriever and SiteRetriever can be run against it unchanged.
+
+It also accepts uploads of site data, as apiretriever.BatchUploader sends them.
+"""
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import sys
+import threading
+import time
+
+
+LISTINGS_PER_PAGE = 25
+LOGIN_PATH = "/secure/login/ajaxex"
+LISTINGS_PATH = "/topsites/global;"
+SITES_PATH = "/sites/"
+UPLOAD_PATH = "/upload"
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+class SyntheticSiteServer(ThreadingHTTPServer):
+    """
+    An HTTP server of synthetic Alexa listings and landing pages.
+
+    num_sites: the number of sites listed.
+    page_words: the number of words on each landing page.
+    latency: seconds to wait before answering a landing page request.
+    latency_jitter: up to this many extra seconds, chosen per site.
+    num_headers: the number of extra headers each site sends.
+    num_cookies: the number of cookies each site sets.
+    ssl_failure_rate: the share of sites that redirect to https
+    on a port that doesn't speak TLS, so the fetch fails with an SSLError.
+    error_rate: the share of sites that drop the connection without replying.
+    seed: the seed that decides which sites fail and how slow each one is.
+
+    uploads: a dictionary of idempotency key to the sites uploaded with it.
+    upload_requests: the number of upload requests received.
+    failing_uploads: the number of upload requests still to be answered
+    with 503 Service Unavailable. Set it to simulate an outage.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, num_sites=100, page_words=1000, latency=0.0,
+                 latency_jitter=0.0, num_headers=10, num_cookies=3,
+                 ssl_failure_rate=0.0, error_rate=0.0, seed=0,
+                 address=("127.0.0.1", 0)):
+        super().__init__(address, SyntheticSiteHandler)
+        self.num_sites = num_sites
+        self.page_words = page_words
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.num_headers = num_headers
+        self.num_cookies = num_cookies
+        self.ssl_failure_rate = ssl_failure_rate
+        self.error_rate = error_rate
+        self.seed = seed
+        self.uploads = {}
+        self.upload_requests = 0
+        self.failing_uploads = 0
+        self._upload_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def host(self):
+        return "{0}:{1}".format(*self.server_address[:2])
+
+    @property
+    def base_url(self):
+        return "http://" + self.host
+
+    def site_name(self, rank):
+        """
+        Return the listing of the site at a rank, without a protocol.
+        """
+        return "{0}{1}{2}".format(self.host, SITES_PATH, rank)
+
+    def site_behaviour(self, rank):
+        """
+        Return (behaviour, latency) for the site at a rank.
+
+        behaviour: ok, ssl_failure or error.
+        """
+        rng = random.Random("{0}-{1}".format(self.seed, rank))
+        roll = rng.random()
+        if roll < self.ssl_failure_rate:
+            behaviour = "ssl_failure"
+        elif roll < self.ssl_failure_rate + self.error_rate:
+            behaviour = "error"
+        else:
+            behaviour = "ok"
+        return behaviour, self.latency + rng.random() * self.latency_jitter
+
+    def build_page(self, rank):
+        """
+        Return the landing page of the site at a rank.
+        """
+        words = " ".join(WORDS[(rank + i) % len(WORDS)]
+                         for i in range(self.page_words))
+        return ("<!DOCTYPE html><html><head><title>Site {0}</title>"
+                "<script>var ignored = true;</script></head>"
+                "<body><p>{1}</p></body></html>").format(rank, words)
+
+    def build_listings_page(self, number):
+        """
+        Return a top sites page, shaped like Alexa's, for a page number.
+        """
+        first_rank = number * LISTINGS_PER_PAGE + 1
+        last_rank = min(first_rank + LISTINGS_PER_PAGE, self.num_sites + 1)
+        listings = "".join(
+            '<div class="tr site-listing"><div class="td">{0}</div>'
+            '<div class="td DescriptionCell"><p>\n{1}\n</p></div></div>'
+            .format(rank, self.site_name(rank))
+            for rank in range(first_rank, last_rank))
+        return ('<html><body><div class="listings table">{0}</div>'
+                '</body></html>').format(listings)
+
+    def receive_upload(self, key, body):
+        """
+        Return the status to answer an upload with, saving its sites.
+
+        key: the upload's idempotency key.
+        body: the gzip compressed JSON body of the upload.
+
+        An upload whose key has been seen before is acknowledged
+        without being saved again.
+        """
+        with self._upload_lock:
+            self.upload_requests += 1
+            if self.failing_uploads:
+                self.failing_uploads -= 1
+                return 503
+            if not key:
+                return 400
+            if key in self.uploads:
+                return 200
+            self.uploads[key] = json.loads(gzip.decompress(body))["sites"]
+            return 201
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        """
+        Ignore clients that hang up partway through a reply,
+        as header-only crawls do once they have the headers,
+        and print a traceback for anything else.
+        """
+        if isinstance(sys.exc_info()[1], (ConnectionResetError,
+                                           BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class SyntheticSiteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.path == LOGIN_PATH:
+            self._send(200, '{"success": true}', "application/json")
+        elif self.path == UPLOAD_PATH:
+            status = self.server.receive_upload(
+                                self.headers.get("Idempotency-Key"), body)
+            self._send(status, '{}', "application/json")
+        else:
+            self._send(404, "not found")
+
+    def do_GET(self):
+        if self.path.startswith(LISTINGS_PATH):
+            number = int(self.path[len(LISTINGS_PATH):])
+            self._send(200, self.server.build_listings_page(number))
+        elif self.path.startswith(SITES_PATH):
+            self._send_site(int(self.path[len(SITES_PATH):]))
+        else:
+            self._send(404, "not found")
+
+    def _send_site(self, rank):
+        server = self.server
+        behaviour, latency = server.site_behaviour(rank)
+        if latency:
+            time.sleep(latency)
+        if behaviour == "error":
+            self.close_connection = True
+            self.connection.close()
+            return
+        if behaviour == "ssl_failure":
+            self.send_response(301)
+            self.send_header("Location", "https://{0}{1}{2}".format(
+                                                server.host, SITES_PATH, rank))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        extra_headers = [("X-Synthetic-{0}".format(i), str(i))
+                         for i in range(server.num_headers)]
+        extra_headers.extend(
+            ("Set-Cookie", "cookie_{0}={1}; Path=/".format(i, rank))
+            for i in range(server.num_cookies))
+        self._send(200, server.build_page(rank), extra_headers=extra_headers)
+
+    def _send(self, status, text, content_type="text/html; charset=utf-8",
+              extra_headers=()):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
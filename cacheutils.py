@@ -0,0 +1,58 @@
+"""
+Pieces shared by the caches and the other files that keep state on disk.
+"""
+import json
+import os
+import threading
+
+
+def write_json(path, data):
+    """
+    Write data to path as JSON.
+
+    The data is written to a temporary file first and then moved into place,
+    so readers never see half of it, even if the write is interrupted.
+    The temporary file is named after the process and thread,
+    so writers in other threads and processes don't collide.
+    """
+    temp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(),
+                                         threading.get_ident())
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+class HitCounter:
+    """
+    Mixin for objects that count hits and misses under self._lock.
+
+    The subclass sets hits, misses and _lock in its __init__.
+    The lock can't be pickled, so it is left out
+    and a new one made when the object is unpickled;
+    a copy is made for each process the object is sent to,
+    and what is counted in other processes isn't sent back.
+    """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+        Return a dictionary of the hit and miss counters.
+        """
+        with self._lock:
+            return self._get_stats()
+
+    def _get_stats(self):
+        """
+        Return the counters. Called with the lock held.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": hit_rate}
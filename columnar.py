@@ -0,0 +1,289 @@
+"""
+A compact, column oriented file format for reports.
+
+A columnar report file is laid out as:
+the magic bytes,
+each column's data, padded to a multiple of 8 bytes,
+a utf-8 JSON footer describing the columns and the report,
+the footer's length as an 8 byte little endian integer,
+and the magic bytes again.
+
+Column kinds:
+int: 8 byte signed integers.
+float: 8 byte floats. Missing values are NaN.
+bool: one byte per value, 0 or 1.
+str: n + 1 8 byte offsets into a utf-8 buffer.
+list: n + 1 8 byte offsets into the items of a str column stored after them.
+
+Numbers are stored in the machine's native byte order,
+which the footer records.
+
+ColumnarReader memory-maps a file,
+so numeric columns are read without copying or parsing,
+and strings are only decoded when they are looked at.
+"""
+from array import array
+from collections.abc import Sequence
+import json
+import math
+import mmap
+import struct
+import sys
+
+
+MAGIC = b"RGRCOL1\n"
+_FOOTER_LENGTH = struct.Struct("<Q")
+
+
+class ColumnBuilder:
+    """
+    Collects the values of one column, a row at a time.
+
+    The column's kind is decided from its values once they have all been seen.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.values = []
+
+    def append(self, value):
+        self.values.append(value)
+
+    def get_kind(self):
+        """
+        Return the kind of column that fits every value.
+        """
+        kinds = set()
+        for value in self.values:
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                kinds.add("bool")
+            elif isinstance(value, int):
+                kinds.add("int")
+            elif isinstance(value, float):
+                kinds.add("float")
+            elif isinstance(value, (list, tuple)):
+                kinds.add("list")
+            else:
+                kinds.add("str")
+        has_missing = any(value is None for value in self.values)
+        if kinds <= {"int"} and not has_missing:
+            return "int"
+        if kinds <= {"int", "float"} and kinds:
+            return "float"
+        if kinds == {"bool"} and not has_missing:
+            return "bool"
+        if kinds == {"list"}:
+            return "list"
+        return "str"
+
+    def encode(self):
+        """
+        Return (kind, blocks) for the column,
+        where blocks is a list of byte strings holding its data.
+        """
+        kind = self.get_kind()
+        if kind == "int":
+            return kind, [array("q", self.values).tobytes()]
+        if kind == "float":
+            return kind, [array("d", (math.nan if value is None
+                                      else float(value)
+                                      for value in self.values)).tobytes()]
+        if kind == "bool":
+            return kind, [bytes(bytearray(self.values))]
+        if kind == "list":
+            item_offsets = array("Q", [0])
+            items = []
+            for value in self.values:
+                items.extend(value or ())
+                item_offsets.append(len(items))
+            return kind, [item_offsets.tobytes()] + _encode_strings(items)
+        return kind, _encode_strings(
+            "" if value is None else str(value) for value in self.values)
+
+
+def _encode_strings(strings):
+    """
+    Return [offsets, buffer] byte strings for a str column.
+    """
+    offsets = array("Q", [0])
+    buffer = bytearray()
+    for string in strings:
+        buffer.extend(string.encode("utf-8"))
+        offsets.append(len(buffer))
+    return [offsets.tobytes(), bytes(buffer)]
+
+
+def _padding(length):
+    return b"\0" * (-length % 8)
+
+
+def iter_columnar_file(columns, metadata):
+    """
+    Yield the chunks of a columnar file.
+
+    columns: a list of ColumnBuilders, all of the same length.
+    metadata: a JSON serializable dictionary saved in the footer.
+    """
+    yield MAGIC
+    offset = len(MAGIC)
+    footer_columns = []
+    num_rows = len(columns[0].values) if columns else 0
+    for column in columns:
+        kind, blocks = column.encode()
+        block_offsets = []
+        for block in blocks:
+            block_offsets.append([offset, len(block)])
+            yield block
+            yield _padding(len(block))
+            offset += len(block) + len(_padding(len(block)))
+        footer_columns.append({"name": column.name, "kind": kind,
+                               "blocks": block_offsets})
+    footer = json.dumps({"byteorder": sys.byteorder,
+                         "num_rows": num_rows,
+                         "columns": footer_columns,
+                         "metadata": metadata}).encode("utf-8")
+    yield footer
+    yield _FOOTER_LENGTH.pack(len(footer))
+    yield MAGIC
+
+
+class ColumnarReader:
+    """
+    Reads a columnar report file through a memory map.
+
+    path: the file to read.
+
+    metadata: the dictionary saved with the report.
+    num_rows: the number of rows in the report.
+    column_names: the names of the columns, in order.
+
+    Columns are views of the mapped file,
+    so they must be released (or dropped) before the reader is closed.
+    Use the reader as a context manager to close it.
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("{0} is not a columnar report".format(path))
+        self._view = memoryview(self._map)
+        footer = self._read_footer(path)
+        if footer["byteorder"] != sys.byteorder:
+            self.close()
+            raise ValueError("{0} was written with {1} endian numbers".format(
+                                                    path, footer["byteorder"]))
+        self.metadata = footer["metadata"]
+        self.num_rows = footer["num_rows"]
+        self._columns = {column["name"]: column
+                         for column in footer["columns"]}
+        self.column_names = [column["name"] for column in footer["columns"]]
+
+    def _read_footer(self, path):
+        size = len(self._map)
+        tail = len(MAGIC) + _FOOTER_LENGTH.size
+        if (size < len(MAGIC) + tail or self._map[:len(MAGIC)] != MAGIC or
+                self._map[size - len(MAGIC):] != MAGIC):
+            self.close()
+            raise ValueError("{0} is not a columnar report".format(path))
+        footer_length, = _FOOTER_LENGTH.unpack_from(self._map, size - tail)
+        footer_start = size - tail - footer_length
+        return json.loads(self._map[footer_start:size - tail].decode("utf-8"))
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, name):
+        """
+        Return the values of a column.
+
+        int, float and bool columns are returned as memoryviews
+        of 8 byte integers, 8 byte floats and bytes.
+        str and list columns are returned as read only sequences
+        that decode their values when they are looked at.
+        """
+        column = self._columns[name]
+        kind = column["kind"]
+        blocks = [self._view[offset:offset + length]
+                  for offset, length in column["blocks"]]
+        if kind == "int":
+            return blocks[0].cast("q")
+        if kind == "float":
+            return blocks[0].cast("d")
+        if kind == "bool":
+            return blocks[0]
+        if kind == "list":
+            return ListColumn(blocks[0].cast("Q"),
+                              StringColumn(blocks[1].cast("Q"), blocks[2]))
+        return StringColumn(blocks[0].cast("Q"), blocks[1])
+
+    def iter_rows(self):
+        """
+        Yield each row as a dictionary of column name to value.
+        """
+        columns = [(name, self.column(name)) for name in self.column_names]
+        for index in range(self.num_rows):
+            row = {}
+            for name, values in columns:
+                value = values[index]
+                if self._columns[name]["kind"] == "bool":
+                    value = bool(value)
+                row[name] = value
+            yield row
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StringColumn(Sequence):
+    """
+    A read only view of a str column.
+    """
+    def __init__(self, offsets, buffer):
+        self._offsets = offsets
+        self._buffer = buffer
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("column index out of range")
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return str(self._buffer[start:end], "utf-8")
+
+
+class ListColumn(Sequence):
+    """
+    A read only view of a list column.
+    """
+    def __init__(self, offsets, items):
+        self._offsets = offsets
+        self._items = items
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("column index out of range")
+        return self._items[self._offsets[index]:self._offsets[index + 1]]
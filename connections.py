@@ -0,0 +1,310 @@
+"""
+The connection layer used by SiteRetriever's session.
+
+requests doesn't say how long it spent opening connections,
+so the connection classes here time their own connect() calls.
+The time is added up per thread,
+which lets the retriever separate connect time from the rest of a fetch.
+
+Connections can also look their hosts up in a shared DNSCache,
+and a ConnectionWarmer can open connections to the next sites
+ahead of time, so that neither the lookup nor the connect
+is in the way when a site is fetched.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import socket
+import threading
+import time
+
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from cacheutils import HitCounter
+
+
+_connect_times = threading.local()
+
+
+def reset_connect_time():
+    """
+    Start counting connect time over for the current thread.
+    """
+    _connect_times.total = 0.0
+
+
+def get_connect_time():
+    """
+    Return the seconds the current thread has spent opening connections
+    since reset_connect_time() was last called.
+    """
+    return getattr(_connect_times, "total", 0.0)
+
+
+def _add_connect_time(seconds):
+    _connect_times.total = get_connect_time() + seconds
+
+
+class DNSCache(HitCounter):
+    """
+    Caches the addresses that host names resolve to.
+
+    ttl: the seconds an address is kept before the host is looked up again.
+    max_entries: the most hosts kept. The oldest are dropped first.
+
+    The system resolver doesn't say how long an answer may be kept,
+    so every answer is kept for ttl.
+    A host whose address can't be connected to is forgotten,
+    so it is looked up again next time.
+    """
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        Return an address to connect to for host.
+
+        Raises socket.gaierror if the host can't be resolved.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._addresses.get(host)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # The lookup is made without the lock,
+        # so a slow host doesn't hold up the others.
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+        with self._lock:
+            self._addresses.pop(host, None)
+            self._addresses[host] = (address, now + self.ttl)
+            while len(self._addresses) > self.max_entries:
+                del self._addresses[next(iter(self._addresses))]
+        return address
+
+    def forget(self, host):
+        """
+        Drop the cached address of host.
+        """
+        with self._lock:
+            self._addresses.pop(host, None)
+
+
+
+def _connect(connection, connect):
+    """
+    Open a connection with connect(), timing it
+    and looking its host up in the connection's DNS cache, if it has one.
+    """
+    start = time.perf_counter()
+    try:
+        if connection.dns_cache is None:
+            connect()
+            return
+        # urllib3 connects to _dns_host, while TLS is still checked
+        # against the host name, so the cached address can be put there.
+        connection._dns_host = connection.dns_cache.resolve(connection.host,
+                                                            connection.port)
+        try:
+            connect()
+        except OSError:
+            connection.dns_cache.forget(connection.host)
+            raise
+    finally:
+        _add_connect_time(time.perf_counter() - start)
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """
+    An HTTP connection that records how long it takes to connect.
+
+    dns_cache: an optional DNSCache to look the host up in.
+    """
+    def __init__(self, *args, dns_cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dns_cache = dns_cache
+
+    def connect(self):
+        _connect(self, super().connect)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """
+    An HTTPS connection that records how long it takes to connect,
+    including the TLS handshake.
+
+    dns_cache: an optional DNSCache to look the host up in.
+    """
+    def __init__(self, *args, dns_cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dns_cache = dns_cache
+
+    def connect(self):
+        _connect(self, super().connect)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    A transport adapter whose connections record their connect time.
+
+    dns_cache: an optional DNSCache shared by all of the connections.
+    """
+    __attrs__ = requests.adapters.HTTPAdapter.__attrs__ + ["dns_cache"]
+
+    def __init__(self, *args, dns_cache=None, **kwargs):
+        # Set first, since the base class builds the pool manager.
+        self.dns_cache = dns_cache
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # Pools pass their extra keyword arguments on to their connections.
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": partial(TimedHTTPConnectionPool, dns_cache=self.dns_cache),
+            "https": partial(TimedHTTPSConnectionPool,
+                             dns_cache=self.dns_cache)}
+
+
+def build_session(pool_size, num_pools=None, dns_cache=None):
+    """
+    Return a session whose connection pools can serve
+    pool_size concurrent requests and whose connections are timed.
+
+    num_pools: the number of hosts to keep connections to.
+    Defaults to pool_size.
+    dns_cache: an optional DNSCache for the connections to share.
+    """
+    if num_pools is None:
+        num_pools = pool_size
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=num_pools,
+                               pool_maxsize=pool_size, dns_cache=dns_cache)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def open_connection(session, url, timeout=None):
+    """
+    Open a connection to url's host in session's connection pool,
+    so that the next request to it doesn't have to.
+
+    timeout: the seconds to allow for connecting.
+    Raises OSError if the host can't be reached.
+    Needs requests 2.32.2 or later, for get_connection_with_tls_context.
+    """
+    adapter = session.get_adapter(url)
+    # The pool is found the way the session finds it for a request,
+    # since pools are keyed by TLS settings as well as by host.
+    request = session.prepare_request(requests.Request("GET", url))
+    settings = session.merge_environment_settings(url, {}, None, None, None)
+    pool = adapter.get_connection_with_tls_context(
+        request, settings["verify"], proxies=settings["proxies"],
+        cert=settings["cert"])
+    connection = pool._get_conn()
+    try:
+        if not connection.is_connected:
+            connection.timeout = timeout
+            connection.connect()
+    except OSError:
+        connection.close()
+        raise
+    finally:
+        pool._put_conn(connection)
+
+
+class ConnectionWarmer:
+    """
+    Opens connections to upcoming urls in the background.
+
+    session: the session whose connection pools the connections are put in.
+    ahead: the most urls connected to ahead of their requests.
+    The session should keep connections to that many more hosts
+    than it has requests in flight, or warm connections are dropped.
+    workers: the number of threads opening connections.
+    timeout: the seconds to allow for each connection.
+
+    Urls are added in the order they will be requested,
+    and each one is marked started when its request begins.
+    Urls started before they were warmed are skipped.
+    A url can be added under a key, such as its site,
+    and marked started by that key,
+    for when the caller doesn't know which url it will request first.
+    Connections that fail are left for the request to report.
+    """
+    def __init__(self, session, ahead, workers=4, timeout=None):
+        self.session = session
+        self.ahead = ahead
+        self.timeout = timeout
+        self.warmed = 0
+        self.failed = 0
+        self._upcoming = deque()
+        self._warming = set()
+        self._skip = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def add(self, url, key=None):
+        """
+        Queue a url to be connected to.
+
+        key: the key the url is marked started by. Defaults to the url.
+        """
+        with self._lock:
+            self._upcoming.append((url if key is None else key, url))
+            self._fill()
+
+    def started(self, key):
+        """
+        Mark the request of a url or key begun,
+        making room to warm another.
+        """
+        with self._lock:
+            if key in self._warming:
+                self._warming.discard(key)
+            else:
+                self._skip.add(key)
+            self._fill()
+
+    def close(self):
+        """
+        Stop warming, dropping the urls not yet connected to.
+        """
+        with self._lock:
+            self._upcoming.clear()
+        self._executor.shutdown(wait=True)
+
+    def _fill(self):
+        while self._upcoming and len(self._warming) < self.ahead:
+            key, url = self._upcoming.popleft()
+            if key in self._skip:
+                self._skip.discard(key)
+                continue
+            self._warming.add(key)
+            self._executor.submit(self._warm, url)
+
+    def _warm(self, url):
+        try:
+            open_connection(self.session, url, self.timeout)
+        except (OSError, ValueError):
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                self.warmed += 1
@@ -0,0 +1,173 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class CrawlStore:
+    """
+    SQLite store for the site dictionaries of each crawl run.
+
+    path: the path of the database file.
+    batch_size: the number of sites written in each transaction.
+
+    Sites are buffered as they complete
+    and written in batches, each in a single transaction.
+    Call flush() to write whatever is buffered.
+    """
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        # Other processes may be writing to the same database,
+        # so wait a while for their transactions rather than failing.
+        self._connection = sqlite3.connect(path, timeout=30,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_id TEXT PRIMARY KEY, started_at REAL NOT NULL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sites ("
+                "run_id TEXT NOT NULL, rank INTEGER NOT NULL, "
+                "site_name TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (run_id, site_name))")
+
+    def start_run(self, run_id=None):
+        """
+        Return the id of a run, creating the run if it doesn't exist.
+
+        run_id: the id of an earlier run to continue.
+        If none is given, a new run is started.
+        """
+        if run_id is None:
+            run_id = uuid.uuid4().hex
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO runs (run_id, started_at) VALUES (?, ?)",
+                (run_id, time.time()))
+        return run_id
+
+    def get_runs(self):
+        """
+        Return a list of run ids, oldest first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT run_id FROM runs ORDER BY started_at").fetchall()
+        return [run_id for run_id, in rows]
+
+    def add_site(self, run_id, rank, site_dict):
+        """
+        Buffer a site dictionary, writing the buffer once it is full.
+
+        run_id: the id of the run the site belongs to.
+        rank: the site's position in the listings, starting at 1.
+        site_dict: a dict representing the data gathered from a site.
+        """
+        row = (run_id, rank, site_dict["site_name"], json.dumps(site_dict))
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._write_pending()
+
+    def flush(self):
+        """
+        Write any buffered sites.
+        """
+        with self._lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO sites (run_id, rank, site_name, data) "
+                "VALUES (?, ?, ?, ?)", self._pending)
+        self._pending = []
+
+    def get_site_dicts(self, run_id):
+        """
+        Return a dictionary of site name to site dictionary
+        for every site stored for a run.
+        """
+        return {site_dict["site_name"]: site_dict
+                for site_dict in self.sites(run_id)}
+
+    def get_site_names(self, run_id):
+        """
+        Return the set of the names of the sites stored for a run.
+        """
+        self.flush()
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT site_name FROM sites WHERE run_id = ?",
+                (run_id,)).fetchall()
+        return set(site_name for site_name, in rows)
+
+    def get_site_dict(self, run_id, site_name):
+        """
+        Return the site dictionary stored for a site in a run,
+        or None if there isn't one.
+        """
+        with self._lock:
+            self._write_pending()
+            row = self._connection.execute(
+                "SELECT data FROM sites WHERE run_id = ? AND site_name = ?",
+                (run_id, site_name)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def sites(self, run_id):
+        """
+        Return the sites stored for a run, in ranking order.
+
+        The result can be passed to the report builders as their data.
+        Rows are read through a cursor each time it is iterated,
+        rather than loaded into a list.
+        """
+        return StoredSites(self, run_id)
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StoredSites:
+    """
+    An iterable over the site dictionaries of one run of a CrawlStore.
+    """
+    def __init__(self, store, run_id):
+        self.store = store
+        self.run_id = run_id
+
+    def __iter__(self):
+        self.store.flush()
+        # A separate connection so the cursor isn't disturbed by writes.
+        connection = sqlite3.connect(self.store.path)
+        try:
+            cursor = connection.execute(
+                "SELECT data FROM sites WHERE run_id = ? ORDER BY rank",
+                (self.run_id,))
+            for data, in cursor:
+                yield json.loads(data)
+        finally:
+            connection.close()
+
+    def __len__(self):
+        self.store.flush()
+        with self.store._lock:
+            count, = self.store._connection.execute(
+                "SELECT COUNT(*) FROM sites WHERE run_id = ?",
+                (self.run_id,)).fetchone()
+        return count
@@ -0,0 +1,145 @@
+"""
+A persistent cache of where each site is really served from.
+
+A listing such as example.com is fetched from http://example.com,
+falling back to http://www.example.com, and the server usually
+redirects from there to its canonical https url.
+EndpointCache remembers the url each site ended up at,
+so the next crawl requests it directly,
+and counts the round trips that saves.
+"""
+import json
+import threading
+import time
+
+from cacheutils import HitCounter, write_json
+
+
+class EndpointCache(HitCounter):
+    """
+    On-disk cache of the final url of each site.
+
+    path: the JSON file the entries are kept in.
+    max_age: the number of seconds after which an entry is stale.
+    Stale entries are still used, but should be refreshed.
+
+    Each entry holds the site's final url,
+    the number of round trips it took to reach it
+    and when it was learned.
+    An entry whose url fails is dropped, so the site is resolved again.
+    Several processes may share the file:
+    each one saves only the entries it learned or dropped.
+    """
+    def __init__(self, path, max_age=7 * 24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.refreshes = 0
+        self.round_trips_saved = 0
+        self._entries = self._load()
+        self._changed = set()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def lookup(self, site):
+        """
+        Return the url learned for a site, or None if there isn't one.
+
+        site: a url without a protocol.
+        """
+        with self._lock:
+            entry = self._entries.get(site)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["url"]
+
+    def peek(self, site):
+        """
+        Return the url learned for a site, or None if there isn't one,
+        without counting it as a lookup.
+
+        site: a url without a protocol.
+        """
+        with self._lock:
+            entry = self._entries.get(site)
+        return None if entry is None else entry["url"]
+
+    def learn(self, site, url, round_trips):
+        """
+        Record the url a site was found at.
+
+        round_trips: the number of requests it took to get there,
+        counting fallbacks and redirects.
+        """
+        with self._lock:
+            if site in self._entries:
+                self.refreshes += 1
+            self._entries[site] = {"url": url, "round_trips": round_trips,
+                                   "learned_at": time.time()}
+            self._changed.add(site)
+            self._refreshing.discard(site)
+
+    def record_success(self, site):
+        """
+        Count the round trips saved by fetching a site from its learned url.
+        """
+        with self._lock:
+            entry = self._entries.get(site)
+            if entry is not None:
+                self.round_trips_saved += entry["round_trips"] - 1
+
+    def record_failure(self, site):
+        """
+        Drop the entry of a site whose learned url failed.
+        """
+        with self._lock:
+            self.failures += 1
+            self._entries.pop(site, None)
+            self._changed.add(site)
+            self._refreshing.discard(site)
+
+    def claim_refresh(self, site):
+        """
+        Return True if a site's entry is stale
+        and no one else is refreshing it yet.
+
+        The caller should refresh it, by learning it again.
+        """
+        with self._lock:
+            entry = self._entries.get(site)
+            if (entry is None or site in self._refreshing or
+                    time.time() - entry["learned_at"] < self.max_age):
+                return False
+            self._refreshing.add(site)
+            return True
+
+    def _get_stats(self):
+        stats = super()._get_stats()
+        stats.update({"failures": self.failures, "refreshes": self.refreshes,
+                      "round_trips_saved": self.round_trips_saved})
+        return stats
+
+    def save(self):
+        """
+        Write the entries learned or dropped to the cache file,
+        keeping the ones other processes saved there meanwhile.
+        """
+        entries = self._load()
+        with self._lock:
+            for site in self._changed:
+                if site in self._entries:
+                    entries[site] = self._entries[site]
+                else:
+                    entries.pop(site, None)
+        write_json(self.path, entries)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
@@ -0,0 +1,117 @@
+"""
+An on-disk cache of rendered report rows.
+
+Reports are rebuilt from data that mostly hasn't changed since the last
+build. FragmentCache keeps the chunk each row rendered to, keyed by a hash
+of the row's ranking and category values, so the next build only renders
+rows that were added, changed or moved, and copies the rest.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from cacheutils import HitCounter, write_json
+
+
+class FragmentCache(HitCounter):
+    """
+    On-disk cache of the row fragments of reports.
+
+    path: the directory the fragments are stored in.
+    Each report's fragments are kept in a file of their own.
+
+    Only the fragments used by the latest build of a report are kept,
+    so rows that have gone from the data don't pile up.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def open(self, report_name):
+        """
+        Return the ReportFragments of a report,
+        ready to be used for a new build.
+
+        report_name: a name that identifies the report and its format,
+        e.g. its filename.
+        """
+        return ReportFragments(self, report_name, self._load(report_name))
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _get_filepath(self, report_name):
+        name = hashlib.sha1(report_name.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, name + ".json")
+
+    def _load(self, report_name):
+        """
+        Return the fragments saved for a report, keyed by row hash.
+        """
+        try:
+            with open(self._get_filepath(report_name)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, report_name, fragments):
+        """
+        Write the fragments of a report.
+        """
+        write_json(self._get_filepath(report_name), fragments)
+
+
+class ReportFragments:
+    """
+    The row fragments of one build of a report.
+
+    Fragments from the previous build are reused,
+    and the fragments used by this build are saved by save().
+    """
+    def __init__(self, cache, report_name, previous):
+        self.cache = cache
+        self.report_name = report_name
+        self.hits = 0
+        self.misses = 0
+        self._previous = previous
+        self._current = {}
+
+    def render_row(self, index, values, render):
+        """
+        Return the fragment of a row,
+        calling render() for it only if it isn't cached.
+
+        index: the ranking of the row.
+        values: the row's category values. They must be JSON serializable,
+        or convertible with str().
+        render: a function of no arguments that renders the row.
+        """
+        key = self._get_key(index, values)
+        fragment = self._current.get(key)
+        if fragment is None:
+            fragment = self._previous.get(key)
+        if fragment is None:
+            fragment = render()
+            self.misses += 1
+        else:
+            self.hits += 1
+        self._current[key] = fragment
+        return fragment
+
+    def save(self):
+        """
+        Save the fragments used by this build, in place of the previous ones.
+        """
+        self.cache._save(self.report_name, self._current)
+        self.cache._count(self.hits, self.misses)
+
+    @staticmethod
+    def _get_key(index, values):
+        row = json.dumps([index, values], default=str, separators=(",", ":"))
+        return hashlib.sha1(row.encode("utf-8")).hexdigest()
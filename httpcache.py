@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from cacheutils import HitCounter, write_json
+
+
+class ResponseCache(HitCounter):
+    """
+    On-disk cache of the data derived from site fetches.
+
+    Each site gets one entry holding the validators from its last response
+    (ETag and Last-Modified) and the data derived from it:
+    header names, cookie names and word count.
+
+    path: the directory the entries are stored in.
+    max_age: the number of seconds an entry is kept after it was validated.
+    max_size: the total number of bytes the entries may take up.
+    max_body_size: bodies up to this many bytes are fingerprinted,
+    so an unchanged body can be recognized even without validators.
+    """
+    def __init__(self, path, max_age=7 * 24 * 60 * 60,
+                 max_size=50 * 1024 * 1024, max_body_size=1024 * 1024):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.max_body_size = max_body_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def conditional_headers(self, site):
+        """
+        Return the request headers that ask the server
+        to reply 304 Not Modified if the site has not changed.
+
+        site: a url without a protocol.
+        """
+        entry = self._load(site)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get_data(self, site, page, body=None):
+        """
+        Return cached (headers, cookies, word_count) for the page,
+        or None if the page has to be parsed.
+
+        site: a url without a protocol.
+        page: a response object from the site.
+        body: an optional wordcounter.CappedBody the page's body is read through.
+
+        A 304 response reuses all of the cached data.
+        An unchanged body reuses the cached word count
+        along with the headers and cookies of the new response.
+        To tell, up to max_body_size bytes of the body are read ahead
+        and fingerprinted before anything parses it;
+        a changed body is then parsed from what was read.
+        """
+        entry = self._load(site)
+        data = None
+        if entry is not None:
+            if page.status_code == 304:
+                data = (entry["headers"], entry["cookies"],
+                        entry["word_count"])
+                self._touch(site, entry, page)
+            elif (entry["body_digest"] is not None
+                    and entry["body_digest"] == self._get_body_digest(page,
+                                                                      body)):
+                data = (list(page.headers.keys()), page.cookies.keys(),
+                        entry["word_count"])
+                self.store(site, page, data, body)
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def store(self, site, page, data, body=None):
+        """
+        Save the validators of page and the data derived from it.
+
+        site: a url without a protocol.
+        page: a response object from the site.
+        data: a (headers, cookies, word_count) tuple.
+        body: an optional wordcounter.CappedBody the page's body was read through.
+        """
+        headers, cookies, word_count = data
+        entry = {"site": site,
+                 "validated_at": time.time(),
+                 "etag": page.headers.get("ETag"),
+                 "last_modified": page.headers.get("Last-Modified"),
+                 "body_digest": self._get_body_digest(page, body),
+                 "headers": headers,
+                 "cookies": cookies,
+                 "word_count": word_count}
+        self._save(site, entry)
+
+    def evict(self):
+        """
+        Remove entries older than max_age,
+        then the least recently validated entries
+        until the cache fits in max_size.
+        """
+        now = time.time()
+        entries = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith(".json"):
+                continue
+            filepath = os.path.join(self.path, filename)
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filepath))
+
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for validated_at, size, filepath in entries:
+            if now - validated_at <= self.max_age and total_size <= self.max_size:
+                break
+            self._remove(filepath)
+            total_size -= size
+
+    def _touch(self, site, entry, page):
+        """
+        Record that an entry was validated by a 304 response.
+
+        The server may send new validators along with the 304.
+        """
+        entry["validated_at"] = time.time()
+        entry["etag"] = page.headers.get("ETag", entry["etag"])
+        entry["last_modified"] = page.headers.get("Last-Modified",
+                                                  entry["last_modified"])
+        self._save(site, entry)
+
+    def _get_body_digest(self, page, body=None):
+        """
+        Return a fingerprint of the page body,
+        or None if the body is larger than max_body_size
+        or was cut off by body's cap.
+
+        body: an optional CappedBody the page's body is read through.
+        Its digest is taken as it streams,
+        and a body that hasn't been read is read ahead up to max_body_size,
+        so a larger body is never held to fingerprint it.
+        """
+        content_length = page.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit():
+            if int(content_length) > self.max_body_size:
+                return None
+        if body is None:
+            content = page.content
+            if len(content) > self.max_body_size:
+                return None
+            return hashlib.sha1(content).hexdigest()
+        if not body.prefetch(self.max_body_size):
+            return None
+        if body.size > self.max_body_size or body.truncated:
+            return None
+        return body.hexdigest()
+
+    def _get_filepath(self, site):
+        name = hashlib.sha1(site.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, name + ".json")
+
+    def _load(self, site):
+        """
+        Return the entry for a site, or None if there isn't one.
+        """
+        try:
+            with open(self._get_filepath(site)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save(self, site, entry):
+        """
+        Write an entry for a site.
+        """
+        write_json(self._get_filepath(site), entry)
+
+    @staticmethod
+    def _remove(filepath):
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,195 @@
+"""
+Per-site phase timings for SiteRetriever.
+
+Each site's fetch is split into phases:
+connect: opening connections, including TLS handshakes.
+first_byte: from sending the request to receiving the response headers,
+including any connecting, redirects and retries.
+download: reading the response body.
+parse: deriving the site data from the response.
+total: the whole of the above.
+
+The timings are recorded in latency histograms
+alongside counters for errors and retries,
+and can be exported as JSON or in the Prometheus text format.
+"""
+from collections import Counter
+import json
+import threading
+
+
+PHASES = ("connect", "first_byte", "download", "parse", "total")
+
+# The site dictionary key each phase's time is stored under.
+PHASE_COLUMNS = {"connect": "connect_time",
+                 "first_byte": "first_byte_time",
+                 "download": "download_time",
+                 "parse": "parse_time",
+                 "total": "time_to_complete"}
+
+
+class Histogram:
+    """
+    A latency histogram with fixed bucket boundaries, in seconds.
+
+    buckets: the upper bounds of the buckets, in increasing order.
+    Values above the last bound are counted in an overflow bucket.
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, quantile):
+        """
+        Return an estimate of a quantile,
+        interpolated within the bucket it falls in,
+        or None if nothing has been observed.
+
+        Values in the overflow bucket are estimated as the last bound.
+        """
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        seen = 0
+        lower = 0.0
+        for i, bucket_count in enumerate(self.counts):
+            if i == len(self.buckets):
+                return self.buckets[-1]
+            upper = self.buckets[i]
+            if bucket_count and seen + bucket_count >= rank:
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+
+    def to_dict(self):
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), self.counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return {"count": self.count,
+                "sum": self.sum,
+                "buckets": cumulative,
+                "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99)}
+
+
+class Instrumentation:
+    """
+    Collects per-site phase timings, errors and retries.
+
+    verbose: if True, each site's timings are printed as it completes.
+    buckets: the histogram bucket bounds, in seconds.
+    """
+    def __init__(self, verbose=False, buckets=Histogram.DEFAULT_BUCKETS):
+        self.verbose = verbose
+        self.histograms = {phase: Histogram(buckets) for phase in PHASES}
+        self.errors = Counter()
+        self.retries = 0
+        self.sites = 0
+        self._lock = threading.Lock()
+
+    def record_site(self, site, timings):
+        """
+        Record the phase timings of a completed site.
+
+        site: a url without a protocol.
+        timings: a dictionary of phase name to seconds.
+        """
+        with self._lock:
+            self.sites += 1
+            for phase, seconds in timings.items():
+                self.histograms[phase].observe(seconds)
+        if self.verbose:
+            print("{0} data retrieval time: {1}".format(site, timings["total"]))
+
+    def record_error(self, site, error):
+        """
+        Count a site that could not be retrieved.
+
+        error: the exception raised while retrieving it.
+        """
+        with self._lock:
+            self.errors[type(error).__name__] += 1
+
+    def record_retry(self, site):
+        """
+        Count a retried request.
+        """
+        with self._lock:
+            self.retries += 1
+
+    def to_dict(self):
+        """
+        Return the collected metrics as a dictionary.
+        """
+        with self._lock:
+            return {"sites": self.sites,
+                    "errors": dict(self.errors),
+                    "retries": self.retries,
+                    "phases": {phase: histogram.to_dict()
+                               for phase, histogram in self.histograms.items()}}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix="siteretriever"):
+        """
+        Return the collected metrics in the Prometheus text format.
+        """
+        metrics = self.to_dict()
+        lines = [
+            "# HELP {0}_sites_total Sites retrieved.".format(prefix),
+            "# TYPE {0}_sites_total counter".format(prefix),
+            "{0}_sites_total {1}".format(prefix, metrics["sites"]),
+            "# HELP {0}_errors_total Sites that could not be retrieved."
+            .format(prefix),
+            "# TYPE {0}_errors_total counter".format(prefix)]
+        for error, count in sorted(metrics["errors"].items()):
+            lines.append('{0}_errors_total{{error="{1}"}} {2}'.format(
+                                                        prefix, error, count))
+        lines.extend([
+            "# HELP {0}_retries_total Retried requests.".format(prefix),
+            "# TYPE {0}_retries_total counter".format(prefix),
+            "{0}_retries_total {1}".format(prefix, metrics["retries"]),
+            "# HELP {0}_phase_seconds Time spent in each phase of a fetch."
+            .format(prefix),
+            "# TYPE {0}_phase_seconds histogram".format(prefix)])
+        for phase in PHASES:
+            histogram = metrics["phases"][phase]
+            for bound, count in histogram["buckets"]:
+                lines.append(
+                    '{0}_phase_seconds_bucket{{phase="{1}",le="{2}"}} {3}'
+                    .format(prefix, phase, bound, count))
+            lines.append('{0}_phase_seconds_sum{{phase="{1}"}} {2}'.format(
+                                            prefix, phase, histogram["sum"]))
+            lines.append('{0}_phase_seconds_count{{phase="{1}"}} {2}'.format(
+                                            prefix, phase, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_json())
+
+    def write_prometheus(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_prometheus())
@@ -1,40 +1,460 @@
-from siteretriever import ListingsRetriever, SiteRetriever
-from reportbuilder import (WordCountReportBuilder, HeaderReportBuilder,
-                           PerformanceReportBuilder, ReportBuilder,
-                           CustomRowReportBuilder)
-from timer import timethis
+"""
+Crawl the top sites on Alexa and build reports from the crawl.
 
-def gather_alexa_data(name, password):
+Usage:
+python main.py crawl <email> <password>
+python main.py report
+python main.py crawl-and-report <email> <password>
+python main.py <email> <password>  (the same as crawl-and-report)
+python main.py work --run-id <run id>
+
+crawl saves each site to a CrawlStore snapshot (crawl.db by default),
+and report builds the reports from the latest run in it.
+With --worker-processes, crawl shares the sites between worker processes
+through a work queue in the snapshot,
+and work joins more workers to a run that is under way.
+With --stream, crawl-and-report passes each site on to the reports
+as soon as it is retrieved, so the reports fill in while the crawl runs
+and the crawl is never held in memory;
+only the counts of header and cookie names are kept.
+`python main.py <command> --help` lists each command's options.
+
+Modules are imported by the functions that use them,
+so report doesn't load requests, BeautifulSoup or the retrievers.
+"""
+import argparse
+import os
+import sys
+
+
+COMMANDS = ("crawl", "report", "crawl-and-report", "work")
+REPORTS = ("word-count", "header", "performance")
+DEFAULT_STORE = "crawl.db"
+STREAM_FLUSH_EVERY = 10
+
+
+def get_default_builders(reports=REPORTS):
+    """
+    Return the report builder classes built from the site data by default.
+
+    reports: the names of the reports to build, from REPORTS.
+    """
+    from reportbuilder import (WordCountReportBuilder, HeaderReportBuilder,
+                               PerformanceReportBuilder)
+    builders = {"word-count": WordCountReportBuilder,
+                "header": HeaderReportBuilder,
+                "performance": PerformanceReportBuilder}
+    return [builders[report] for report in reports]
+
+def get_crawl_fields(builders):
+    """
+    Return the set of site dictionary keys read by the builders' reports,
+    so that the crawl only fetches what they need.
+
+    builders: a list of report builder classes.
+    They are made without any data to ask them.
+    """
+    from reportbuilder import get_required_fields
+    return get_required_fields([Builder([]) for Builder in builders])
+
+def gather_alexa_data(name, password, max_workers=10, cache_dir=None,
+                      store_path=None, run_id=None, index=None,
+                      instrumentation=None, prewarm=0,
+                      endpoint_cache_path=None, fields=None):
     """
     Retrieve data for the top 100 sites on Alexa.
 
     Data includes word count, headers, cookies and the time it took
     to gather the data.
+
+    max_workers: the number of sites to retrieve concurrently.
+    cache_dir: an optional directory for caching responses between runs.
+    store_path: an optional SQLite database to save each site to.
+    run_id: the id of a stored run to resume.
+    index: an optional NameIndex to index header and cookie names in.
+    instrumentation: an optional Instrumentation to record timings in.
+    prewarm: the number of sites ahead to connect to in the background.
+    endpoint_cache_path: an optional file for remembering
+    the url each site was found at between runs.
+    fields: an optional set of the site dictionary keys that are needed.
+    Defaults to every key.
     """
+    from siteretriever import ListingsRetriever, SiteRetriever
     l = ListingsRetriever(name, password)
     listings = l.get_listings()
-    s = SiteRetriever()
+    cache = None
+    if cache_dir is not None:
+        from httpcache import ResponseCache
+        cache = ResponseCache(cache_dir)
+    endpoint_cache = None
+    if endpoint_cache_path is not None:
+        from endpointcache import EndpointCache
+        endpoint_cache = EndpointCache(endpoint_cache_path)
+    store = None
+    if store_path is not None:
+        from crawlstore import CrawlStore
+        store = CrawlStore(store_path)
+    s = SiteRetriever(max_workers=max_workers, cache=cache, store=store,
+                      run_id=run_id, index=index,
+                      instrumentation=instrumentation, prewarm=prewarm,
+                      endpoint_cache=endpoint_cache, fields=fields)
     alexa_sites_data = s.build_sites_list(listings)
     return alexa_sites_data
 
-def build_reports(alexa_sites_data, builders, file_format):
+def load_crawl(store_path, run_id=None):
+    """
+    Return the sites of a stored crawl, in ranking order.
+
+    store_path: the SQLite database the crawl was saved to.
+    run_id: the id of the run to load. Defaults to the latest run.
+
+    Raises ValueError if there is no such crawl.
+    A missing database is reported rather than created.
+    """
+    from crawlstore import CrawlStore
+    if not os.path.exists(store_path):
+        raise ValueError("no crawl has been saved to {0}".format(store_path))
+    store = CrawlStore(store_path)
+    runs = store.get_runs()
+    if run_id is None:
+        if not runs:
+            raise ValueError("{0} has no stored crawls".format(store_path))
+        run_id = runs[-1]
+    elif run_id not in runs:
+        raise ValueError("{0} has no run {1}".format(store_path, run_id))
+    return store.sites(run_id)
+
+def build_reports(alexa_sites_data, builders, file_format, processes=None,
+                  fragment_cache_dir=None):
     """
     Creates a new report from each of the passed report builders.
+
+    The reports are rendered together in one pass over the data.
+    processes: an optional number of processes to spread the builders over.
+    fragment_cache_dir: an optional directory for caching rendered rows
+    between builds, so that only changed rows are rendered.
+    """
+    from reportengine import ReportEngine
+    report_builders = [Builder(alexa_sites_data) for Builder in builders]
+    fragment_cache = None
+    if fragment_cache_dir is not None:
+        from fragmentcache import FragmentCache
+        fragment_cache = FragmentCache(fragment_cache_dir)
+    engine = ReportEngine(report_builders, processes=processes,
+                          fragment_cache=fragment_cache)
+    engine.create_reports(alexa_sites_data, file_format)
+    if fragment_cache is not None:
+        print("Report rows: {hits} reused, {misses} rendered.".format(
+                                                    **fragment_cache.stats()))
+
+def build_frequency_reports(index, file_format):
+    """
+    Creates a frequency report of header names and of cookie names.
     """
-    for Builder in builders:
-        report_builder = Builder(alexa_sites_data)
-        report_builder.create_report(file_format)
+    from nameindex import NameIndex
+    from reportbuilder import FrequencyReportBuilder
+    for kind in NameIndex.KINDS:
+        FrequencyReportBuilder(index, kind).create_report(file_format)
+
+def crawl(name, password, store_path=DEFAULT_STORE, run_id=None,
+          max_workers=10, cache_dir=None, metrics_path=None, prewarm=0,
+          endpoint_cache_path=None, fields=None):
+    """
+    Gather the Alexa data and save it to a CrawlStore snapshot.
+
+    Returns the sites and a NameIndex of their header and cookie names.
+
+    metrics_path: an optional path to write the retrieval timings to,
+    as JSON.
+    fields: an optional set of the site dictionary keys that are needed.
+    Defaults to every key, since any report may be built from the crawl.
+    """
+    from instrumentation import Instrumentation
+    from nameindex import NameIndex
+    index = NameIndex()
+    instrumentation = Instrumentation(verbose=True)
+    alexa_data = gather_alexa_data(name, password, max_workers=max_workers,
+                                   cache_dir=cache_dir, store_path=store_path,
+                                   run_id=run_id, index=index,
+                                   instrumentation=instrumentation,
+                                   prewarm=prewarm,
+                                   endpoint_cache_path=endpoint_cache_path,
+                                   fields=fields)
+    if metrics_path is not None:
+        instrumentation.write_json(metrics_path)
+    return alexa_data, index
+
+def crawl_sharded(name, password, worker_processes, store_path=DEFAULT_STORE,
+                  run_id=None, max_workers=10, batch_size=25, fields=None,
+                  cache_dir=None, prewarm=0, endpoint_cache_path=None):
+    """
+    Gather the Alexa data with several worker processes
+    and save it to a CrawlStore snapshot.
+
+    The listings are put in a workqueue.WorkQueue in the snapshot,
+    and each worker leases batches of batch_size sites from it.
+    Returns the id of the run.
 
-def main(name, password, builders, file_format):
-    alexa_data = gather_alexa_data(name, password)
-    build_reports(alexa_data, builders, file_format)
+    worker_processes: the number of worker processes to start.
+    Workers started elsewhere with `main.py work` share the run too.
+    max_workers: the number of sites each worker retrieves concurrently.
+    fields: an optional set of the site dictionary keys that are needed.
+    cache_dir, prewarm and endpoint_cache_path are passed on to each worker,
+    and the workers share the caches.
+
+    Once the worker processes are done,
+    this process crawls whatever workers elsewhere leave unfinished.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from siteretriever import ListingsRetriever
+    from workqueue import CrawlCoordinator, run_worker
+    listings = ListingsRetriever(name, password).get_listings()
+    with CrawlCoordinator(store_path) as coordinator:
+        run_id = coordinator.start(listings, run_id)
+        print("Crawling run {0} with {1} worker processes...".format(
+                                                    run_id, worker_processes))
+        worker_options = {"batch_size": batch_size,
+                          "max_workers": max_workers, "fields": fields,
+                          "cache_dir": cache_dir, "prewarm": prewarm,
+                          "endpoint_cache_path": endpoint_cache_path}
+        with ProcessPoolExecutor(max_workers=worker_processes) as executor:
+            futures = [executor.submit(run_worker, store_path, run_id,
+                                       **worker_options)
+                       for _ in range(worker_processes)]
+            for future in futures:
+                future.result()
+        # Workers elsewhere may still hold leases,
+        # and the sites of any that die are crawled here.
+        coordinator.drain(run_id, **worker_options)
+        print("Run {0}: {done} sites done, {failed} failed.".format(
+                                    run_id, **coordinator.progress(run_id)))
+    return run_id
+
+def report(builders, file_format, store_path=DEFAULT_STORE, run_id=None,
+           processes=None, fragment_cache_dir=None):
+    """
+    Build the reports from a stored crawl, without crawling.
+
+    run_id: the id of the run to report on. Defaults to the latest run.
+    """
+    from nameindex import NameIndex
+    alexa_data = load_crawl(store_path, run_id)
+    build_reports(alexa_data, builders, file_format, processes=processes,
+                  fragment_cache_dir=fragment_cache_dir)
+    build_frequency_reports(NameIndex.from_sites(alexa_data), file_format)
+
+def stream_reports(name, password, builders, file_format, store_path=None,
+                   run_id=None, max_workers=10, cache_dir=None,
+                   metrics_path=None, flush_every=STREAM_FLUSH_EVERY,
+                   prewarm=0, endpoint_cache_path=None):
+    """
+    Gather the Alexa data and build the reports from it as it arrives.
+
+    Listings, sites and report rows are passed along as iterators,
+    and only the counts of header and cookie names are kept
+    for the frequency reports,
+    so memory depends on the number of sites in flight
+    and of distinct names rather than the number crawled.
+    A resumed run keeps the names of the sites it already has.
+    The report files are flushed every flush_every rows.
+    Columnar reports are still held and written once the crawl is done.
+    Only what the builders' reports need is fetched.
+    """
+    from crawlstore import CrawlStore
+    from instrumentation import Instrumentation
+    from nameindex import NameCounts
+    from reportengine import ReportEngine
+    from siteretriever import ListingsRetriever, SiteRetriever
+    cache = None
+    if cache_dir is not None:
+        from httpcache import ResponseCache
+        cache = ResponseCache(cache_dir)
+    store = None
+    if store_path is not None:
+        store = CrawlStore(store_path)
+    endpoint_cache = None
+    if endpoint_cache_path is not None:
+        from endpointcache import EndpointCache
+        endpoint_cache = EndpointCache(endpoint_cache_path)
+    index = NameCounts()
+    instrumentation = Instrumentation(verbose=True)
+    retriever = SiteRetriever(max_workers=max_workers, cache=cache,
+                              store=store, run_id=run_id, index=index,
+                              instrumentation=instrumentation,
+                              prewarm=prewarm, endpoint_cache=endpoint_cache,
+                              fields=get_crawl_fields(builders))
+    listings = ListingsRetriever(name, password).iter_listings()
+    sites = retriever.iter_sites(listings)
+    report_builders = [Builder(sites) for Builder in builders]
+    engine = ReportEngine(report_builders, flush_every=flush_every)
+    engine.create_reports(sites, file_format)
+    if metrics_path is not None:
+        instrumentation.write_json(metrics_path)
+    build_frequency_reports(index, file_format)
+
+def main(name, password, builders, file_format, metrics_path=None,
+         store_path=None, processes=None, fragment_cache_dir=None,
+         **crawl_options):
+    """
+    Gather the Alexa data and build the reports.
+
+    metrics_path: an optional path to write the retrieval timings to,
+    as JSON.
+    store_path: an optional SQLite database to save each site to.
+    crawl_options: passed on to crawl().
+
+    Only what the builders' reports need is fetched,
+    so a crawl saved for a few reports may not do for the others.
+    """
+    alexa_data, index = crawl(name, password, store_path=store_path,
+                              metrics_path=metrics_path,
+                              fields=get_crawl_fields(builders),
+                              **crawl_options)
+    build_reports(alexa_data, builders, file_format, processes=processes,
+                  fragment_cache_dir=fragment_cache_dir)
+    build_frequency_reports(index, file_format)
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    def add_crawl_arguments(subparser):
+        subparser.add_argument("email")
+        subparser.add_argument("password")
+        subparser.add_argument("--max-workers", type=int, default=10)
+        subparser.add_argument("--cache-dir",
+                               help="cache responses between crawls here")
+        subparser.add_argument("--metrics",
+                               help="write the retrieval timings here as JSON")
+        subparser.add_argument("--worker-processes", type=int,
+                               help="share the crawl between this many "
+                                    "processes")
+        subparser.add_argument("--prewarm", type=int, default=0,
+                               help="connect to this many sites ahead "
+                                    "of the crawl")
+        subparser.add_argument("--endpoint-cache",
+                               help="remember where each site was found "
+                                    "in this file")
+
+    def add_report_arguments(subparser):
+        subparser.add_argument("--format", default="html",
+                               choices=["html", "csv", "jsonl", "columnar"])
+        subparser.add_argument("--reports", nargs="+", default=list(REPORTS),
+                               choices=REPORTS,
+                               help="the reports to build, "
+                                    "and so what the crawl fetches")
+        subparser.add_argument("--processes", type=int,
+                               help="spread the reports over this many "
+                                    "processes")
+        subparser.add_argument("--fragment-cache",
+                               help="cache rendered rows between builds here")
+
+    def add_stream_argument(subparser):
+        subparser.add_argument("--stream", action="store_true",
+                               help="build the reports while crawling")
+
+    def add_store_arguments(subparser):
+        subparser.add_argument("--store", default=DEFAULT_STORE,
+                               help="the crawl snapshot database")
+        subparser.add_argument("--run-id",
+                               help="the stored run to resume or report on")
+
+    crawl_parser = subparsers.add_parser(
+        "crawl", help="crawl the sites and save them to the snapshot")
+    add_crawl_arguments(crawl_parser)
+    add_store_arguments(crawl_parser)
+
+    report_parser = subparsers.add_parser(
+        "report", help="build the reports from the snapshot")
+    add_report_arguments(report_parser)
+    add_store_arguments(report_parser)
+
+    both_parser = subparsers.add_parser(
+        "crawl-and-report", help="crawl the sites and build the reports")
+    add_crawl_arguments(both_parser)
+    add_report_arguments(both_parser)
+    add_store_arguments(both_parser)
+    add_stream_argument(both_parser)
+
+    work_parser = subparsers.add_parser(
+        "work", help="help crawl a run that is under way")
+    work_parser.add_argument("--max-workers", type=int, default=10)
+    work_parser.add_argument("--batch-size", type=int, default=25)
+    add_store_arguments(work_parser)
+    return parser
+
+def parse_args(argv):
+    """
+    Return the parsed command line arguments.
+
+    argv: the arguments, without the program name.
+    The old `<email> <password>` form runs crawl-and-report.
+    """
+    if len(argv) == 2 and argv[0] not in COMMANDS and not argv[0].startswith("-"):
+        argv = ["crawl-and-report"] + list(argv)
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command in ("report", "work"):
+        # Checked here so a missing crawl is a usage error, not a traceback.
+        try:
+            load_crawl(args.store, args.run_id)
+        except ValueError as error:
+            parser.error(str(error))
+    if getattr(args, "worker_processes", None):
+        if args.metrics is not None:
+            parser.error("--metrics can't be used with --worker-processes")
+        if getattr(args, "stream", False):
+            parser.error("--stream can't be used with --worker-processes")
+    return args
+
+def run(args):
+    """
+    Run the command given on the command line.
+    """
+    if args.command == "work":
+        from workqueue import run_worker
+        run_worker(args.store, args.run_id or load_crawl(args.store).run_id,
+                   batch_size=args.batch_size, max_workers=args.max_workers)
+    elif args.command in ("crawl", "crawl-and-report") and args.worker_processes:
+        builders = fields = None
+        if args.command == "crawl-and-report":
+            builders = get_default_builders(args.reports)
+            fields = get_crawl_fields(builders)
+        run_id = crawl_sharded(args.email, args.password, args.worker_processes,
+                               store_path=args.store, run_id=args.run_id,
+                               max_workers=args.max_workers, fields=fields,
+                               cache_dir=args.cache_dir, prewarm=args.prewarm,
+                               endpoint_cache_path=args.endpoint_cache)
+        if builders is not None:
+            report(builders, args.format, store_path=args.store,
+                   run_id=run_id, processes=args.processes,
+                   fragment_cache_dir=args.fragment_cache)
+    elif args.command == "crawl-and-report" and args.stream:
+        stream_reports(args.email, args.password,
+                       get_default_builders(args.reports),
+                       args.format, store_path=args.store, run_id=args.run_id,
+                       max_workers=args.max_workers, cache_dir=args.cache_dir,
+                       metrics_path=args.metrics, prewarm=args.prewarm,
+                       endpoint_cache_path=args.endpoint_cache)
+    elif args.command == "crawl":
+        crawl(args.email, args.password, store_path=args.store,
+              run_id=args.run_id, max_workers=args.max_workers,
+              cache_dir=args.cache_dir, metrics_path=args.metrics,
+              prewarm=args.prewarm, endpoint_cache_path=args.endpoint_cache)
+    elif args.command == "report":
+        report(get_default_builders(args.reports), args.format,
+               store_path=args.store, run_id=args.run_id, processes=args.processes,
+               fragment_cache_dir=args.fragment_cache)
+    else:
+        main(args.email, args.password, get_default_builders(args.reports),
+             args.format,
+             metrics_path=args.metrics, store_path=args.store,
+             processes=args.processes, fragment_cache_dir=args.fragment_cache,
+             run_id=args.run_id, max_workers=args.max_workers,
+             cache_dir=args.cache_dir, prewarm=args.prewarm,
+             endpoint_cache_path=args.endpoint_cache)
 
 if __name__ == "__main__":
-    import sys
-    name = sys.argv[1]
-    password = sys.argv[2]
-    builders = [WordCountReportBuilder, HeaderReportBuilder,\
-                PerformanceReportBuilder]
-    file_format = "html"
-
-    main(name, password, builders, file_format)
+    run(parse_args(sys.argv[1:]))
@@ -0,0 +1,167 @@
+from abc import ABCMeta, abstractmethod
+import heapq
+import threading
+from collections import Counter
+
+
+# Headers that nearly every site sends.
+# They're left out of the most common headers unless asked for.
+DEFAULT_EXCLUDED_HEADERS = frozenset([
+    "accept-ranges", "age", "cache-control", "connection",
+    "content-encoding", "content-length", "content-type", "date", "etag",
+    "expires", "keep-alive", "last-modified", "pragma", "server",
+    "set-cookie", "transfer-encoding", "vary"])
+
+
+class BaseNameIndex(metaclass=ABCMeta):
+    """
+    Base class for tallies of the header and cookie names sites sent.
+
+    Header names are case insensitive, so they are kept in lower case.
+    Cookie names are kept as they are.
+    Subclasses decide what is kept for each name.
+    """
+    KINDS = ("headers", "cookies")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.site_count = 0
+
+    @classmethod
+    def from_sites(cls, site_dicts):
+        """
+        Return an index of the given site dictionaries.
+        """
+        index = cls()
+        for site_dict in site_dicts:
+            index.add(site_dict)
+        return index
+
+    def add(self, site_dict):
+        """
+        Index the header and cookie names of a site.
+
+        site_dict: a dict representing the data gathered from a site.
+        """
+        site = site_dict["site_name"]
+        with self._lock:
+            self.site_count += 1
+            for kind in self.KINDS:
+                names = set(self._normalize(kind, name)
+                            for name in site_dict.get(kind) or ())
+                self._add_names(kind, site, names)
+
+    @abstractmethod
+    def count(self, kind, name):
+        """
+        Return the number of sites that sent a header or cookie.
+
+        kind: headers or cookies.
+        name: the header or cookie name.
+        """
+        pass
+
+    def most_common(self, kind, top_k=10, exclude=None):
+        """
+        Return a list of (name, site count) tuples,
+        most common first.
+
+        kind: headers or cookies.
+        top_k: the number of names to return, or None for all of them.
+        exclude: names to leave out.
+        Defaults to DEFAULT_EXCLUDED_HEADERS for headers.
+        """
+        if exclude is None:
+            exclude = DEFAULT_EXCLUDED_HEADERS if kind == "headers" else ()
+        exclude = set(self._normalize(kind, name) for name in exclude)
+        with self._lock:
+            counts = [(name, count)
+                      for name, count in self._iter_counts(kind)
+                      if name not in exclude]
+
+        def sort_key(item):
+            name, count = item
+            return (-count, name)
+
+        if top_k is None:
+            return sorted(counts, key=sort_key)
+        return heapq.nsmallest(top_k, counts, key=sort_key)
+
+    @abstractmethod
+    def _add_names(self, kind, site, names):
+        """
+        Record that a site sent the names. Called with the lock held.
+        """
+        pass
+
+    @abstractmethod
+    def _iter_counts(self, kind):
+        """
+        Yield (name, site count) tuples. Called with the lock held.
+        """
+        pass
+
+    @staticmethod
+    def _normalize(kind, name):
+        if kind == "headers":
+            return name.lower()
+        return name
+
+
+class NameIndex(BaseNameIndex):
+    """
+    Inverted index of header and cookie names.
+
+    Maps each name to the sites that sent it,
+    so frequency questions can be answered
+    without scanning every site dictionary again.
+    """
+    def __init__(self):
+        super().__init__()
+        self._sites = {kind: {} for kind in self.KINDS}
+
+    def count(self, kind, name):
+        return len(self.sites_with(kind, name))
+
+    def sites_with(self, kind, name):
+        """
+        Return a list of the sites that sent a header or cookie,
+        in the order they were indexed.
+
+        kind: headers or cookies.
+        name: the header or cookie name.
+        """
+        sites = self._sites[kind].get(self._normalize(kind, name), [])
+        return list(sites)
+
+    def _add_names(self, kind, site, names):
+        sites_by_name = self._sites[kind]
+        for name in names:
+            sites_by_name.setdefault(name, []).append(site)
+
+    def _iter_counts(self, kind):
+        for name, sites in self._sites[kind].items():
+            yield name, len(sites)
+
+
+class NameCounts(BaseNameIndex):
+    """
+    Counts of header and cookie names, without the sites that sent them.
+
+    Answers the same frequency questions as NameIndex,
+    in memory that depends on the number of distinct names
+    rather than the number of sites,
+    so it suits a crawl that is streamed rather than held.
+    """
+    def __init__(self):
+        super().__init__()
+        self._counts = {kind: Counter() for kind in self.KINDS}
+
+    def count(self, kind, name):
+        return self._counts[kind][self._normalize(kind, name)]
+
+    def _add_names(self, kind, site, names):
+        self._counts[kind].update(names)
+
+    def _iter_counts(self, kind):
+        return iter(self._counts[kind].items())
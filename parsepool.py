@@ -0,0 +1,67 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import os
+import threading
+
+from wordcounter import count_body_words
+
+
+class ParsePool:
+    """
+    A pool of worker processes that parse response bodies.
+
+    processes: the number of worker processes.
+    Defaults to the number of CPUs.
+    max_pending: the most bodies allowed to be downloaded
+    but not yet parsed at once. Defaults to twice the number of processes.
+
+    Fetching threads hold a slot from the time they start downloading
+    a body until it has been parsed,
+    so when the parsers fall behind, the fetchers wait
+    instead of piling up bodies in memory.
+    """
+    def __init__(self, processes=None, max_pending=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.processes
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the worker processes, if they haven't been started.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                                            max_workers=self.processes)
+
+    def close(self):
+        """
+        Stop the worker processes once they are idle.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold one of the pending body slots, waiting for one if need be.
+        """
+        self._slots.acquire()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def count_words(self, body, encoding):
+        """
+        Return the number of words in a body, counted by a worker process.
+
+        body: the body as bytes.
+        encoding: the name of the body's character encoding.
+        """
+        self.start()
+        return self._executor.submit(count_body_words, body, encoding).result()
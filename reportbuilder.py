@@ -1,4 +1,7 @@
 from abc import ABCMeta, abstractmethod
+from aggregators import build_aggregator
+from instrumentation import PHASES, PHASE_COLUMNS
+from reportformats import get_report_format, HtmlFormat, HtmlTableFormat
 
 class BaseReportBuilder(metaclass=ABCMeta):
     """
@@ -21,48 +24,57 @@ class NonStandardRowMixin:
     Used to add a nonstandard row to a report.
 
     Currently the only nonstandard functionality is to reduce a column,
-    specifically one that has been averaged or summed.
+    e.g. one that has been averaged or summed.
 
     The NonStandardRowMixin has an additional required keyword argument:
     _reduced_columns.
     The value should be a list of dictionaries in the following format:
     {"column_name": this should be the name of the column,
-      "method": sum or average,
-      "value": []}
+      "method": sum, average, min, max, count, p50, p95 or p99}
+    A "value" key left over from older code is ignored.
 
     Two cells will be appended to the table for each of the dictionaries.
     The first cell describes gives the method and column name.
     The second cell gives the new value.
+
+    The reduced values are kept by running aggregators
+    that are updated as each row is rendered,
+    so the column does not have to be kept or scanned again.
+    The reduced column doesn't have to be one of the report's categories.
     """
     def __init__(self, *args, _reduced_columns, **kwargs):
         self._reduced_columns = _reduced_columns
+        self._aggregators = []
         super().__init__(*args, **kwargs)
 
-    def _update_list(self, current_category, value):
+    def get_required_fields(self):
         """
-        If the current category matches the sought_category parameter,
-        update the associated instance list attribute.
-
-        This is useful when values are being stored
-        for later processing/consumption.
+        Return the set of site dictionary keys the report reads,
+        including the reduced columns.
+        """
+        fields = super().get_required_fields()
+        fields.update(column_data["column_name"]
+                      for column_data in self._reduced_columns)
+        return fields
 
-        current_category: the category being checked.
-        sought_category: the category that current_category must match.
-        list_to_update: the list to which a value will be added.
-        value: the value to be added.
+    def _start_aggregators(self):
         """
-        for category_data in self._reduced_columns:
-            if current_category == category_data["column_name"]:
-                category_data["value"].append(float(value))
+        Replace the aggregators with fresh ones,
+        one for each reduced column.
+        """
+        self._aggregators = [
+            (column_data["column_name"],
+             build_aggregator(column_data["method"]))
+            for column_data in self._reduced_columns]
 
-    def _remove_closing_table_tag(self, table):
+    def _update_aggregators(self, site_dict):
         """
-        Return a table with the closing tag removed.
+        Add the values in site_dict to the running aggregators.
 
-        This is useful for subclasses
-        that add non-standard rows to the table.
+        site_dict: a dict representing the data gathered from a site.
         """
-        return table[:-8]
+        for column_name, aggregator in self._aggregators:
+            aggregator.add(site_dict.get(column_name))
 
     def _build_reduce_row(self, method_applied, category_name, reduced_value):
         """
@@ -83,64 +95,50 @@ class NonStandardRowMixin:
                                         reduced_value)
         return reduced_row
 
-    def build_html_table(self):
+    def _start_report(self):
         """
-        Return a table of data.
-        This subclass adds a row for average word count.
-        """
-        table = super().build_html_table()
-        # I can get an add_row method from the mixin that does the following.
-        table = self._remove_closing_table_tag(table)
-
-        for special_column_data in self._reduced_columns:
-            for site_dict in self.data:
-                category = special_column_data["column_name"]
-                if category == site_dict["site_name"]:
-                    self._build_column_data(category, site_dict)
-
-            method = special_column_data["method"]
-            value = special_column_data["value"]
-            if method == "sum":
-                pretty_method = "total"
-                reduced_value = self._get_sum(value)
-            elif special_column_data["method"] == "average":
-                pretty_method = "avg"
-                reduced_value = self._get_average(value)
-            reduced_row = self._build_reduce_row(pretty_method, category,
-                                                       reduced_value)
-            table += reduced_row
-        table += "</table>"
-        return table
-
-    def _build_column_data(self, category, site_dict):
+        Start the reduced columns over for a new report.
         """
-        Return formatted data for a column.
+        super()._start_report()
+        self._start_aggregators()
 
-        category: a column name.
-        site_dict: a dict representing the data gathered from a site.
+    def _observe_row(self, site_dict):
         """
-        column_data = super()._build_column_data(
-                                category, site_dict)
-        category_value = site_dict[category]
-        self._update_list(category, category_value)
-        return column_data
+        Update the reduced columns with a row of the report.
+        """
+        super()._observe_row(site_dict)
+        self._update_aggregators(site_dict)
 
-    def _get_average(self, some_list):
+    def _get_reduced_values(self):
         """
-        Return the average of all values in a list.
+        Return a list of {"column_name", "method", "value"} dictionaries,
+        one for each reduced column.
         """
-        return sum(some_list) / len(some_list)
+        return [{"column_name": column_name,
+                 "method": aggregator.pretty_name,
+                 "value": aggregator.result()}
+                for column_name, aggregator in self._aggregators]
 
-    def _get_sum(self, some_list):
+    def _iter_html_closing_rows(self):
         """
-        Return the sum of all values in a list.
+        Yield a row for each reduced column.
+
+        The rows come after the site rows,
+        once every value in the column has been seen.
         """
-        return sum(some_list)
+        for column_name, aggregator in self._aggregators:
+            yield self._build_reduce_row(aggregator.pretty_name, column_name,
+                                         aggregator.result())
 
 class ReportBuilder(BaseReportBuilder):
     """
     Basic class for building an html report.
+
+    fragment_cache: an optional fragmentcache.FragmentCache.
+    Set it to render only the rows that changed since the last build.
     """
+    fragment_cache = None
+
     def __init__(self, header, categories, data):
         """
         data: a list of dictionaries used to populate rows in the report.
@@ -153,31 +151,135 @@ class ReportBuilder(BaseReportBuilder):
 
     def create_report(self, file_format):
         """
-        Create an html report.
+        Create a report file in the requested format.
+
+        The report is written a chunk at a time as it is rendered,
+        so it never has to be held in memory as a whole.
         """
-        report = self.build_report(file_format)
-        filename = "{0}.{1}".format(self.header, file_format)
-        with open(filename, "w") as f:
-            f.write(report)
+        renderer = self.open_renderer(file_format)
+        filename = self.get_filename(file_format)
+        with open(filename, renderer.file_mode) as f:
+            for chunk in self._iter_rendered(renderer):
+                f.write(chunk)
+        renderer.write_metadata(filename)
+
+    def get_required_fields(self):
+        """
+        Return the set of site dictionary keys the report reads.
+        """
+        return set(self.categories)
+
+    def get_filename(self, file_format):
+        """
+        Return the name of the file the report is created in.
+        """
+        return "{0}.{1}".format(self.header, file_format)
 
     def build_report(self, file_format):
         """
         Build a report in the requested file format.
 
         file_format: The format to use for the file.
-        Currently supports html.
+        Currently supports html, csv, jsonl and columnar.
 
-        This method delegates to a build method appropriate to the provided
+        The columnar format is returned as bytes.
+        Metadata that create_report writes to a file of its own
+        isn't included.
+        """
+        renderer = self.open_renderer(file_format)
+        empty = b"" if "b" in renderer.file_mode else ""
+        return empty.join(self._iter_rendered(renderer))
+
+    def iter_report(self, file_format):
+        """
+        Yield a report in the requested file format, a chunk at a time.
+
+        file_format: The format to use for the file.
+        Currently supports html, csv, jsonl and columnar.
+
+        This method delegates to a renderer appropriate to the provided
         file_format.
         """
-        if file_format == "html":
-            report = self.build_html_report()
-        return report
+        return self._iter_rendered(self.open_renderer(file_format))
+
+    def open_renderer(self, file_format):
+        """
+        Return a renderer for the requested file format,
+        ready for a new pass over the data.
+
+        The renderer turns the report into a head,
+        a chunk for each row and a tail.
+        This lets reportengine.ReportEngine
+        feed one pass over the data to many builders.
+        """
+        format_class = get_report_format(file_format)
+        fragments = None
+        if self.fragment_cache is not None and format_class.cacheable_rows:
+            fragments = self.fragment_cache.open("{0}:{1}".format(
+                        type(self).__name__, self.get_filename(file_format)))
+        renderer = format_class(self, fragments)
+        self._start_report()
+        return renderer
+
+    def _iter_rendered(self, renderer):
+        """
+        Yield the chunks of a report from a renderer.
+        """
+        yield from renderer.iter_head()
+        for index, site_dict in enumerate(self.data, 1):
+            yield renderer.render_row(index, site_dict)
+        yield from renderer.iter_tail()
+        renderer.close()
+
+    def _start_report(self):
+        """
+        Prepare for a new pass over the data.
+
+        The basic report has nothing to prepare.
+        """
+        pass
+
+    def _observe_row(self, site_dict):
+        """
+        Take note of a row before it is rendered.
+
+        The basic report doesn't need to.
+        """
+        pass
 
     def build_html_report(self):
         """
         Return an html report.
         """
+        return "".join(self.iter_html_report())
+
+    def iter_html_report(self):
+        """
+        Yield an html report, a chunk at a time.
+        """
+        self._start_report()
+        return self._iter_rendered(HtmlFormat(self))
+
+    def build_html_table(self):
+        """
+        Return an html table.
+        """
+        return "".join(self.iter_html_table())
+
+    def iter_html_table(self):
+        """
+        Yield an html table, a row at a time.
+
+        The ReportBuilder categories
+        are used for data retrieval and table header creation.
+        """
+        self._start_report()
+        return self._iter_rendered(HtmlTableFormat(self))
+
+    def _build_html_headings(self):
+        """
+        Return the html that comes before the table.
+        """
         headings =\
         """
         <head>
@@ -186,27 +288,31 @@ class ReportBuilder(BaseReportBuilder):
         <body>
         <h2>{0}</h2><br>
         """.format(self.header)
+        return headings
 
-        table = self.build_html_table()
-        report = "{0}{1}<br><br><br></body>".format(headings, table)
-        return report
+    def _build_html_row(self, index, site_dict):
+        """
+        Return an html table row for a site, starting with its ranking.
+        """
+        unfinished_row = self._build_site_row(site_dict)
+        return "<tr><td>{0}</td>{1}</tr>".format(index, unfinished_row)
 
-    def build_html_table(self):
+    def _get_reduced_values(self):
         """
-        Return an html table.
+        Return the values of the reduced columns.
 
-        The ReportBuilder categories
-        are used for data retrieval and table header creation.
+        The basic report has none.
         """
-        table = ""
-        table_header = self._build_html_table_header()
-        table += table_header
-        for index, site_dict in enumerate(self.data, 1):
-            unfinished_row = self._build_site_row(site_dict)
-            row = "<tr><td>{0}</td>{1}</tr>".format(index, unfinished_row)
-            table += row
-        table = "<table border=\"1\">{0}</table>".format(table)
-        return table
+        return []
+
+    def _iter_html_closing_rows(self):
+        """
+        Yield rows to be added after the site rows.
+
+        The basic report has none.
+        Subclasses can use this to add summary rows.
+        """
+        return iter(())
 
     def _build_html_table_header(self):
         """
@@ -230,10 +336,8 @@ class ReportBuilder(BaseReportBuilder):
         Return an html table row
         containing data for all of the predefined categories.
         """
-        site_row = ""
-        for category in self.categories:
-            site_row += self._build_column_data(category, site_dict)
-        return site_row
+        return "".join(self._build_column_data(category, site_dict)
+                       for category in self.categories)
 
     def _build_column_data(self, category, site_dict):
         """
@@ -265,8 +369,7 @@ class WordCountReportBuilder(CustomRowReportBuilder):
     def __init__(self, data):
         self.categories = ["site_name", "word_count"]
         reduced_columns = [{"column_name": "word_count",
-                           "method": "average",
-                           "value": []}]
+                           "method": "average"}]
         self.header = "Word Count Report"
         super().__init__(
             self.header, self.categories, data, _reduced_columns=reduced_columns)
@@ -284,12 +387,56 @@ class HeaderReportBuilder(ReportBuilder):
 class PerformanceReportBuilder(CustomRowReportBuilder):
     """
     Used to build a Performance report.
+
+    The time to complete is totalled,
+    and each phase is summarized as p50, p95 and p99 latencies.
+
+    phase_columns: the phase timing columns to summarize.
+    Defaults to every phase SiteRetriever records.
     """
-    def __init__(self, data):
+    def __init__(self, data, phase_columns=None):
+        if phase_columns is None:
+            phase_columns = [PHASE_COLUMNS[phase] for phase in PHASES]
         self.categories = ["site_name", "time_to_complete"]
         self.header = "Performance Report"
-        reduced_columns = [{"column_name": "word_count",
-                           "method": "sum",
-                           "value": []}]
+        reduced_columns = [{"column_name": "time_to_complete",
+                            "method": "sum"}]
+        for column in phase_columns:
+            reduced_columns.extend({"column_name": column, "method": method}
+                                   for method in ["p50", "p95", "p99"])
         super().__init__(
             self.header, self.categories, data, _reduced_columns=reduced_columns)
+
+
+class FrequencyReportBuilder(ReportBuilder):
+    """
+    Used to build a report of the most common header or cookie names.
+
+    index: a nameindex.NameIndex or NameCounts of the retrieved sites.
+    kind: headers or cookies.
+    top_k: the number of names to report, or None for all of them.
+    exclude: names to leave out of the report.
+    Defaults to the headers that nearly every site sends.
+    """
+    def __init__(self, index, kind="headers", top_k=25, exclude=None):
+        self.categories = ["name", "site_count", "percent_of_sites"]
+        self.header = "{0} Frequency Report".format(kind[:-1].capitalize())
+        data = []
+        for name, site_count in index.most_common(kind, top_k, exclude):
+            percent = 100 * site_count / index.site_count
+            data.append({"name": name,
+                         "site_count": site_count,
+                         "percent_of_sites": "{0:.1f}".format(percent)})
+        super().__init__(self.header, self.categories, data)
+
+
+def get_required_fields(builders):
+    """
+    Return the set of site dictionary keys read by any of the builders.
+
+    builders: a list of report builder instances.
+    """
+    fields = set()
+    for builder in builders:
+        fields.update(builder.get_required_fields())
+    return fields
@@ -0,0 +1,96 @@
+from contextlib import ExitStack
+
+
+class ReportEngine:
+    """
+    Creates the reports of many builders in one pass over the data.
+
+    builders: a list of report builder instances.
+    processes: an optional number of worker processes.
+    When more than one is given,
+    the builders are split between the processes
+    and each process makes its own single pass over the data.
+
+    Each site record is rendered by every builder as soon as it is read,
+    so the data is only iterated once however many builders there are.
+    The files are the same as those written by each builder's create_report.
+
+    fragment_cache: an optional fragmentcache.FragmentCache
+    for builders that don't have one of their own,
+    so that only rows that changed since the last build are rendered.
+    flush_every: an optional number of rows after which the files are
+    flushed, so that partial reports can be read while the data,
+    e.g. SiteRetriever.iter_sites, is still being produced.
+    The data is never held in memory when a single process is used.
+    """
+    def __init__(self, builders, processes=None, fragment_cache=None,
+                 flush_every=None):
+        self.builders = builders
+        self.processes = processes
+        self.flush_every = flush_every
+        if fragment_cache is not None:
+            for builder in builders:
+                if builder.fragment_cache is None:
+                    builder.fragment_cache = fragment_cache
+
+    def create_reports(self, data, file_format):
+        """
+        Create a report file from each of the builders.
+
+        data: an iterable of dictionaries used to populate rows in the reports.
+        file_format: the format to use for the files.
+        """
+        if self.processes is None or self.processes < 2 or len(self.builders) < 2:
+            render_reports(self.builders, data, file_format,
+                           flush_every=self.flush_every)
+            return
+
+        # Only imported when needed, since it's slow to import.
+        from concurrent.futures import ProcessPoolExecutor
+        data = list(data)
+        # The builders are pickled to be sent to the processes,
+        # and their data may be a store holding a database connection,
+        # so each is given the list instead.
+        for builder in self.builders:
+            builder.data = data
+        groups = [self.builders[i::self.processes]
+                  for i in range(min(self.processes, len(self.builders)))]
+        with ProcessPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [executor.submit(render_reports, group, data, file_format,
+                                       flush_every=self.flush_every)
+                       for group in groups]
+            for future in futures:
+                future.result()
+
+
+def render_reports(builders, data, file_format, flush_every=None):
+    """
+    Create a report file from each of the builders in one pass over data.
+
+    builders: a list of report builder instances.
+    data: an iterable of dictionaries used to populate rows in the reports.
+    file_format: the format to use for the files.
+    flush_every: an optional number of rows after which the files are flushed.
+    """
+    with ExitStack() as stack:
+        outputs = []
+        for builder in builders:
+            renderer = builder.open_renderer(file_format)
+            filename = builder.get_filename(file_format)
+            f = stack.enter_context(open(filename, renderer.file_mode))
+            for chunk in renderer.iter_head():
+                f.write(chunk)
+            outputs.append((renderer, filename, f))
+
+        for index, site_dict in enumerate(data, 1):
+            for renderer, filename, f in outputs:
+                f.write(renderer.render_row(index, site_dict))
+            if flush_every and index % flush_every == 0:
+                for renderer, filename, f in outputs:
+                    f.flush()
+
+        for renderer, filename, f in outputs:
+            for chunk in renderer.iter_tail():
+                f.write(chunk)
+            renderer.write_metadata(filename)
+            renderer.close()
@@ -0,0 +1,225 @@
+"""
+The file formats a report builder can render.
+
+A format renders a report in three parts:
+a head, a chunk for each row and a tail.
+The chunks can be written out as soon as they are rendered.
+
+html is for reading. csv, jsonl and columnar are for loading into
+other programs: they hold the row values as they are,
+and keep the reduced columns apart from the rows.
+"""
+import csv
+import io
+import json
+
+from columnar import ColumnBuilder, iter_columnar_file
+
+
+class ReportFormat:
+    """
+    Base class for report formats.
+
+    builder: the report builder whose categories and rows are rendered.
+    fragments: an optional fragmentcache.ReportFragments.
+    Rows whose ranking and category values are unchanged since the last build
+    are then copied from it instead of being rendered again.
+    """
+    file_mode = "w"
+    # Whether a row's chunk can be reused from a fragment cache.
+    cacheable_rows = True
+    # The suffix of the file the report's metadata is written to, if any.
+    metadata_suffix = None
+
+    def __init__(self, builder, fragments=None):
+        self.builder = builder
+        self.fragments = fragments
+
+    def iter_head(self):
+        """
+        Yield the chunks that come before the rows.
+        """
+        return iter(())
+
+    def render_row(self, index, site_dict):
+        """
+        Return the chunk for one row of the report.
+
+        index: the ranking of the row, starting at 1.
+        site_dict: a dict representing the data gathered from a site.
+        """
+        self.builder._observe_row(site_dict)
+        if self.fragments is None:
+            return self._render_row(index, site_dict)
+        values = [site_dict[category] for category in self.builder.categories]
+        return self.fragments.render_row(
+            index, values, lambda: self._render_row(index, site_dict))
+
+    def _render_row(self, index, site_dict):
+        raise NotImplementedError
+
+    def iter_tail(self):
+        """
+        Yield the chunks that come after the rows.
+        """
+        return iter(())
+
+    def get_metadata(self):
+        """
+        Return a dictionary describing the report:
+        its header, its categories and the values of its reduced columns.
+
+        Only complete once every row has been rendered.
+        """
+        return {"header": self.builder.header,
+                "categories": list(self.builder.categories),
+                "reduced": self.builder._get_reduced_values()}
+
+    def write_metadata(self, filename):
+        """
+        Write the report's metadata next to the report file,
+        for formats that keep it in a file of its own.
+
+        filename: the name of the report file.
+        """
+        if self.metadata_suffix is not None:
+            with open(filename + self.metadata_suffix, "w") as f:
+                json.dump(self.get_metadata(), f, default=str)
+
+    def close(self):
+        """
+        Finish the report once every chunk has been written,
+        saving the rows' fragments for the next build.
+        """
+        if self.fragments is not None:
+            self.fragments.save()
+
+
+class HtmlTableFormat(ReportFormat):
+    """
+    Renders a report as a bare html table.
+    """
+    def iter_head(self):
+        yield "<table border=\"1\">"
+        yield self.builder._build_html_table_header()
+
+    def _render_row(self, index, site_dict):
+        return self.builder._build_html_row(index, site_dict)
+
+    def iter_tail(self):
+        yield from self.builder._iter_html_closing_rows()
+        yield "</table>"
+
+
+class HtmlFormat(HtmlTableFormat):
+    """
+    Renders a report as an html page around the table.
+    """
+    def iter_head(self):
+        yield self.builder._build_html_headings()
+        yield from super().iter_head()
+
+    def iter_tail(self):
+        yield from super().iter_tail()
+        yield "<br><br><br></body>"
+
+
+class CsvFormat(ReportFormat):
+    """
+    Renders a report as comma separated values,
+    with a ranking column before the categories.
+
+    List values are sorted and joined with semicolons.
+    The reduced columns are written to a .meta.json file beside the report.
+    """
+    metadata_suffix = ".meta.json"
+
+    def __init__(self, builder, fragments=None):
+        super().__init__(builder, fragments)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator="\n")
+
+    def iter_head(self):
+        yield self._write(["ranking"] + list(self.builder.categories))
+
+    def _render_row(self, index, site_dict):
+        row = [index]
+        for category in self.builder.categories:
+            value = site_dict[category]
+            if isinstance(value, list):
+                value = ";".join(sorted(value))
+            row.append(value)
+        return self._write(row)
+
+    def _write(self, row):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow(row)
+        return self._buffer.getvalue()
+
+
+class JsonlFormat(ReportFormat):
+    """
+    Renders a report as one JSON object per line,
+    with a ranking key alongside the categories.
+
+    List values are sorted.
+    The reduced columns are written to a .meta.json file beside the report.
+    """
+    metadata_suffix = ".meta.json"
+
+    def _render_row(self, index, site_dict):
+        row = {"ranking": index}
+        for category in self.builder.categories:
+            value = site_dict[category]
+            if isinstance(value, list):
+                value = sorted(value)
+            row[category] = value
+        return json.dumps(row, default=str) + "\n"
+
+
+class ColumnarFormat(ReportFormat):
+    """
+    Renders a report in the columnar binary format,
+    which columnar.ColumnarReader reads through a memory map.
+
+    There is a ranking column before the categories.
+    The rows are held as columns until the last one has been seen,
+    then the whole file is written as the tail.
+    The report's metadata, including the reduced columns,
+    is kept in the file's footer.
+    """
+    file_mode = "wb"
+    cacheable_rows = False
+
+    def __init__(self, builder, fragments=None):
+        super().__init__(builder, fragments)
+        self._rankings = ColumnBuilder("ranking")
+        self._columns = [ColumnBuilder(category)
+                         for category in builder.categories]
+
+    def _render_row(self, index, site_dict):
+        self._rankings.append(index)
+        for column in self._columns:
+            column.append(site_dict[column.name])
+        return b""
+
+    def iter_tail(self):
+        yield from iter_columnar_file([self._rankings] + self._columns,
+                                      self.get_metadata())
+
+
+REPORT_FORMATS = {"html": HtmlFormat,
+                  "csv": CsvFormat,
+                  "jsonl": JsonlFormat,
+                  "columnar": ColumnarFormat}
+
+
+def get_report_format(file_format):
+    """
+    Return the format class for a file format name.
+    """
+    try:
+        return REPORT_FORMATS[file_format]
+    except KeyError:
+        raise ValueError("Unsupported report format: {0}".format(file_format))
@@ -0,0 +1,353 @@
+"""
+A scheduler for SiteRetriever's fetches.
+
+FetchScheduler wraps each request with:
+connect and read timeouts,
+retries with jittered exponential backoff for transient failures,
+per-host and global rate limits,
+an adaptive (AIMD) limit on the number of requests in flight,
+and an optional deadline for the whole run.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from urllib3.exceptions import (DecodeError, ProtocolError, ReadTimeoutError,
+                                SSLError)
+
+
+# Responses with these statuses are retried like connection failures.
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Raised when a request can't be made before the run's deadline.
+    """
+    pass
+
+
+class RateLimiter:
+    """
+    A token bucket that allows rate requests per second,
+    with bursts of up to burst requests.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """
+        Wait until a request is allowed.
+
+        deadline: a time.monotonic() value to give up at.
+        Raises DeadlineExceeded if the wait would pass it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise DeadlineExceeded("rate limit wait passes the deadline")
+            time.sleep(wait)
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Limits the number of requests in flight,
+    adjusting the limit additively up and multiplicatively down (AIMD).
+
+    The limit grows by about one for every limit's worth of requests
+    that finish within latency_target,
+    and is multiplied by backoff_ratio whenever a request times out.
+
+    initial: the starting limit.
+    minimum: the limit never goes below this.
+    maximum: the limit never goes above this.
+    latency_target: the seconds a healthy request takes at most.
+    backoff_ratio: the ratio the limit is cut by on a timeout.
+    """
+    def __init__(self, initial, minimum=1, maximum=None, latency_target=2.0,
+                 backoff_ratio=0.5):
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else initial
+        self.limit = float(initial)
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        """
+        Wait for room under the limit, then take it.
+
+        deadline: a time.monotonic() value to give up at.
+        Raises DeadlineExceeded if it passes while waiting.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        raise DeadlineExceeded(
+                            "no room under the concurrency limit before "
+                            "the deadline")
+                self._condition.wait(timeout)
+            self.in_flight += 1
+
+    def release(self, latency, timed_out=False):
+        """
+        Give back room under the limit and adjust it.
+
+        latency: the seconds the request took.
+        timed_out: whether the request timed out.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if timed_out:
+                self.limit = max(self.minimum, self.limit * self.backoff_ratio)
+            elif latency <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class FetchScheduler:
+    """
+    Makes requests for SiteRetriever under timeouts, retries,
+    rate limits, a concurrency limit and a deadline.
+
+    connect_timeout: seconds to wait for a connection.
+    read_timeout: seconds to wait between bytes of the response.
+    retries: the number of times a transient failure is retried.
+    backoff: the base of the exponential backoff between retries, in seconds.
+    Each wait is chosen at random up to backoff * 2 ** attempt.
+    max_backoff: the longest wait between retries, in seconds.
+    per_host_rate: the most requests per second to any one host.
+    global_rate: the most requests per second overall.
+    max_concurrency: the most requests in flight.
+    The adaptive limit starts here and shrinks when requests time out.
+    min_concurrency: the adaptive limit never goes below this.
+    latency_target: seconds within which a response counts as healthy.
+    deadline: seconds a run may take, from start_run().
+    Requests that would start later fail with DeadlineExceeded.
+    retry_statuses: the response statuses that are retried.
+    """
+    def __init__(self, connect_timeout=10.0, read_timeout=30.0, retries=2,
+                 backoff=0.1, max_backoff=2.0, per_host_rate=None,
+                 global_rate=None, max_concurrency=None, min_concurrency=1,
+                 latency_target=2.0, deadline=None,
+                 retry_statuses=RETRY_STATUSES):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.per_host_rate = per_host_rate
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+        self.global_limiter = None
+        if global_rate is not None:
+            self.global_limiter = RateLimiter(global_rate)
+        self.concurrency = None
+        if max_concurrency is not None:
+            self.concurrency = AdaptiveConcurrencyLimit(
+                max_concurrency, minimum=min_concurrency,
+                latency_target=latency_target)
+        self._host_limiters = {}
+        self._lock = threading.Lock()
+        self._deadline_at = None
+
+    def start_run(self):
+        """
+        Start the clock on the run's deadline, if there is one.
+        """
+        if self.deadline is not None:
+            self._deadline_at = time.monotonic() + self.deadline
+
+    def fetch(self, session, url, on_retry=None, hold=False, **kwargs):
+        """
+        Return the response to a GET request for url.
+
+        session: the requests.Session to make the request with.
+        on_retry: an optional function called with url before each retry.
+        hold: if True, the response keeps its place under the concurrency
+        limit until its body has been read with iter_body()
+        or it is given to release().
+        Use it with stream=True, so that the body is read
+        under the deadline and the limit as well as the headers.
+        kwargs: passed on to session.get.
+
+        SSL errors are raised straight away,
+        since they are not transient.
+        """
+        return self.request(session, "GET", url, on_retry=on_retry, hold=hold,
+                            **kwargs)
+
+    def request(self, session, method, url, on_retry=None, hold=False,
+                **kwargs):
+        """
+        Return the response to a request for url, as fetch() does.
+
+        method: the HTTP method.
+        Only retry requests that are safe to repeat,
+        e.g. POSTs that carry an idempotency key.
+        """
+        for attempt in range(self.retries + 1):
+            error = None
+            response = None
+            self._wait_for_turn(url)
+            start = time.monotonic()
+            try:
+                response = session.request(method, url,
+                                           timeout=self._get_timeout(),
+                                           **kwargs)
+            except requests.exceptions.SSLError:
+                self._release(start)
+                raise
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as request_error:
+                error = request_error
+                self._release(start, timed_out=isinstance(
+                                    error, requests.exceptions.Timeout))
+            else:
+                if (response.status_code not in self.retry_statuses or
+                        attempt == self.retries):
+                    if hold:
+                        response.scheduled_start = start
+                    else:
+                        self._release(start)
+                    return response
+                self._release(start)
+
+            if attempt == self.retries:
+                raise error
+            if response is not None:
+                response.close()
+            if on_retry is not None:
+                on_retry(url)
+            self._sleep(random.uniform(
+                0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def iter_body(self, response, chunk_size=8192):
+        """
+        Yield the body of a streamed response in chunks of up to
+        chunk_size bytes, each as soon as it arrives,
+        and then release the response.
+
+        The deadline is checked before each chunk.
+        If it has passed, the response is closed
+        and DeadlineExceeded is raised,
+        so a site that trickles its body can't hold up the run.
+        A read timeout shrinks the concurrency limit,
+        as a timeout before the headers does.
+        Errors are raised as the requests exceptions
+        that Response.iter_content would raise.
+        """
+        timed_out = False
+        try:
+            # A response that wasn't streamed already holds its body.
+            if response._content_consumed:
+                yield from response.iter_content(chunk_size)
+                return
+            while True:
+                self.check_deadline()
+                try:
+                    chunk = response.raw.read1(chunk_size, decode_content=True)
+                except ReadTimeoutError as error:
+                    timed_out = True
+                    raise requests.exceptions.ConnectionError(error)
+                except SSLError as error:
+                    raise requests.exceptions.SSLError(error)
+                except ProtocolError as error:
+                    raise requests.exceptions.ChunkedEncodingError(error)
+                except DecodeError as error:
+                    raise requests.exceptions.ContentDecodingError(error)
+                if not chunk:
+                    return
+                yield chunk
+        except DeadlineExceeded:
+            timed_out = True
+            response.close()
+            raise
+        finally:
+            self.release(response, timed_out)
+
+    def release(self, response, timed_out=False):
+        """
+        Give back the place under the concurrency limit
+        held by a response fetched with hold=True.
+
+        Releasing a response more than once, or one that holds no place,
+        does nothing.
+        """
+        start = getattr(response, "scheduled_start", None)
+        if start is None:
+            return
+        response.scheduled_start = None
+        self._release(start, timed_out)
+
+    def check_deadline(self):
+        """
+        Raise DeadlineExceeded if the run's deadline has passed.
+        """
+        if (self._deadline_at is not None and
+                time.monotonic() >= self._deadline_at):
+            raise DeadlineExceeded("the run's deadline has passed")
+
+    def _wait_for_turn(self, url):
+        """
+        Wait until the rate and concurrency limits allow a request to url.
+        """
+        self.check_deadline()
+        if self.per_host_rate is not None:
+            self._get_host_limiter(url).acquire(self._deadline_at)
+        if self.global_limiter is not None:
+            self.global_limiter.acquire(self._deadline_at)
+        if self.concurrency is not None:
+            self.concurrency.acquire(self._deadline_at)
+
+    def _release(self, start, timed_out=False):
+        if self.concurrency is not None:
+            self.concurrency.release(time.monotonic() - start, timed_out)
+
+    def _get_host_limiter(self, url):
+        host = urlsplit(url).hostname
+        with self._lock:
+            limiter = self._host_limiters.get(host)
+            if limiter is None:
+                limiter = RateLimiter(self.per_host_rate)
+                self._host_limiters[host] = limiter
+            return limiter
+
+    def _get_timeout(self):
+        """
+        Return the (connect, read) timeout,
+        shortened so a request can't outlast the deadline.
+        """
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        if self._deadline_at is not None:
+            remaining = self._deadline_at - time.monotonic()
+            connect_timeout = min(connect_timeout, remaining)
+            read_timeout = min(read_timeout, remaining)
+        return (connect_timeout, read_timeout)
+
+    def _sleep(self, seconds):
+        """
+        Sleep, unless waking would be past the deadline.
+        """
+        if (self._deadline_at is not None and
+                time.monotonic() + seconds >= self._deadline_at):
+            raise DeadlineExceeded("retry wait passes the deadline")
+        time.sleep(seconds)
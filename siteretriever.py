@@ -1,7 +1,44 @@
-from collections import OrderedDict
+import asyncio
+import itertools
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import requests
-from bs4 import BeautifulSoup
-from timer import timethis
+from bs4 import BeautifulSoup, SoupStrainer
+from connections import (ConnectionWarmer, DNSCache, build_session,
+                         get_connect_time, reset_connect_time)
+from instrumentation import Instrumentation, PHASE_COLUMNS
+from scheduler import DeadlineExceeded, FetchScheduler
+from sitestore import SiteRecordStore
+from wordcounter import CappedBody, count_response_words
+
+
+def _iter_in_order(executor, func, args_iterable, window):
+    """
+    Yield func(*args) for each args tuple, in order,
+    running them on executor.
+
+    window: the most calls submitted but not yet yielded at once.
+    Arguments are only read from args_iterable as room opens up,
+    so it can be a generator of any length.
+    """
+    pending = deque()
+    args_iterable = iter(args_iterable)
+    try:
+        while True:
+            while len(pending) < window:
+                args = next(args_iterable, None)
+                if args is None:
+                    break
+                pending.append(executor.submit(func, *args))
+            if not pending:
+                return
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
 
 
 # Thing that change:
@@ -13,15 +50,25 @@ from timer import timethis
 class ListingsRetriever:
     """
     Class for retrieving top listings from Alexa.
+
+    max_workers: the number of listing pages to fetch concurrently
+    once logged in.
     """
     BASE_URL = "http://www.alexa.com/topsites/global;"
     LOGIN_URL = "http://www.alexa.com/secure/login/ajaxex"
+    # Only the site listings are parsed out of each page.
+    # The class attribute is still a plain string while parsing,
+    # so it's matched with a regex rather than a class name.
+    LISTINGS_STRAINER = SoupStrainer(
+        "div", class_=re.compile(r"(^|\s)site-listing(\s|$)"))
 
-    def __init__(self, email=None, password=None, num_sites=100):
+    def __init__(self, email=None, password=None, num_sites=100,
+                 max_workers=4):
         self.email = email
         self.password = password
         self.num_sites = num_sites
         self.num_pages = self._get_number_of_amazon_pages(num_sites)
+        self.max_workers = max_workers
         self.listings = None
 
     def get_listings(self):
@@ -32,12 +79,41 @@ class ListingsRetriever:
         if self.listings is not None:
             return self.listings
 
-        soupy_listings = self._get_soupy_listings()
-        listings = self._scrub_listings(soupy_listings)
+        unclean_listings = self._get_unclean_listings()
+        listings = self._scrub_listings(unclean_listings)
         self.listings = listings
         print("Top sites retrieved...")
         return listings
 
+    def iter_listings(self):
+        """
+        Yield the top Alexa sites in ranking order.
+
+        Listing pages are fetched as the sites are consumed,
+        no more than max_workers pages ahead,
+        so the first sites are yielded once the first page arrives.
+        The listings aren't kept.
+        """
+        if self.listings is not None:
+            yield from self.listings
+            return
+
+        with requests.Session() as s, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self._log_in(s)
+            pages = _iter_in_order(executor, self._get_page_listings,
+                                   ((s, number)
+                                    for number in range(self.num_pages)),
+                                   self.max_workers)
+            remaining = self.num_sites
+            for page_listings in pages:
+                for site in self._scrub_listings(page_listings)[:remaining]:
+                    yield site
+                    remaining -= 1
+                if not remaining:
+                    pages.close()
+                    return
+
     def _get_number_of_amazon_pages(self, num_sites):
         """
         Return the number of amazon pages to visit.
@@ -60,37 +136,74 @@ class ListingsRetriever:
         else:
             return (num_sites // 25) + 1
 
-    def _get_soupy_listings(self):
+    def _get_unclean_listings(self):
         """
-        Return a list of site listings,
-        still made of soup.
+        Return the unscrubbed text of every site listing, in ranking order.
+
+        The listing pages are fetched concurrently
+        over the logged in session.
         """
         with requests.Session() as s:
-            payload = {'email': self.email, 'password': self.password, 'async': 'async', "type": "object"}
-            p = s.post(self.LOGIN_URL, data=payload)
-            # need to visit a second time to get a successful login.
-            p = s.post(self.LOGIN_URL, data=payload)
-            soupy_listings = []
-            for number in range(self.num_pages):
-                page = s.get(self.BASE_URL + str(number))
-                soup = BeautifulSoup(page.text, 'html.parser')
-                listings_table = soup.find("div", "listings table")
-                page_listings = listings_table.find_all("div", "site-listing")
-                soupy_listings.extend(page_listings)
-            return soupy_listings
-
-    def _scrub_listings(self, soupy_listings):
+            self._log_in(s)
+
+            def get_page_listings(number):
+                return self._get_page_listings(s, number)
+
+            unclean_listings = []
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for page_listings in executor.map(get_page_listings,
+                                                  range(self.num_pages)):
+                    unclean_listings.extend(page_listings)
+            return unclean_listings
+
+    def _log_in(self, session):
+        """
+        Log a session in to Alexa.
+        """
+        payload = {'email': self.email, 'password': self.password, 'async': 'async', "type": "object"}
+        p = session.post(self.LOGIN_URL, data=payload)
+        # need to visit a second time to get a successful login.
+        p = session.post(self.LOGIN_URL, data=payload)
+
+    def _get_page_listings(self, session, number):
+        """
+        Return the unscrubbed text of the site listings on one page.
+
+        session: a logged in requests.Session.
+        number: the number of the listings page.
+
+        Only the site listings are parsed,
+        and the soup is discarded once their text is pulled out.
+        """
+        page = session.get(self.BASE_URL + str(number))
+        soup = BeautifulSoup(page.text, 'html.parser',
+                             parse_only=self.LISTINGS_STRAINER)
+        return [self._get_listing_text(listing)
+                for listing in soup.find_all("div", "site-listing")]
+
+    @staticmethod
+    def _get_listing_text(listing):
+        """
+        Return the unscrubbed site text of a site listing.
+
+        listing: a site listing strained from the soup.
+        """
+        description = listing.find("div", "td DescriptionCell")
+        return description.p.get_text()
+
+    def _scrub_listings(self, unclean_listings):
         """
         Return a list of sites
         equal in number to self.num_sites.
 
-        soupy_listings: a list of site listings strained from the soup.
+        unclean_listings: a list of unscrubbed site strings,
+        or of site listings strained from the soup.
         """
         sites = []
-        for listing in soupy_listings[:self.num_sites]:
-            description = listing.find("div", "td DescriptionCell")
-            unclean_site = description.p.get_text()
-            scrubbed_site = unclean_site.strip()
+        for listing in unclean_listings[:self.num_sites]:
+            if not isinstance(listing, str):
+                listing = self._get_listing_text(listing)
+            scrubbed_site = listing.strip()
             sites.append(scrubbed_site)
         return sites
 
@@ -105,85 +218,634 @@ class ListingsRetriever:
 class SiteRetriever:
     """
     Class for retrieving data from a list of sites.
+
+    max_workers: the number of sites to retrieve concurrently.
+    A value of 1 visits the sites one after another.
+    session: an optional requests.Session shared by every fetch.
+    If none is given, a pooled session sized to max_workers is created.
+    cache: an optional httpcache.ResponseCache.
+    Cached sites are fetched with conditional requests,
+    and unchanged pages are not parsed again.
+    compact: if True, the sites are collected in a
+    sitestore.SiteRecordStore instead of a list of dictionaries.
+    store: an optional crawlstore.CrawlStore.
+    Each site is written to the store as it completes.
+    run_id: the id of the run the sites are stored under.
+    If none is given, a new run is started.
+    Passing the id of an earlier run resumes it:
+    sites already stored for that run are not fetched again.
+    index: an optional nameindex.NameIndex, or NameCounts.
+    The header and cookie names of each site are indexed as it completes.
+    instrumentation: an optional instrumentation.Instrumentation
+    to record each site's phase timings in.
+    One that doesn't print is created if none is given.
+    scheduler: an optional scheduler.FetchScheduler
+    to make each request under timeouts, retries and limits.
+    If none is given, one with the default timeouts and retries is created,
+    limited to max_workers requests in flight.
+    parse_pool: an optional parsepool.ParsePool.
+    Bodies are then parsed by its worker processes
+    while the fetching threads go on downloading,
+    and no more than its max_pending bodies wait to be parsed at once.
+    For the pool to stay busy, max_workers should be
+    larger than its number of processes.
+    max_body_size: the most bytes of a page body to read, or None for no cap.
+    Larger pages are cut off at that size, their words are counted
+    up to the cut, and their site dictionaries are marked truncated.
+    dns_cache: an optional connections.DNSCache for the session created here
+    to look hosts up in. If none is given, one is created.
+    It isn't used when a session is passed in.
+    prewarm: the number of sites ahead of those being fetched
+    to look up and connect to in the background, or 0 not to.
+    Connections are only kept for the session created here.
+    endpoint_cache: an optional endpointcache.EndpointCache.
+    Sites are then fetched straight from the url they were last found at,
+    skipping the fallback and redirects it took to get there.
+    Stale urls are refreshed in the background,
+    and urls that fail are resolved again.
+    fields: an optional set of the site dictionary keys that will be used,
+    e.g. reportbuilder.get_required_fields(builders).
+    When none of them come from the body,
+    each connection is closed as soon as the headers have arrived,
+    and the body's keys are None.
+    Defaults to every key.
     """
+    MAX_BODY_SIZE = 5 * 1024 * 1024
+    # The keys that can only be had by reading the body.
+    BODY_FIELDS = frozenset(["word_count", "truncated",
+                             PHASE_COLUMNS["download"], PHASE_COLUMNS["parse"]])
 
-    def __init__(self):
-        self.sites_list = []
+    def __init__(self, max_workers=1, session=None, cache=None,
+                 compact=False, store=None, run_id=None, index=None,
+                 instrumentation=None, scheduler=None, parse_pool=None,
+                 max_body_size=MAX_BODY_SIZE, dns_cache=None, prewarm=0,
+                 endpoint_cache=None, fields=None):
+        self.sites_list = SiteRecordStore() if compact else []
+        self.max_workers = max_workers
+        self.prewarm = prewarm
+        self.dns_cache = None
+        if session is None:
+            if dns_cache is None:
+                dns_cache = DNSCache()
+            self.dns_cache = dns_cache
+            # Warm connections wait in pools of their own
+            # until their sites are fetched.
+            session = self._build_session(max_workers,
+                                          num_pools=max_workers + prewarm,
+                                          dns_cache=dns_cache)
+        self.session = session
+        self.cache = cache
+        self.store = store
+        self.index = index
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        if scheduler is None:
+            scheduler = FetchScheduler(max_concurrency=max_workers)
+        self.scheduler = scheduler
+        self.parse_pool = parse_pool
+        self.max_body_size = max_body_size
+        self.endpoint_cache = endpoint_cache
+        self.reads_body = (fields is None or
+                           not self.BODY_FIELDS.isdisjoint(fields))
+        self.run_id = None
+        self._stored_names = set()
+        self._warmer = None
+        self._refresher = None
+        if store is not None:
+            self.run_id = store.start_run(run_id)
+
+    @staticmethod
+    def _build_session(pool_size, num_pools=None, dns_cache=None):
+        """
+        Return a session whose connection pools can serve
+        pool_size concurrent requests.
+
+        num_pools: the number of hosts to keep connections to.
+        dns_cache: an optional DNSCache for the connections to share.
+        """
+        return build_session(pool_size, num_pools=num_pools,
+                             dns_cache=dns_cache)
 
     def build_sites_list(self, listings):
         """
         Return a list of site dictionaries.
 
         listings: a list of websites without their protocols.
+
+        The dictionaries are returned in the same order as listings,
+        even when the sites are retrieved concurrently.
         """
-        if self.sites_list != []:
+        if self.sites_list:
             return self.sites_list
 
         print("Collecting sites data...")
-        for site in listings:
-            print("Collecting {0}'s data...".format(site))
-
-            try:
-                page = self._get_page(site)
-                self.sites_list.append(self._build_site_dictionary(page, site))
-            except requests.exceptions.ConnectionError:
-                print("{0} could not be accessed".format(site))
-                continue
-            ##### the next comment
+        self._start_run()
+        ranks = range(1, len(listings) + 1)
+        for site_dict in self.retrieve_sites(listings, ranks):
+            if site_dict is not None:
+                self.sites_list.append(site_dict)
 
+        self._finish_run()
         print("Sites data collected.")
         return self.sites_list
         # I can access the list of dicts from the db to pass to the reportbuilder.
         # reportbuilder shouldn't be responsible for the retrieval.
 
-    @timethis
-    def _build_site_dictionary(self, page, site):
+    def iter_sites(self, listings, window=None):
+        """
+        Yield site dictionaries in the order of listings.
+
+        listings: an iterable of websites without their protocols,
+        e.g. ListingsRetriever.iter_listings().
+        window: the most sites being retrieved or waiting to be yielded
+        at once. Defaults to twice max_workers.
+
+        Sites are read from listings as room opens up in the window,
+        and nothing is kept once it has been yielded,
+        so memory depends on the window rather than the number of sites.
+        Sites that could not be accessed are skipped.
+        """
+        if window is None:
+            window = 2 * self.max_workers
+        self._start_run()
+        try:
+            ranked_sites = zip(self._iter_warming(listings),
+                               itertools.count(1))
+            if self.max_workers > 1:
+                with ThreadPoolExecutor(
+                        max_workers=self.max_workers) as executor:
+                    site_dicts = _iter_in_order(executor, self._retrieve_site,
+                                                ranked_sites, window)
+                    for site_dict in site_dicts:
+                        if site_dict is not None:
+                            yield site_dict
+            else:
+                for site, rank in ranked_sites:
+                    site_dict = self._retrieve_site(site, rank)
+                    if site_dict is not None:
+                        yield site_dict
+        finally:
+            self._finish_run()
+
+    def retrieve_sites(self, listings, ranks):
+        """
+        Return a list of site dictionaries in the order of listings,
+        with None for each site that could not be accessed.
+
+        listings: a list of websites without their protocols.
+        ranks: the position of each site in the full listings, starting at 1.
+
+        Unlike build_sites_list, the results aren't kept,
+        so a retriever can be used for one batch of sites after another.
+        Sites written to the store are buffered until the run is finished
+        or the store is flushed.
+        """
+        listings = self._iter_warming(listings)
+        if self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return list(executor.map(self._retrieve_site, listings, ranks))
+        return list(map(self._retrieve_site, listings, ranks))
+
+    def _iter_warming(self, listings):
+        """
+        Yield the sites of listings,
+        queueing each one to be connected to ahead of its fetch.
+
+        Sites already stored for the run aren't fetched,
+        so they aren't connected to.
+        """
+        for site in listings:
+            if self._warmer is not None and site not in self._stored_names:
+                url = None
+                if self.endpoint_cache is not None:
+                    url = self.endpoint_cache.peek(site)
+                self._warmer.add(url or "http://" + site, key=site)
+            yield site
+
+    def _start_run(self):
+        """
+        Get ready to retrieve the sites.
+
+        The scheduler's deadline starts,
+        and the names of the sites already stored for this run are loaded,
+        so that a resumed run reads them from the store
+        rather than fetching them again.
+        """
+        self.scheduler.start_run()
+        if self.parse_pool is not None:
+            self.parse_pool.start()
+        if self.prewarm and self._warmer is None:
+            self._warmer = ConnectionWarmer(
+                self.session, self.prewarm,
+                timeout=self.scheduler.connect_timeout)
+        if self.endpoint_cache is not None and self._refresher is None:
+            self._refresher = ThreadPoolExecutor(max_workers=2)
+        if self.store is not None:
+            self._stored_names = self.store.get_site_names(self.run_id)
+            if self._stored_names:
+                print("Resuming run {0}: {1} sites already collected.".format(
+                                        self.run_id, len(self._stored_names)))
+
+    def _finish_run(self):
+        """
+        Write out and tidy up anything the run has left pending.
+        """
+        if self.parse_pool is not None:
+            self.parse_pool.close()
+        if self._warmer is not None:
+            self._warmer.close()
+            print("Connections warmed: {0}, failed: {1}.".format(
+                                self._warmer.warmed, self._warmer.failed))
+            self._warmer = None
+        if self._refresher is not None:
+            self._refresher.shutdown(wait=True)
+            self._refresher = None
+        if self.endpoint_cache is not None:
+            self.endpoint_cache.save()
+            print("Endpoint cache: {hits} hits, {misses} misses, "
+                  "{round_trips_saved} round trips saved.".format(
+                                            **self.endpoint_cache.stats()))
+        if self.store is not None:
+            self.store.flush()
+        if self.cache is not None:
+            self.cache.evict()
+            print("Response cache: {hits} hits, {misses} misses.".format(
+                                                    **self.cache.stats()))
+
+    def _retrieve_site(self, site, rank=None):
+        """
+        Return a site dictionary,
+        or None if the site could not be accessed.
+
+        site: a url without a protocol.
+        rank: the site's position in the listings, starting at 1.
+        Needed for the site to be written to the store.
+        """
+        if site in self._stored_names:
+            stored_site = self.store.get_site_dict(self.run_id, site)
+            if self.index is not None:
+                self.index.add(stored_site)
+            return stored_site
+
+        print("Collecting {0}'s data...".format(site))
+        try:
+            site_dict = self._fetch_site(site)
+        except requests.exceptions.RequestException as error:
+            # Includes bodies cut off or garbled partway through.
+            print("{0} could not be accessed".format(site))
+            self.instrumentation.record_error(site, error)
+            return None
+
+        if self.store is not None and rank is not None:
+            self.store.add_site(self.run_id, rank, site_dict)
+        if self.index is not None:
+            self.index.add(site_dict)
+        return site_dict
+
+    def _fetch_site(self, site):
+        """
+        Return a site dictionary
+        including the time spent in each phase of retrieving it.
+
+        site: a url without a protocol.
+        """
+        reset_connect_time()
+        start = time.perf_counter()
+        page = self._get_page(site)
+        first_byte = time.perf_counter()
+        # The page holds its place under the scheduler's concurrency limit
+        # until its body has been read, or here if the body isn't read.
+        try:
+            if self.reads_body:
+                body = self._open_body(page)
+                with self._parse_slot():
+                    site_dict = self._build_site_dictionary(page, site, body)
+                site_dict["truncated"] = body.truncated
+                read_time = body.read_time
+            else:
+                # Nothing wanted is in the body,
+                # so the connection is closed without reading it.
+                page.close()
+                site_dict = self._build_header_dictionary(page, site)
+                read_time = 0.0
+        finally:
+            self.scheduler.release(page)
+        parsed = time.perf_counter()
+
+        # The body is parsed as it streams in,
+        # so the time spent waiting on it is counted as download time
+        # and the rest as parse time.
+        timings = {"connect": get_connect_time(),
+                   "first_byte": first_byte - start,
+                   "download": read_time,
+                   "parse": parsed - first_byte - read_time,
+                   "total": parsed - start}
+        for phase, seconds in timings.items():
+            site_dict[PHASE_COLUMNS[phase]] = seconds
+        self.instrumentation.record_site(site, timings)
+        return site_dict
+
+    def _parse_slot(self):
+        """
+        Return a context manager that holds a place for a body
+        from the time it is downloaded until it has been parsed.
+
+        Without a parse pool, bodies are parsed by the thread that
+        downloaded them, so there is nothing to wait for.
+        """
+        if self.parse_pool is None:
+            return nullcontext()
+        return self.parse_pool.slot()
+
+    def _open_body(self, page):
+        """
+        Return a wordcounter.CappedBody to read the page's body through,
+        capped at max_body_size.
+
+        page: a streamed response object from a website.
+
+        The body is read through the scheduler,
+        so it is bound by the run's deadline.
+        """
+        return CappedBody(page, self.max_body_size,
+                          chunks=self.scheduler.iter_body(page))
+
+    def _build_site_dictionary(self, page, site, body=None):
         """
         Return a site dictionary.
 
         page: a response object from a website.
         site: a url without a protocol.
+        body: an optional CappedBody to read the page's body through.
+
+        Truncated pages aren't cached,
+        since their word counts are only of part of the page.
         """
-        headers, cookies, word_count = self._get_data_from(page)
+        if body is None:
+            body = self._open_body(page)
+        data = None
+        if self.cache is not None:
+            data = self.cache.get_data(site, page, body)
+        if data is None:
+            data = self._get_data_from(page, body)
+            if self.cache is not None and not body.truncated:
+                self.cache.store(site, page, data, body)
+        headers, cookies, word_count = data
         return {
             "site_name": site,
             "headers": headers,
             "cookies": cookies,
             "word_count": word_count}
 
-    def _get_data_from(self, page):
+    def _build_header_dictionary(self, page, site):
+        """
+        Return a site dictionary of what the page's headers give,
+        with None for the keys that come from its body.
+
+        page: a response object from a website.
+        site: a url without a protocol.
+        """
+        return {
+            "site_name": site,
+            "headers": list(page.headers.keys()),
+            "cookies": page.cookies.keys(),
+            "word_count": None,
+            "truncated": None}
+
+    def _get_data_from(self, page, body=None):
         """
         Return all of the data retrieved from page.
 
         page: A response object from a website.
+        body: an optional CappedBody to read the page's body through.
         """
         headers = list(page.headers.keys())
         cookies = page.cookies.keys()
-        word_count = self._get_wordcount(page)
+        word_count = self._get_wordcount(page, body)
         return (headers, cookies, word_count)
 
-    @staticmethod
-    def _get_page(site):
+    def _get_page(self, site):
         """
         Return a response object from the site.
 
         site: a url without a protocol.
+
+        The response is streamed,
+        so it returns once the headers have arrived.
+        """
+        headers = {}
+        # A 304 reply doesn't carry all of the headers,
+        # so they are only asked for when the cached data can be used.
+        if self.cache is not None and self.reads_body:
+            headers = self.cache.conditional_headers(site)
+        if self._warmer is not None:
+            self._warmer.started(site)
+        if self.endpoint_cache is not None:
+            page = self._get_learned_page(site, headers)
+            if page is not None:
+                return page
+        page, round_trips = self._resolve_page(site, headers)
+        if self.endpoint_cache is not None and page.status_code < 400:
+            self.endpoint_cache.learn(site, page.url, round_trips)
+        return page
+
+    def _resolve_page(self, site, headers):
+        """
+        Return (response, round trips) for the site,
+        trying http://<site> and then http://www.<site>,
+        and following any redirects.
+
+        round trips: the number of requests made to get the response.
         """
         try:
             url = "http://" + site
-            page = requests.get(url)
+            page = self._request(url, headers)
+            fallbacks = 0
         except requests.exceptions.SSLError:
             url = "http://www." + site
-            page = requests.get(url)
+            page = self._request(url, headers)
+            fallbacks = 1
+        return page, 1 + fallbacks + len(page.history)
+
+    def _get_learned_page(self, site, headers):
+        """
+        Return a response from the url learned for the site,
+        or None if there is none or it failed.
+
+        A stale url is used, and refreshed in the background.
+        Any failure of the learned url, such as a timeout or a TLS error,
+        drops it, so the site is resolved again.
+        """
+        url = self.endpoint_cache.lookup(site)
+        if url is None:
+            return None
+        try:
+            page = self._request(url, headers)
+        except DeadlineExceeded:
+            # The run is out of time, which is no fault of the url.
+            raise
+        except requests.exceptions.RequestException:
+            self.endpoint_cache.record_failure(site)
+            return None
+        if page.status_code >= 400:
+            page.close()
+            self.scheduler.release(page)
+            self.endpoint_cache.record_failure(site)
+            return None
+        if page.history:
+            # The site has moved since it was learned.
+            self.endpoint_cache.learn(site, page.url, 1 + len(page.history))
+            return page
+        self.endpoint_cache.record_success(site)
+        if (self._refresher is not None and
+                self.endpoint_cache.claim_refresh(site)):
+            self._refresher.submit(self._refresh_endpoint, site)
         return page
 
-    @staticmethod
-    def _get_wordcount(page):
+    def _refresh_endpoint(self, site):
+        """
+        Resolve the site again and learn where it is now.
+
+        Only the headers of the response are read.
+        """
+        try:
+            page, round_trips = self._resolve_page(site, {})
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            return
+        page.close()
+        self.scheduler.release(page)
+        if page.status_code < 400:
+            self.endpoint_cache.learn(site, page.url, round_trips)
+
+    def _request(self, url, headers):
+        """
+        Return a streamed response to a GET request for url,
+        made through the scheduler.
+
+        headers: extra request headers.
+        """
+        return self.scheduler.fetch(
+            self.session, url, on_retry=self.instrumentation.record_retry,
+            hold=True, headers=headers, stream=True)
+
+    def _get_wordcount(self, page, body=None):
         """
         Return the number of words on a page.
 
         page: A response object from a website.
+        body: an optional CappedBody to read the page's body through.
+
+        The body is tokenized in chunks as it is read,
+        so no DOM or full copy of the body or its text is built.
+        With a parse pool, the (capped) body is read in full
+        and tokenized in one of the pool's processes.
         """
-        soup = BeautifulSoup(page.text, 'html.parser')
-        words = soup.get_text().split()
-        return len(words)
+        if body is None:
+            body = self._open_body(page)
+        if self.parse_pool is not None:
+            return self.parse_pool.count_words(body.content, page.encoding)
+        return count_response_words(page, body=body)
+
+
+class AsyncSiteRetriever(SiteRetriever):
+    """
+    Class for retrieving data from a list of sites on an asyncio event loop.
+
+    max_in_flight: the most sites allowed to be in flight at once.
+    session: an optional requests.Session shared by every fetch.
+
+    This lets the sites be collected from inside an event loop,
+    but it doesn't make the fetches themselves asynchronous.
+    requests is a blocking library,
+    so each fetch/parse cycle is handed to a worker thread,
+    and there is one OS thread per site in flight.
+    Holding thousands of slow sites open at once
+    would take thousands of threads;
+    that needs an asynchronous HTTP client, which this doesn't use.
+    Sites are read from the listings only as others finish,
+    so no more than max_in_flight are started at once,
+    however many sites are waiting.
+    """
+
+    def __init__(self, max_in_flight=100, session=None, **kwargs):
+        super().__init__(max_workers=max_in_flight, session=session, **kwargs)
+        self.max_in_flight = max_in_flight
+
+    async def build_sites_list(self, listings):
+        """
+        Return a list of site dictionaries in the order of listings.
+
+        listings: a list of websites without their protocols.
+        """
+        if self.sites_list:
+            return self.sites_list
+
+        print("Collecting sites data...")
+        self._start_run()
+        site_dicts = [None] * len(listings)
+        try:
+            async for index, site_dict in self._iter_indexed_sites(listings):
+                site_dicts[index] = site_dict
+        finally:
+            self._finish_run()
+
+        self.sites_list.extend(
+            site_dict for site_dict in site_dicts if site_dict is not None)
+        print("Sites data collected.")
+        return self.sites_list
+
+    async def iter_sites(self, listings):
+        """
+        Yield site dictionaries as they finish.
+
+        listings: a list of websites without their protocols.
+
+        Sites that could not be accessed are skipped.
+        The run is finished even if the caller stops early.
+        """
+        self._start_run()
+        indexed_sites = self._iter_indexed_sites(listings)
+        try:
+            async for index, site_dict in indexed_sites:
+                if site_dict is not None:
+                    yield site_dict
+        finally:
+            await indexed_sites.aclose()
+            self._finish_run()
+
+    async def _iter_indexed_sites(self, listings):
+        """
+        Yield (index, site dictionary) tuples in the order they finish.
+
+        The site dictionary is None if the site could not be accessed.
+        A site is only read from listings once there is room for it,
+        so at most max_in_flight sites are in flight.
+        If iteration stops early, sites not yet started are dropped
+        and those being fetched are waited for,
+        so they are stored before the run is finished.
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+        def retrieve(index, site):
+            return index, self._retrieve_site(site, index + 1)
+
+        listings = enumerate(self._iter_warming(listings))
+        in_flight = set()
+        try:
+            while True:
+                room = self.max_in_flight - len(in_flight)
+                for index, site in itertools.islice(listings, room):
+                    in_flight.add(loop.run_in_executor(executor, retrieve,
+                                                       index, site))
+                if not in_flight:
+                    return
+                done, in_flight = await asyncio.wait(
+                                in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            await asyncio.to_thread(executor.shutdown, wait=True,
+                                    cancel_futures=True)
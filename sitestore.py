@@ -0,0 +1,205 @@
+"""
+A compact, column oriented store for site records.
+
+A list of site dictionaries keeps a separate copy of every header
+and cookie name for every site.
+SiteRecordStore keeps each field in a typed column instead,
+and stores header and cookie names once, referring to them by id.
+Indexing the store returns a read only mapping
+with the same keys and values as the original site dictionary,
+so it can be passed to the report builders in place of a list.
+"""
+from array import array
+from collections.abc import Mapping, Sequence
+import math
+
+
+class StringTable:
+    """
+    Assigns each distinct string a small integer id.
+    """
+    def __init__(self):
+        self._ids = {}
+        self._strings = []
+
+    def get_id(self, string):
+        """
+        Return the id of a string, adding it to the table if it's new.
+        """
+        string_id = self._ids.get(string)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._ids[string] = string_id
+            self._strings.append(string)
+        return string_id
+
+    def get_string(self, string_id):
+        return self._strings[string_id]
+
+    def __len__(self):
+        return len(self._strings)
+
+
+class SiteRecordStore(Sequence):
+    """
+    A sequence of site records stored in typed columns.
+
+    site_name is kept in one utf-8 buffer,
+    word_count in an array of integers,
+    time_to_complete and the other phase timings in arrays of floats,
+    truncated in an array of bytes,
+    and headers and cookies as arrays of ids into a shared StringTable.
+    Any other keys are kept per record as they are.
+    """
+    INT_COLUMNS = ("word_count",)
+    FLOAT_COLUMNS = ("time_to_complete", "connect_time", "first_byte_time",
+                     "download_time", "parse_time")
+    BOOL_COLUMNS = ("truncated",)
+    LIST_COLUMNS = ("headers", "cookies")
+    MISSING_INT = -2 ** 63
+    MISSING_BOOL = -1
+    _known_keys = frozenset(("site_name",) + INT_COLUMNS + FLOAT_COLUMNS +
+                            BOOL_COLUMNS + LIST_COLUMNS)
+
+    def __init__(self):
+        self._name_buffer = bytearray()
+        self._name_offsets = array("Q", [0])
+        self._ints = {column: array("q") for column in self.INT_COLUMNS}
+        self._floats = {column: array("d") for column in self.FLOAT_COLUMNS}
+        self._bools = {column: array("b") for column in self.BOOL_COLUMNS}
+        self._list_ids = {column: array("I") for column in self.LIST_COLUMNS}
+        self._list_offsets = {column: array("Q", [0])
+                              for column in self.LIST_COLUMNS}
+        self._strings = StringTable()
+        self._extras = []
+        self._has_extras = False
+
+    @classmethod
+    def from_dicts(cls, site_dicts):
+        """
+        Return a store holding the given site dictionaries.
+        """
+        store = cls()
+        store.extend(site_dicts)
+        return store
+
+    def append(self, site_dict):
+        """
+        Add a site dictionary to the end of the store.
+        """
+        self._name_buffer.extend(site_dict["site_name"].encode("utf-8"))
+        self._name_offsets.append(len(self._name_buffer))
+
+        for column, values in self._ints.items():
+            value = site_dict.get(column)
+            values.append(self.MISSING_INT if value is None else int(value))
+
+        for column, values in self._floats.items():
+            value = site_dict.get(column)
+            values.append(math.nan if value is None else float(value))
+
+        for column, values in self._bools.items():
+            value = site_dict.get(column)
+            values.append(self.MISSING_BOOL if value is None else bool(value))
+
+        for column, ids in self._list_ids.items():
+            for name in site_dict.get(column) or ():
+                ids.append(self._strings.get_id(name))
+            self._list_offsets[column].append(len(ids))
+
+        extras = {key: value for key, value in site_dict.items()
+                  if key not in self._known_keys}
+        if extras:
+            self._has_extras = True
+        self._extras.append(extras or None)
+
+    def extend(self, site_dicts):
+        for site_dict in site_dicts:
+            self.append(site_dict)
+
+    def __len__(self):
+        return len(self._extras)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("site record index out of range")
+        return SiteRecord(self, index)
+
+    def _get_value(self, index, key):
+        """
+        Return the value of key for the record at index.
+
+        Raises KeyError if the record has no value for key.
+        """
+        if key == "site_name":
+            start, end = self._name_offsets[index], self._name_offsets[index + 1]
+            return self._name_buffer[start:end].decode("utf-8")
+        if key in self._ints:
+            value = self._ints[key][index]
+            if value == self.MISSING_INT:
+                raise KeyError(key)
+            return value
+        if key in self._floats:
+            value = self._floats[key][index]
+            if math.isnan(value):
+                raise KeyError(key)
+            return value
+        if key in self._bools:
+            value = self._bools[key][index]
+            if value == self.MISSING_BOOL:
+                raise KeyError(key)
+            return bool(value)
+        if key in self._list_ids:
+            offsets = self._list_offsets[key]
+            ids = self._list_ids[key][offsets[index]:offsets[index + 1]]
+            return [self._strings.get_string(string_id) for string_id in ids]
+        extras = self._extras[index]
+        if extras is None:
+            raise KeyError(key)
+        return extras[key]
+
+    def _get_keys(self, index):
+        """
+        Return the keys that the record at index has values for.
+        """
+        keys = ["site_name"]
+        for column, values in self._ints.items():
+            if values[index] != self.MISSING_INT:
+                keys.append(column)
+        for column, values in self._floats.items():
+            if not math.isnan(values[index]):
+                keys.append(column)
+        for column, values in self._bools.items():
+            if values[index] != self.MISSING_BOOL:
+                keys.append(column)
+        keys.extend(self.LIST_COLUMNS)
+        if self._has_extras and self._extras[index] is not None:
+            keys.extend(self._extras[index])
+        return keys
+
+
+class SiteRecord(Mapping):
+    """
+    A read only view of one record in a SiteRecordStore.
+    """
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._store._get_value(self._index, key)
+
+    def __iter__(self):
+        return iter(self._store._get_keys(self._index))
+
+    def __len__(self):
+        return len(self._store._get_keys(self._index))
+
+    def __repr__(self):
+        return "SiteRecord({0!r})".format(dict(self))
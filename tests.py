@@ -1,7 +1,46 @@
+import asyncio
+import contextlib
+import csv
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from reportbuilder import ReportBuilder, WordCountReportBuilder
-from siteretriever import ListingsRetriever, SiteRetriever
+from unittest import mock
+from reportbuilder import (ReportBuilder, WordCountReportBuilder,
+                           HeaderReportBuilder, PerformanceReportBuilder,
+                           FrequencyReportBuilder, get_required_fields)
+from reportengine import ReportEngine
+from aggregators import Aggregator, build_aggregator
+from siteretriever import ListingsRetriever, SiteRetriever, AsyncSiteRetriever
 from test_data import alexa_text, alexa_listings
+from connections import (ConnectionWarmer, DNSCache, build_session,
+                         get_connect_time, reset_connect_time)
+from apiretriever import BatchUploader
+from benchserver import (SyntheticSiteServer, LISTINGS_PATH, LOGIN_PATH,
+                         UPLOAD_PATH)
+from columnar import ColumnarReader
+from crawlstore import CrawlStore
+from endpointcache import EndpointCache
+from fragmentcache import FragmentCache
+from httpcache import ResponseCache
+from instrumentation import Histogram, Instrumentation, PHASE_COLUMNS
+import main
+from nameindex import NameCounts, NameIndex
+from parsepool import ParsePool
+from scheduler import (AdaptiveConcurrencyLimit, DeadlineExceeded,
+                       FetchScheduler, RateLimiter)
+from sitestore import SiteRecordStore
+from workqueue import CrawlCoordinator, CrawlWorker, WorkQueue
+from wordcounter import (CappedBody, count_body_words, count_words,
+                         iter_decoded)
 import requests
 import requests_mock
 from bs4 import BeautifulSoup
@@ -54,6 +93,905 @@ class BuilderTestCase(unittest.TestCase):
         wcr_table = self.wcr.build_html_table().replace("\n", "").replace(" ", "")
         self.assertEqual(wcr_table, self.wcr_table)
 
+    def test_iter_report_streams_rows(self):
+        chunks = list(self.r.iter_report("html"))
+        self.assertGreater(len(chunks), 3)
+        report = "".join(chunks).replace("\n", "").replace(" ", "")
+        self.assertEqual(report, self.plain_report)
+
+    def test_create_report_writes_streamed_report(self):
+        working_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(working_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(working_dir.name)
+        self.wcr.create_report("html")
+        with open("Word Count Report.html") as f:
+            report = f.read()
+        self.assertIn(self.wcr_table, report.replace("\n", "").replace(" ", ""))
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            self.r.build_report("pdf")
+
+    def test_required_fields_include_reduced_columns(self):
+        self.assertEqual(get_required_fields([HeaderReportBuilder([])]),
+                         {"site_name", "headers", "cookies"})
+        fields = get_required_fields([PerformanceReportBuilder([])])
+        self.assertIn(PHASE_COLUMNS["download"], fields)
+
+class AggregatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.values = list(range(1, 1001))
+        random.Random(0).shuffle(self.values)
+
+    def aggregate(self, method, values):
+        aggregator = build_aggregator(method)
+        for value in values:
+            aggregator.add(value)
+        return aggregator.result()
+
+    def test_incomplete_aggregator_cannot_be_created(self):
+        class NoResultAggregator(Aggregator):
+            def _add(self, value):
+                pass
+        with self.assertRaises(TypeError):
+            NoResultAggregator()
+
+    def test_exact_aggregators(self):
+        self.assertEqual(self.aggregate("sum", self.values), 500500)
+        self.assertEqual(self.aggregate("average", self.values), 500.5)
+        self.assertEqual(self.aggregate("min", self.values), 1)
+        self.assertEqual(self.aggregate("max", self.values), 1000)
+        self.assertEqual(self.aggregate("count", self.values), 1000)
+
+    def test_quantiles_are_approximately_right(self):
+        self.assertAlmostEqual(self.aggregate("p50", self.values), 500, delta=25)
+        self.assertAlmostEqual(self.aggregate("p95", self.values), 950, delta=25)
+        self.assertAlmostEqual(self.aggregate("p99", self.values), 990, delta=10)
+
+    def test_quantile_of_few_values_is_exact(self):
+        self.assertEqual(self.aggregate("p50", [3, 1, 2]), 2)
+
+    def test_none_values_are_skipped(self):
+        self.assertEqual(self.aggregate("average", [None, 2, 4]), 3)
+        self.assertIsNone(self.aggregate("average", []))
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            build_aggregator("median")
+
+    def test_performance_report_percentiles(self):
+        data = [{"site_name": str(value), "time_to_complete": value}
+                for value in self.values]
+        table = PerformanceReportBuilder(data).build_html_table()
+        table = table.replace("\n", "").replace(" ", "")
+        self.assertIn("<td><b>totaltimetocomplete:</b></td><td><b>500500.0</b></td>",
+                      table)
+        self.assertIn("<td><b>p99timetocomplete:</b></td>", table)
+
+    def test_rebuilding_does_not_double_count(self):
+        wcr = WordCountReportBuilder([{"site_name": "a", "word_count": 2}])
+        self.assertEqual(wcr.build_html_table(), wcr.build_html_table())
+
+class ReportEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        working_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(working_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(working_dir.name)
+        self.data = [{"site_name": "site{0}.com".format(number),
+                      "headers": ["b", "a"],
+                      "cookies": ["c"],
+                      "word_count": number * 10,
+                      "time_to_complete": number / 10}
+                     for number in range(1, 21)]
+
+    def build_builders(self):
+        return [WordCountReportBuilder(self.data),
+                HeaderReportBuilder(self.data),
+                PerformanceReportBuilder(self.data)]
+
+    def read_reports(self, builders):
+        reports = []
+        for builder in builders:
+            with open(builder.get_filename("html")) as f:
+                reports.append(f.read())
+        return reports
+
+    def sequential_reports(self):
+        builders = self.build_builders()
+        for builder in builders:
+            builder.create_report("html")
+        return self.read_reports(builders)
+
+    def test_single_pass_matches_sequential_reports(self):
+        expected = self.sequential_reports()
+        builders = self.build_builders()
+        ReportEngine(builders).create_reports(iter(self.data), "html")
+        self.assertEqual(self.read_reports(builders), expected)
+
+    def test_process_pool_matches_sequential_reports(self):
+        expected = self.sequential_reports()
+        builders = self.build_builders()
+        ReportEngine(builders, processes=2).create_reports(self.data, "html")
+        self.assertEqual(self.read_reports(builders), expected)
+
+    def test_fragment_cache_matches_sequential_reports(self):
+        expected = self.sequential_reports()
+        cache = FragmentCache("fragments")
+        for _ in range(2):
+            builders = self.build_builders()
+            ReportEngine(builders, fragment_cache=cache).create_reports(
+                                                            self.data, "html")
+            self.assertEqual(self.read_reports(builders), expected)
+        self.assertEqual(cache.stats()["hits"], 3 * len(self.data))
+
+    def test_partial_reports_are_flushed(self):
+        expected = self.sequential_reports()
+        builders = self.build_builders()
+        partial_reports = []
+
+        def stream():
+            for number, site_dict in enumerate(self.data, 1):
+                if number == 11:
+                    partial_reports.extend(self.read_reports(builders))
+                yield site_dict
+
+        ReportEngine(builders, flush_every=5).create_reports(stream(), "html")
+        self.assertEqual(self.read_reports(builders), expected)
+        self.assertIn("site10.com", partial_reports[0])
+        self.assertNotIn("site11.com", partial_reports[0])
+
+class ReportFormatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        working_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(working_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(working_dir.name)
+        self.data = [{"site_name": "apple",
+                      "headers": ["five", "four"],
+                      "cookies": [],
+                      "word_count": 42},
+                     {"site_name": "pear, nashi",
+                      "headers": ["b"],
+                      "cookies": ["oreo"],
+                      "word_count": 145}]
+
+    def read_metadata(self, builder, file_format):
+        with open(builder.get_filename(file_format) + ".meta.json") as f:
+            return json.load(f)
+
+    def test_csv_report(self):
+        builder = HeaderReportBuilder(self.data)
+        builder.create_report("csv")
+        with open(builder.get_filename("csv"), newline="") as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows, [["ranking", "site_name", "headers", "cookies"],
+                                ["1", "apple", "five;four", ""],
+                                ["2", "pear, nashi", "b", "oreo"]])
+
+    def test_jsonl_report_keeps_reduced_values_in_metadata(self):
+        builder = WordCountReportBuilder(self.data)
+        builder.create_report("jsonl")
+        with open(builder.get_filename("jsonl")) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows[1], {"ranking": 2, "site_name": "pear, nashi",
+                                   "word_count": 145})
+        self.assertEqual(self.read_metadata(builder, "jsonl")["reduced"],
+                         [{"column_name": "word_count", "method": "avg",
+                           "value": 93.5}])
+
+    def test_columnar_report_round_trips(self):
+        builder = HeaderReportBuilder(self.data)
+        builder.create_report("columnar")
+        with ColumnarReader(builder.get_filename("columnar")) as reader:
+            self.assertEqual(reader.metadata["header"], "Header Report")
+            self.assertEqual(list(reader.iter_rows()),
+                             [{"ranking": 1, "site_name": "apple",
+                               "headers": ["five", "four"], "cookies": []},
+                              {"ranking": 2, "site_name": "pear, nashi",
+                               "headers": ["b"], "cookies": ["oreo"]}])
+
+    def test_columnar_numeric_columns_are_memory_mapped(self):
+        builder = WordCountReportBuilder(self.data)
+        report = builder.build_report("columnar")
+        self.assertIsInstance(report, bytes)
+        builder.create_report("columnar")
+        with ColumnarReader(builder.get_filename("columnar")) as reader:
+            word_counts = reader.column("word_count")
+            self.assertEqual(word_counts.format, "q")
+            self.assertEqual(word_counts.tolist(), [42, 145])
+            self.assertEqual(reader.metadata["reduced"][0]["value"], 93.5)
+            word_counts.release()
+
+    def test_engine_writes_metadata(self):
+        builder = WordCountReportBuilder(self.data)
+        ReportEngine([builder]).create_reports(self.data, "csv")
+        self.assertEqual(self.read_metadata(builder, "csv")["categories"],
+                         ["site_name", "word_count"])
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        working_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(working_dir.cleanup)
+        self.working_dir = working_dir.name
+        self.store_path = os.path.join(self.working_dir, "crawl.db")
+        with CrawlStore(self.store_path) as store:
+            run_id = store.start_run()
+            for rank, site in enumerate(["a.com", "b.com"], 1):
+                store.add_site(run_id, rank,
+                               {"site_name": site, "headers": ["X-A"],
+                                "cookies": [], "word_count": rank,
+                                "time_to_complete": 0.1})
+
+    def test_reports_decide_what_is_crawled(self):
+        args = main.parse_args(["crawl-and-report", "me@example.com", "secret",
+                                "--reports", "header"])
+        fields = main.get_crawl_fields(main.get_default_builders(args.reports))
+        self.assertNotIn("word_count", fields)
+        self.assertIn("word_count", main.get_crawl_fields(
+                                                main.get_default_builders()))
+
+    def test_worker_processes_reject_unsupported_options(self):
+        for option in (["--stream"], ["--metrics", "metrics.json"]):
+            with self.assertRaises(SystemExit), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                main.parse_args(["crawl-and-report", "me@example.com",
+                                 "secret", "--worker-processes", "2"] + option)
+        args = main.parse_args(["crawl", "me@example.com", "secret",
+                                "--worker-processes", "2", "--prewarm", "5"])
+        self.assertEqual(args.prewarm, 5)
+
+    def test_report_without_a_crawl_is_a_usage_error(self):
+        missing_path = os.path.join(self.working_dir, "missing.db")
+        for command in (["report"], ["work"]):
+            with self.assertRaises(SystemExit), \
+                    contextlib.redirect_stderr(io.StringIO()) as stderr:
+                main.parse_args(command + ["--store", missing_path])
+            self.assertIn("no crawl has been saved", stderr.getvalue())
+        self.assertFalse(os.path.exists(missing_path))
+        with self.assertRaises(SystemExit), \
+                contextlib.redirect_stderr(io.StringIO()):
+            main.parse_args(["report", "--store", self.store_path,
+                             "--run-id", "missing"])
+
+    def test_old_arguments_crawl_and_report(self):
+        args = main.parse_args(["me@example.com", "secret"])
+        self.assertEqual(args.command, "crawl-and-report")
+        self.assertEqual(args.email, "me@example.com")
+
+    def test_report_skips_network_stack(self):
+        code = ("import sys, main; "
+                "main.run(main.parse_args(['report', '--format', 'csv', "
+                "'--store', {0!r}])); "
+                "print(sorted(set(sys.modules) & "
+                "{{'requests', 'bs4', 'siteretriever'}}))").format(
+                                                            self.store_path)
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=self.working_dir,
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(
+                                                os.path.abspath(__file__))),
+            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        self.assertEqual(output.splitlines()[-1], "[]")
+        with open(os.path.join(self.working_dir, "Word Count Report.csv")) as f:
+            self.assertEqual(f.read().splitlines()[1:], ["1,a.com,1",
+                                                         "2,b.com,2"])
+        self.assertTrue(os.path.exists(os.path.join(
+                            self.working_dir, "Header Frequency Report.csv")))
+
+    def test_report_from_store_with_processes(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.working_dir)
+        main.report(main.get_default_builders(), "csv",
+                    store_path=self.store_path, processes=2)
+        with open("Header Report.csv") as f:
+            self.assertEqual(len(f.read().splitlines()), 3)
+
+class FragmentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache = FragmentCache(cache_dir.name)
+        self.data = [{"site_name": "site{0}.com".format(number),
+                      "word_count": number * 10}
+                     for number in range(1, 6)]
+
+    def build(self, data):
+        builder = WordCountReportBuilder(data)
+        builder.fragment_cache = self.cache
+        return builder.build_report("html")
+
+    def test_unchanged_rows_are_not_rendered_again(self):
+        self.build(self.data)
+        self.data[2] = dict(self.data[2], word_count=1000)
+        with mock.patch.object(ReportBuilder, "_build_site_row", autospec=True,
+                               side_effect=ReportBuilder._build_site_row
+                               ) as render:
+            report = self.build(self.data)
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(report, WordCountReportBuilder(self.data)
+                                 .build_report("html"))
+        self.assertEqual(self.cache.stats()["hits"], 4)
+        self.assertEqual(self.cache.stats()["misses"], 6)
+
+    def test_reranked_rows_are_rendered_again(self):
+        self.build(self.data)
+        report = self.build(self.data[::-1])
+        self.assertEqual(report, WordCountReportBuilder(self.data[::-1])
+                                 .build_report("html"))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+class SiteRecordStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = [{"site_name": "apple",
+                      "headers": ["five", "four", "three"],
+                      "cookies": [],
+                      "word_count": 42,
+                      "time_to_complete": 0.5},
+                     {"site_name": "pear",
+                      "headers": ["five", "b"],
+                      "cookies": ["oreo"],
+                      "word_count": 145,
+                      "time_to_complete": 1.5,
+                      "truncated": True,
+                      "language": "en"}]
+        self.store = SiteRecordStore.from_dicts(self.data)
+
+    def test_records_match_dicts(self):
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual([dict(record) for record in self.store], self.data)
+        self.assertEqual(self.store[-1]["language"], "en")
+        self.assertIsNone(self.store[0].get("language"))
+
+    def test_names_are_stored_once(self):
+        self.assertEqual(len(self.store._strings), 5)
+
+    def test_report_builders_accept_store(self):
+        expected = WordCountReportBuilder(self.data).build_report("html")
+        built = WordCountReportBuilder(self.store).build_report("html")
+        self.assertEqual(built, expected)
+
+    def test_site_retriever_builds_store(self):
+        session, listings = build_mock_sites_session()
+        sr = SiteRetriever(session=session, compact=True)
+        sites_list = sr.build_sites_list(listings)
+        self.assertIsInstance(sites_list, SiteRecordStore)
+        self.assertEqual([site["word_count"] for site in sites_list], [1, 2, 3])
+
+class CrawlStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        store_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(store_dir.cleanup)
+        self.store = CrawlStore(os.path.join(store_dir.name, "crawl.db"),
+                                batch_size=2)
+        self.addCleanup(self.store.close)
+        self.session, self.listings = build_mock_sites_session()
+
+    def test_sites_are_stored_in_ranking_order(self):
+        sr = SiteRetriever(max_workers=4, session=self.session,
+                           store=self.store)
+        sites_list = sr.build_sites_list(self.listings)
+        stored_sites = self.store.sites(sr.run_id)
+        self.assertEqual(len(stored_sites), 3)
+        self.assertEqual(list(stored_sites), sites_list)
+
+    def test_resumed_run_skips_stored_sites(self):
+        run_id = self.store.start_run()
+        self.store.add_site(run_id, 1, {"site_name": "a.com", "headers": [],
+                                        "cookies": [], "word_count": 99})
+        sr = SiteRetriever(session=self.session, store=self.store,
+                           run_id=run_id)
+        sites_list = sr.build_sites_list(self.listings)
+        self.assertEqual([site["word_count"] for site in sites_list],
+                         [99, 2, 3])
+        self.assertEqual(self.store.get_runs(), [run_id])
+
+    def test_report_builders_read_from_store(self):
+        sr = SiteRetriever(session=self.session, store=self.store)
+        sites_list = sr.build_sites_list(self.listings)
+        expected = WordCountReportBuilder(sites_list).build_report("html")
+        built = WordCountReportBuilder(
+            self.store.sites(sr.run_id)).build_report("html")
+        self.assertEqual(built, expected)
+
+class WorkQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        store_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(store_dir.cleanup)
+        self.path = os.path.join(store_dir.name, "crawl.db")
+        self.queue = WorkQueue(self.path)
+        self.addCleanup(self.queue.close)
+        self.queue.enqueue("run", ["a.com", "b.com", "c.com"])
+
+    def test_leases_are_exclusive_until_they_expire(self):
+        self.queue.lease_seconds = -1
+        self.assertEqual(self.queue.lease("run", "w1", 2),
+                         [(1, "a.com"), (2, "b.com")])
+        self.queue.lease_seconds = 60
+        self.assertEqual(self.queue.lease("run", "w2", 3),
+                         [(1, "a.com"), (2, "b.com"), (3, "c.com")])
+        self.assertEqual(self.queue.lease("run", "w3", 3), [])
+        self.assertEqual(self.queue.complete("run", "w1", [1, 2]), 0)
+        self.assertEqual(self.queue.complete("run", "w2", [1, 2]), 2)
+        self.assertEqual(self.queue.counts("run")["done"], 2)
+
+    def test_sites_fail_after_max_attempts(self):
+        self.queue.lease_seconds = -1
+        self.queue.max_attempts = 2
+        for _ in range(2):
+            self.queue.lease("run", "w1", 3)
+        self.assertEqual(self.queue.lease("run", "w1", 3), [])
+        self.assertEqual(self.queue.counts("run")["failed"], 3)
+        self.assertTrue(self.queue.is_finished("run"))
+
+    def test_renewed_leases_are_not_handed_out(self):
+        self.queue.lease_seconds = 0.2
+        self.queue.lease("run", "w1", 2)
+        time.sleep(0.1)
+        self.assertEqual(self.queue.renew("run", "w1", [1, 2]), 2)
+        time.sleep(0.15)
+        self.assertEqual(self.queue.lease("run", "w2", 3), [(3, "c.com")])
+        self.assertEqual(self.queue.renew("run", "w1", [3]), 0)
+
+    def test_worker_renews_leases_while_crawling(self):
+        session, listings = build_mock_sites_session()
+        adapter = session.get_adapter("http://a.com")
+
+        def slow_page(request, context):
+            time.sleep(0.5)
+            return "word"
+        adapter.register_uri('GET', 'http://a.com', text=slow_page)
+        with CrawlCoordinator(self.path) as coordinator:
+            run_id = coordinator.start(listings)
+            worker = CrawlWorker(self.path, run_id, batch_size=4,
+                                 lease_seconds=0.3, session=session,
+                                 max_workers=1)
+            self.addCleanup(worker.close)
+            thread = threading.Thread(target=worker.run)
+            thread.start()
+            time.sleep(0.4)
+            stolen = coordinator.queue.lease(run_id, "other", 4)
+            thread.join()
+            self.assertEqual(stolen, [])
+            self.assertGreater(worker.lease_renewals, 0)
+
+    def test_drain_crawls_sites_of_a_dead_worker(self):
+        session, listings = build_mock_sites_session()
+        with CrawlCoordinator(self.path, lease_seconds=0.2) as coordinator:
+            run_id = coordinator.start(listings)
+            coordinator.queue.lease(run_id, "dead", 4)
+            self.assertFalse(coordinator.wait(run_id, poll_interval=0.05,
+                                              timeout=0.1))
+            coordinator.drain(run_id, poll_interval=0.05, session=session,
+                              max_workers=1)
+            progress = coordinator.progress(run_id)
+            self.assertEqual((progress["done"], progress["failed"]), (3, 1))
+            self.assertTrue(coordinator.wait(run_id, timeout=0))
+
+    def test_workers_merge_results_in_ranking_order(self):
+        session, listings = build_mock_sites_session()
+        with CrawlCoordinator(self.path) as coordinator:
+            run_id = coordinator.start(listings[::-1])
+            workers = [CrawlWorker(self.path, run_id, batch_size=1,
+                                   session=session, max_workers=2)
+                       for _ in range(2)]
+            threads = [threading.Thread(target=worker.run)
+                       for worker in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for worker in workers:
+                worker.close()
+            self.assertTrue(coordinator.wait(run_id, timeout=0))
+            progress = coordinator.progress(run_id)
+            self.assertEqual((progress["done"], progress["failed"]), (3, 1))
+            self.assertEqual(sum(worker.sites_crawled for worker in workers), 3)
+            self.assertEqual(sum(worker.sites_failed for worker in workers), 1)
+            sites = coordinator.sites(run_id)
+            self.assertEqual([site["site_name"] for site in sites],
+                             ["c.com", "b.com", "a.com"])
+            self.assertIn("<td><b>2.0</b></td>",
+                          WordCountReportBuilder(sites).build_report("html")
+                          .replace("\n", "").replace(" ", ""))
+
+class NameIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = NameIndex.from_sites([
+            {"site_name": "a.com", "headers": ["Content-Type", "X-Powered-By"],
+             "cookies": ["sid"]},
+            {"site_name": "b.com", "headers": ["content-type", "x-powered-by",
+                                               "X-Cache"],
+             "cookies": ["sid", "pref"]},
+            {"site_name": "c.com", "headers": ["X-Cache"], "cookies": []}])
+
+    def test_most_common_excludes_typical_headers(self):
+        self.assertEqual(self.index.most_common("headers"),
+                         [("x-cache", 2), ("x-powered-by", 2)])
+        self.assertEqual(self.index.most_common("headers", top_k=1,
+                                                exclude=[]),
+                         [("content-type", 2)])
+
+    def test_sites_with(self):
+        self.assertEqual(self.index.sites_with("headers", "X-CACHE"),
+                         ["b.com", "c.com"])
+        self.assertEqual(self.index.sites_with("cookies", "pref"), ["b.com"])
+        self.assertEqual(self.index.count("cookies", "missing"), 0)
+
+    def test_frequency_report(self):
+        builder = FrequencyReportBuilder(self.index, "cookies")
+        table = builder.build_html_table().replace("\n", "").replace(" ", "")
+        self.assertEqual(builder.header, "Cookie Frequency Report")
+        self.assertIn("<tr><td>1</td><td>sid</td><td>2</td><td>66.7</td></tr>",
+                      table)
+
+    def test_counts_match_index(self):
+        counts = NameCounts.from_sites([
+            {"site_name": "a.com", "headers": ["Content-Type", "X-Powered-By"],
+             "cookies": ["sid"]},
+            {"site_name": "b.com", "headers": ["content-type", "x-powered-by",
+                                               "X-Cache"],
+             "cookies": ["sid", "pref"]},
+            {"site_name": "c.com", "headers": ["X-Cache"], "cookies": []}])
+        for kind in NameIndex.KINDS:
+            self.assertEqual(counts.most_common(kind, None),
+                             self.index.most_common(kind, None))
+        self.assertEqual(counts.count("headers", "X-CACHE"), 2)
+        self.assertEqual(counts.site_count, 3)
+        self.assertFalse(hasattr(counts, "sites_with"))
+
+    def test_site_retriever_fills_index(self):
+        session, listings = build_mock_sites_session()
+        index = NameIndex()
+        SiteRetriever(session=session, index=index).build_sites_list(listings)
+        self.assertEqual(index.site_count, 3)
+        self.assertEqual(index.count("headers", "headerkey"), 3)
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        session, self.listings = build_mock_sites_session()
+        self.instrumentation = Instrumentation()
+        self.sr = SiteRetriever(session=session,
+                                instrumentation=self.instrumentation)
+
+    def test_phase_timings_are_floats(self):
+        sites_list = self.sr.build_sites_list(self.listings)
+        for site in sites_list:
+            for column in PHASE_COLUMNS.values():
+                self.assertIsInstance(site[column], float)
+
+    def test_sites_and_errors_are_counted(self):
+        self.sr.build_sites_list(self.listings)
+        metrics = self.instrumentation.to_dict()
+        self.assertEqual(metrics["sites"], 3)
+        self.assertEqual(metrics["errors"], {"ConnectionError": 1})
+        self.assertEqual(metrics["phases"]["total"]["count"], 3)
+
+    def test_prometheus_export(self):
+        self.sr.build_sites_list(self.listings)
+        text = self.instrumentation.to_prometheus()
+        self.assertIn("siteretriever_sites_total 3", text)
+        self.assertIn('siteretriever_phase_seconds_count{phase="parse"} 3', text)
+        self.assertIn('siteretriever_errors_total{error="ConnectionError"} 1',
+                      text)
+
+    def test_histogram_quantile(self):
+        histogram = Histogram(buckets=(1, 2, 3))
+        for value in [0.5, 1.5, 1.5, 2.5]:
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 1.5)
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_connect_time_is_measured(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0),
+                                        http.server.SimpleHTTPRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        session = build_session(1)
+        reset_connect_time()
+        session.get("http://127.0.0.1:{0}/".format(server.server_port))
+        self.assertGreater(get_connect_time(), 0)
+
+class ConnectionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SyntheticSiteServer(num_sites=5, page_words=5).start()
+        self.addCleanup(self.server.stop)
+        self.dns_cache = DNSCache()
+
+    def test_dns_cache_reuses_addresses_until_ttl(self):
+        address = self.dns_cache.resolve("localhost", 80)
+        self.assertEqual(self.dns_cache.resolve("localhost", 80), address)
+        self.assertEqual(self.dns_cache.stats()["hits"], 1)
+        expiring_cache = DNSCache(ttl=0)
+        for _ in range(2):
+            expiring_cache.resolve("localhost", 80)
+        self.assertEqual(expiring_cache.stats()["misses"], 2)
+
+    def test_session_connects_through_dns_cache(self):
+        session = build_session(1, dns_cache=self.dns_cache)
+        url = "http://" + self.server.site_name(1)
+        for _ in range(2):
+            self.assertEqual(session.get(url).status_code, 200)
+        self.assertEqual(self.dns_cache.stats()["misses"], 1)
+
+    def test_warmed_connection_takes_connect_off_the_request(self):
+        session = build_session(1, dns_cache=self.dns_cache)
+        url = "http://" + self.server.site_name(1)
+        warmer = ConnectionWarmer(session, ahead=1)
+        warmer.add(url)
+        warmer.close()
+        self.assertEqual(warmer.warmed, 1)
+        reset_connect_time()
+        self.assertEqual(session.get(url).status_code, 200)
+        self.assertEqual(get_connect_time(), 0)
+
+    def test_prewarming_keeps_results(self):
+        listings = [self.server.site_name(rank) for rank in range(1, 6)]
+        sr = SiteRetriever(max_workers=2, prewarm=2)
+        sites_list = sr.build_sites_list(listings)
+        self.assertEqual([site["site_name"] for site in sites_list], listings)
+        self.assertGreater(sr.dns_cache.stats()["hits"], 0)
+
+class SyntheticSiteServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SyntheticSiteServer(num_sites=30, page_words=50,
+                                          num_headers=2, num_cookies=1,
+                                          error_rate=0.2).start()
+        self.addCleanup(self.server.stop)
+
+    def test_retrievers_run_against_server(self):
+        lr = ListingsRetriever("me@me.com", "secret", num_sites=30)
+        lr.BASE_URL = self.server.base_url + LISTINGS_PATH
+        lr.LOGIN_URL = self.server.base_url + LOGIN_PATH
+        listings = lr.get_listings()
+        self.assertEqual(listings[0], self.server.site_name(1))
+        self.assertEqual(len(listings), 30)
+
+        sites_list = SiteRetriever(max_workers=4).build_sites_list(listings)
+        failures = [rank for rank in range(1, 31)
+                    if self.server.site_behaviour(rank)[0] != "ok"]
+        self.assertEqual(len(sites_list), 30 - len(failures))
+        self.assertEqual(sites_list[0]["word_count"], 50 + 1)
+        self.assertIn("cookie_0", sites_list[0]["cookies"])
+
+    def test_header_only_crawl_leaves_no_tracebacks(self):
+        server = SyntheticSiteServer(num_sites=3, page_words=200000).start()
+        listings = [server.site_name(rank) for rank in range(1, 4)]
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            SiteRetriever(fields={"site_name", "headers"}).build_sites_list(
+                                                                    listings)
+            server.stop()
+        self.assertNotIn("Traceback", stderr.getvalue())
+
+class BatchUploaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SyntheticSiteServer().start()
+        self.addCleanup(self.server.stop)
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        self.checkpoint_path = os.path.join(checkpoint_dir.name, "upload.json")
+        self.sites = [{"site_name": "site{0}.com".format(number),
+                       "headers": ["X-A"], "cookies": [],
+                       "word_count": number}
+                      for number in range(10)]
+
+    def build_uploader(self, **kwargs):
+        return BatchUploader(self.server.base_url + UPLOAD_PATH, batch_size=4,
+                             checkpoint_path=self.checkpoint_path,
+                             scheduler=FetchScheduler(retries=2, backoff=0),
+                             **kwargs)
+
+    def uploaded_sites(self):
+        return sorted((site for sites in self.server.uploads.values()
+                       for site in sites), key=lambda site: site["word_count"])
+
+    def test_sites_are_uploaded_in_compressed_batches(self):
+        self.assertEqual(self.build_uploader().upload(iter(self.sites)), 3)
+        self.assertEqual(len(self.server.uploads), 3)
+        self.assertEqual(self.uploaded_sites(), self.sites)
+
+    def test_failed_batches_are_retried(self):
+        self.server.failing_uploads = 2
+        uploader = self.build_uploader(max_in_flight=1)
+        uploader.upload(self.sites)
+        self.assertEqual(uploader.retries, 2)
+        self.assertEqual(self.uploaded_sites(), self.sites)
+
+    def interrupted_sites(self, sites):
+        yield from sites[:8]
+        raise KeyboardInterrupt
+
+    def test_interrupted_upload_resumes_from_checkpoint(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.build_uploader().upload(self.interrupted_sites(self.sites),
+                                         source="run-1")
+        uploader = self.build_uploader()
+        self.assertEqual(uploader.upload(self.sites, source="run-1"), 1)
+        self.assertEqual(uploader.skipped, 2)
+        self.assertEqual(self.server.upload_requests, 3)
+        self.assertEqual(self.uploaded_sites(), self.sites)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_uploads_without_a_source_start_over(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.build_uploader().upload(self.interrupted_sites(self.sites))
+        other_sites = [dict(site, site_name="other" + site["site_name"])
+                       for site in self.sites]
+        uploader = self.build_uploader()
+        self.assertEqual(uploader.upload(other_sites), 3)
+        self.assertEqual(uploader.skipped, 0)
+        self.assertEqual(len(self.uploaded_sites()), 18)
+
+    def test_resuming_a_source_ignores_changed_contents(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.build_uploader().upload(self.interrupted_sites(self.sites),
+                                         source="run-1")
+        timed_sites = [dict(site, total_seconds=0.5) for site in self.sites]
+        uploader = self.build_uploader()
+        self.assertEqual(uploader.upload(timed_sites, source="run-1"), 1)
+        self.assertEqual(uploader.skipped, 2)
+        other_source = self.build_uploader()
+        self.assertEqual(other_source.upload(self.sites, source="run-2"), 3)
+        self.assertEqual(other_source.skipped, 0)
+
+    def test_upload_error_is_raised(self):
+        self.server.failing_uploads = 100
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.build_uploader().upload(self.sites)
+
+class SlowBodyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves /trickle a byte at a time,
+    cuts /drop off partway through its body,
+    and serves any other path in full.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "1000")
+        self.end_headers()
+        try:
+            if self.path.startswith("/trickle"):
+                for _ in range(1000):
+                    self.wfile.write(b"w")
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            elif self.path.startswith("/drop"):
+                self.wfile.write(b"word " * 20)
+                self.close_connection = True
+            else:
+                self.wfile.write(b"word " * 200)
+        except OSError:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+def start_slow_body_server(test_case):
+    """
+    Start a SlowBodyHandler server for a test and return its host.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                             SlowBodyHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return "127.0.0.1:{0}".format(server.server_port)
+
+class FetchSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = requests_mock.Adapter()
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+
+    def test_transient_failures_are_retried(self):
+        self.adapter.register_uri('GET', 'http://flaky.com', [
+            {"exc": requests.exceptions.ConnectionError},
+            {"status_code": 503},
+            {"text": "finally"}])
+        scheduler = FetchScheduler(retries=2, backoff=0)
+        retried = []
+        response = scheduler.fetch(self.session, "http://flaky.com",
+                                   on_retry=retried.append)
+        self.assertEqual(response.text, "finally")
+        self.assertEqual(len(retried), 2)
+
+    def test_requests_have_timeouts(self):
+        self.adapter.register_uri('GET', 'http://a.com', text="ok")
+        scheduler = FetchScheduler(connect_timeout=1, read_timeout=2)
+        scheduler.fetch(self.session, "http://a.com")
+        self.assertEqual(self.adapter.last_request.timeout, (1, 2))
+
+    def test_ssl_errors_are_not_retried(self):
+        self.adapter.register_uri('GET', 'http://a.com',
+                                  exc=requests.exceptions.SSLError)
+        scheduler = FetchScheduler(retries=2, backoff=0)
+        with self.assertRaises(requests.exceptions.SSLError):
+            scheduler.fetch(self.session, "http://a.com")
+        self.assertEqual(self.adapter.call_count, 1)
+
+    def test_deadline_skips_remaining_sites(self):
+        session, listings = build_mock_sites_session()
+        scheduler = FetchScheduler(deadline=0)
+        sr = SiteRetriever(session=session, scheduler=scheduler)
+        self.assertEqual(sr.build_sites_list(listings), [])
+        self.assertEqual(sr.instrumentation.errors["DeadlineExceeded"], 4)
+
+    def test_hung_site_is_bounded_by_read_timeout(self):
+        server = SyntheticSiteServer(num_sites=1, latency=2).start()
+        self.addCleanup(server.stop)
+        scheduler = FetchScheduler(read_timeout=0.2, retries=0)
+        sr = SiteRetriever(scheduler=scheduler)
+        start = time.monotonic()
+        self.assertEqual(sr.build_sites_list([server.site_name(1)]), [])
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_deadline_bounds_body_reads(self):
+        host = start_slow_body_server(self)
+        scheduler = FetchScheduler(deadline=1.0, read_timeout=0.5, retries=0,
+                                   max_concurrency=4)
+        sr = SiteRetriever(max_workers=2, scheduler=scheduler)
+        start = time.monotonic()
+        sites_list = sr.build_sites_list([host + "/trickle1",
+                                          host + "/trickle2"])
+        self.assertLess(time.monotonic() - start, 2.0)
+        self.assertEqual(sites_list, [])
+        self.assertEqual(sr.instrumentation.errors["DeadlineExceeded"], 2)
+        self.assertEqual(scheduler.concurrency.in_flight, 0)
+        self.assertLess(scheduler.concurrency.limit, 4)
+
+    def test_body_cut_off_midway_skips_only_that_site(self):
+        host = start_slow_body_server(self)
+        sr = SiteRetriever(max_workers=2,
+                           scheduler=FetchScheduler(retries=0))
+        sites_list = sr.build_sites_list([host + "/a", host + "/drop",
+                                          host + "/b"])
+        self.assertEqual([site["word_count"] for site in sites_list],
+                         [200, 200])
+        self.assertEqual(sr.instrumentation.errors["ChunkedEncodingError"], 1)
+
+    def test_adaptive_limit(self):
+        limit = AdaptiveConcurrencyLimit(8, minimum=2, latency_target=1)
+        limit.acquire()
+        limit.release(5, timed_out=True)
+        self.assertEqual(limit.limit, 4)
+        for _ in range(8):
+            limit.acquire()
+            limit.release(0.1)
+        self.assertGreater(limit.limit, 5)
+        self.assertLessEqual(limit.limit, 8)
+        limit.limit = 2
+        for _ in range(3):
+            limit.acquire()
+            limit.release(5, timed_out=True)
+        self.assertEqual(limit.limit, 2)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        with self.assertRaises(DeadlineExceeded):
+            limiter.acquire(deadline=time.monotonic())
+
 class ListingsRetrieverTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -68,6 +1006,25 @@ class ListingsRetrieverTestCase(unittest.TestCase):
         scrubbed_listings = self.lr._scrub_listings(self.soupy_listings)
         self.assertEqual(scrubbed_listings, alexa_listings)
 
+    def test_get_listings_fetches_pages_concurrently(self):
+        lr = ListingsRetriever("me@me.com", "secret", num_sites=75)
+        with requests_mock.Mocker() as m:
+            m.post(lr.LOGIN_URL, text="")
+            for number in range(lr.num_pages):
+                m.get(lr.BASE_URL + str(number), text=alexa_text)
+            listings = lr.get_listings()
+        self.assertEqual(listings, alexa_listings + alexa_listings[:25])
+
+    def test_iter_listings_matches_get_listings(self):
+        lr = ListingsRetriever("me@me.com", "secret", num_sites=75)
+        with requests_mock.Mocker() as m:
+            m.post(lr.LOGIN_URL, text="")
+            for number in range(lr.num_pages):
+                m.get(lr.BASE_URL + str(number), text=alexa_text)
+            listings = list(lr.iter_listings())
+        self.assertEqual(listings, alexa_listings + alexa_listings[:25])
+        self.assertIsNone(lr.listings)
+
 class SiteRetrieverTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -92,13 +1049,339 @@ class SiteRetrieverTestCase(unittest.TestCase):
     def test_build_site_dictionary(self):
         generated_dict = self.sr._build_site_dictionary(self.resp, "google.com")
         # using assertIn instead of assertEqual
-        # because the timethis decorator adds a dynamic value to the dictionary.
-        # could have also deleted or overwritten 'time_to_complete'
+        # because the retriever adds dynamic timing values to the dictionary.
+        # could have also deleted or overwritten them.
         self.assertIn(("site_name", 'google.com'), generated_dict.items())
         self.assertIn(("headers", ['headerkey']), generated_dict.items())
         self.assertIn(("cookies", ['choc_chip']), generated_dict.items())
         self.assertIn(("word_count", 2), generated_dict.items())
 
+    def test_body_size_cap_truncates_page(self):
+        session, listings = build_mock_sites_session()
+        sr = SiteRetriever(session=session, max_body_size=9)
+        sites_list = sr.build_sites_list(listings)
+        self.assertEqual([site["word_count"] for site in sites_list],
+                         [1, 2, 2])
+        self.assertEqual([site["truncated"] for site in sites_list],
+                         [False, False, True])
+
+    def test_header_only_fields_skip_the_body(self):
+        session, listings = build_mock_sites_session()
+        fields = get_required_fields([HeaderReportBuilder([])])
+        sr = SiteRetriever(session=session, fields=fields)
+        with mock.patch.object(sr, "_open_body") as open_body:
+            sites_list = sr.build_sites_list(listings)
+        open_body.assert_not_called()
+        self.assertEqual([site["headers"] for site in sites_list],
+                         [["headerkey"]] * 3)
+        self.assertEqual([site["word_count"] for site in sites_list],
+                         [None] * 3)
+
+def build_mock_sites_session():
+    """
+    Return a session serving three small sites and one unreachable site,
+    along with the listings for them.
+    """
+    adapter = requests_mock.Adapter()
+    for word_count, site in enumerate(["a.com", "b.com", "c.com"], 1):
+        adapter.register_uri('GET',
+                             'http://' + site,
+                             headers={"headerkey": "someval"},
+                             text=" ".join(["word"] * word_count))
+    adapter.register_uri('GET', 'http://down.com',
+                         exc=requests.exceptions.ConnectionError)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    listings = ["a.com", "down.com", "b.com", "c.com"]
+    return session, listings
+
+class WordCounterTestCase(unittest.TestCase):
+
+    @staticmethod
+    def soup_count(text):
+        return len(BeautifulSoup(text, 'html.parser').get_text().split())
+
+    def test_matches_soup_count_on_alexa_text(self):
+        chunks = (alexa_text[i:i + 100] for i in range(0, len(alexa_text), 100))
+        self.assertEqual(count_words(chunks), self.soup_count(alexa_text))
+
+    def test_words_split_across_chunks_and_tags(self):
+        text = "<p>one tw</p>o<!-- not counted --> three<script>x y</script>"
+        chunks = [text[i:i + 3] for i in range(0, len(text), 3)]
+        self.assertEqual(count_words(chunks), 3)
+        self.assertEqual(count_words(chunks), self.soup_count(text))
+
+    def test_multibyte_characters_split_across_chunks(self):
+        body = "caf\u00e9 cr\u00e8me".encode("utf-8")
+        chunks = [body[i:i + 1] for i in range(len(body))]
+        self.assertEqual(count_words(iter_decoded(chunks, "utf-8")), 2)
+
+    def test_capped_body_stops_at_max_size(self):
+        page = mock.Mock()
+        page.iter_content.return_value = iter([b"abcd", b"efgh", b"ijkl"])
+        body = CappedBody(page, max_size=6)
+        self.assertEqual(list(body), [b"abcd", b"ef"])
+        self.assertTrue(body.truncated)
+        self.assertEqual(body.size, 6)
+        page.close.assert_called_once_with()
+
+    def test_prefetch_holds_a_bounded_part_of_the_body(self):
+        page = mock.Mock()
+        page.iter_content.return_value = iter([b"abcd", b"efgh", b"ijkl"])
+        body = CappedBody(page)
+        self.assertFalse(body.prefetch(5))
+        self.assertEqual(body.size, 8)
+        self.assertEqual(b"".join(body), b"abcdefghijkl")
+        small = CappedBody(mock.Mock(**{"iter_content.return_value":
+                                        iter([b"ab", b"cd"])}))
+        self.assertTrue(small.prefetch(5))
+        self.assertEqual(small.hexdigest(), hashlib.sha1(b"abcd").hexdigest())
+        self.assertEqual(list(small), [b"ab", b"cd"])
+
+    def test_count_body_words_matches_count_words(self):
+        body = alexa_text.encode("utf-8")
+        self.assertEqual(count_body_words(body, "utf-8", chunk_size=100),
+                         self.soup_count(alexa_text))
+
+class EndpointCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.path = os.path.join(cache_dir.name, "endpoints.json")
+        self.adapter = requests_mock.Adapter()
+        self.adapter.register_uri('GET', 'http://a.com', status_code=301,
+                                  headers={"Location": "https://www.a.com/"})
+        self.adapter.register_uri('GET', 'https://www.a.com/', text="a page")
+        self.adapter.register_uri('GET', 'http://b.com',
+                                  exc=requests.exceptions.SSLError)
+        self.adapter.register_uri('GET', 'http://www.b.com', status_code=302,
+                                  headers={"Location": "https://www.b.com/"})
+        self.adapter.register_uri('GET', 'https://www.b.com/', text="b page")
+        self.adapter.register_uri('GET', 'https://old.a.com/',
+                                  exc=requests.exceptions.ConnectionError)
+        self.adapter.register_uri('GET', 'https://old.b.com/',
+                                  exc=requests.exceptions.ReadTimeout)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def crawl(self, cache):
+        sr = SiteRetriever(session=self.session, endpoint_cache=cache)
+        return sr.build_sites_list(["a.com", "b.com"])
+
+    def requested_urls(self):
+        return [request.url for request in self.adapter.request_history]
+
+    def test_later_crawls_go_straight_to_learned_urls(self):
+        first = self.crawl(EndpointCache(self.path))
+        self.assertEqual(len(self.requested_urls()), 5)
+        self.adapter.reset()
+        cache = EndpointCache(self.path)
+        second = self.crawl(cache)
+        self.assertEqual(self.requested_urls(),
+                         ["https://www.a.com/", "https://www.b.com/"])
+        self.assertEqual([site["word_count"] for site in second],
+                         [site["word_count"] for site in first])
+        self.assertEqual(cache.stats()["round_trips_saved"], 3)
+
+    def test_failing_url_is_resolved_again(self):
+        cache = EndpointCache(self.path)
+        cache.learn("a.com", "https://old.a.com/", 1)
+        sites_list = self.crawl(cache)
+        self.assertEqual(sites_list[0]["word_count"], 2)
+        self.assertEqual(cache.lookup("a.com"), "https://www.a.com/")
+        self.assertEqual(cache.stats()["failures"], 1)
+
+    def test_timed_out_url_is_resolved_again(self):
+        cache = EndpointCache(self.path)
+        cache.learn("b.com", "https://old.b.com/", 1)
+        self.assertEqual(cache.peek("b.com"), "https://old.b.com/")
+        self.assertEqual(cache.stats()["hits"], 0)
+        sites_list = self.crawl(cache)
+        self.assertEqual(sites_list[1]["word_count"], 2)
+        self.assertEqual(cache.lookup("b.com"), "https://www.b.com/")
+        self.assertEqual(cache.stats()["failures"], 1)
+
+    def test_stale_url_is_refreshed_in_background(self):
+        cache = EndpointCache(self.path, max_age=0)
+        cache.learn("a.com", "https://www.a.com/", 2)
+        self.crawl(cache)
+        self.assertEqual(cache.stats()["refreshes"], 1)
+        self.assertIn("http://a.com/", self.requested_urls())
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.cache_dir.name)
+
+        def etag_page(request, context):
+            context.headers["ETag"] = '"v1"'
+            if request.headers.get("If-None-Match") == '"v1"':
+                context.status_code = 304
+                return ""
+            return "three little words"
+
+        adapter = requests_mock.Adapter()
+        adapter.register_uri('GET', 'http://etag.com', text=etag_page)
+        adapter.register_uri('GET', 'http://plain.com', text="just two")
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def retrieve(self, site):
+        sr = SiteRetriever(session=self.session, cache=self.cache)
+        return sr._retrieve_site(site)
+
+    def test_not_modified_reuses_cached_data(self):
+        first = self.retrieve("etag.com")
+        second = self.retrieve("etag.com")
+        self.assertEqual(second["word_count"], 3)
+        self.assertEqual(second["headers"], first["headers"])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_unchanged_body_reuses_word_count(self):
+        self.retrieve("plain.com")
+        with mock.patch.object(SiteRetriever, "_get_wordcount") as wordcount:
+            site_dict = self.retrieve("plain.com")
+        wordcount.assert_not_called()
+        self.assertEqual(site_dict["word_count"], 2)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_large_bodies_are_not_held_to_fingerprint(self):
+        self.cache.max_body_size = 4
+        self.retrieve("plain.com")
+        with mock.patch.object(SiteRetriever, "_get_wordcount",
+                               return_value=2) as wordcount:
+            self.retrieve("plain.com")
+        wordcount.assert_called_once()
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_changed_body_is_counted_again(self):
+        self.retrieve("plain.com")
+        self.session.get_adapter("http://plain.com").register_uri(
+            'GET', 'http://plain.com', text="now three words")
+        site_dict = self.retrieve("plain.com")
+        self.assertEqual(site_dict["word_count"], 3)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+        self.assertEqual(self.retrieve("plain.com")["word_count"], 3)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_evict_enforces_max_size(self):
+        self.retrieve("plain.com")
+        self.retrieve("etag.com")
+        self.cache.max_size = 0
+        self.cache.evict()
+        self.assertEqual(self.cache.conditional_headers("etag.com"), {})
+
+class ConcurrentSiteRetrieverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        session, self.listings = build_mock_sites_session()
+        self.sr = SiteRetriever(max_workers=4, session=session)
+
+    def test_build_sites_list_keeps_listing_order(self):
+        sites_list = self.sr.build_sites_list(self.listings)
+        self.assertEqual([site["site_name"] for site in sites_list],
+                         ["a.com", "b.com", "c.com"])
+        self.assertEqual([site["word_count"] for site in sites_list],
+                         [1, 2, 3])
+
+    def test_build_sites_list_times_each_site(self):
+        sites_list = self.sr.build_sites_list(self.listings)
+        for site in sites_list:
+            self.assertIn("time_to_complete", site)
+
+    def test_parse_pool_keeps_listing_order(self):
+        self.sr.parse_pool = ParsePool(processes=2, max_pending=2)
+        sites_list = self.sr.build_sites_list(self.listings)
+        self.assertEqual([site["word_count"] for site in sites_list],
+                         [1, 2, 3])
+        self.assertIsNone(self.sr.parse_pool._executor)
+
+    def test_iter_sites_reads_listings_as_needed(self):
+        read = []
+
+        def listings():
+            for site in self.listings:
+                read.append(site)
+                yield site
+
+        sites = self.sr.iter_sites(listings(), window=1)
+        self.assertEqual(next(sites)["site_name"], "a.com")
+        self.assertEqual(read, ["a.com"])
+        self.assertEqual([site["word_count"] for site in sites], [2, 3])
+
+class AsyncSiteRetrieverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        session, self.listings = build_mock_sites_session()
+        self.sr = AsyncSiteRetriever(max_in_flight=2, session=session)
+
+    def test_build_sites_list_keeps_listing_order(self):
+        sites_list = asyncio.run(self.sr.build_sites_list(self.listings))
+        self.assertEqual([site["site_name"] for site in sites_list],
+                         ["a.com", "b.com", "c.com"])
+
+    def test_iter_sites_skips_inaccessible_sites(self):
+        async def collect():
+            return [site async for site in self.sr.iter_sites(self.listings)]
+        sites_list = asyncio.run(collect())
+        self.assertEqual(sorted(site["site_name"] for site in sites_list),
+                         ["a.com", "b.com", "c.com"])
+
+    def test_iter_sites_starts_at_most_max_in_flight(self):
+        read = []
+        finished = []
+        self.sr._finish_run = lambda: finished.append(True)
+
+        def listings():
+            for site in ["a.com", "b.com", "c.com"]:
+                read.append(site)
+                yield site
+
+        async def first_site():
+            sites = self.sr.iter_sites(listings())
+            site = await sites.__anext__()
+            await sites.aclose()
+            return site
+        self.assertIn(asyncio.run(first_site())["site_name"],
+                      ["a.com", "b.com"])
+        self.assertEqual(read, ["a.com", "b.com"])
+        self.assertEqual(finished, [True])
+
+    def test_sites_in_flight_are_stored_when_stopped_early(self):
+        store_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(store_dir.cleanup)
+        store = CrawlStore(os.path.join(store_dir.name, "crawl.db"))
+        self.addCleanup(store.close)
+
+        def slow_page(request, context):
+            time.sleep(0.3)
+            return "two words"
+        session = self.sr.session
+        session.get_adapter("http://b.com").register_uri(
+            'GET', 'http://b.com', text=slow_page)
+        sr = AsyncSiteRetriever(max_in_flight=2, session=session, store=store)
+
+        async def first_site():
+            sites = sr.iter_sites(["a.com", "b.com", "c.com"])
+            site = await sites.__anext__()
+            await sites.aclose()
+            return site
+        self.assertEqual(asyncio.run(first_site())["site_name"], "a.com")
+        self.assertEqual([site["site_name"] for site in store.sites(sr.run_id)],
+                         ["a.com", "b.com"])
+
+    def test_results_accepted_by_report_builder(self):
+        sites_list = asyncio.run(self.sr.build_sites_list(self.listings))
+        table = WordCountReportBuilder(sites_list).build_html_table()
+        self.assertIn("<td><b>2.0</b></td>", table.replace("\n", "").replace(" ", ""))
+
 
 
 
@@ -0,0 +1,238 @@
+import codecs
+import hashlib
+from collections import deque
+from html.parser import HTMLParser
+import time
+
+
+class StreamingWordCounter(HTMLParser):
+    """
+    Count the words on a page without building a DOM.
+
+    Feed the page in chunks of any size with feed(),
+    then call close() and read word_count.
+    Only the words in the current chunk are held in memory.
+
+    The count matches BeautifulSoup(text, 'html.parser').get_text().split():
+    comments, declarations and processing instructions are ignored,
+    as is text inside script, style and template tags.
+    Text on either side of a tag is joined,
+    so a word split by markup is counted once.
+    """
+    SKIPPED_TAGS = frozenset(["script", "style", "template"])
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.word_count = 0
+        self._in_word = False
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._count(data)
+
+    def unknown_decl(self, data):
+        if data.startswith("CDATA["):
+            self._count(data[len("CDATA["):])
+
+    def _count(self, text):
+        """
+        Add the words in text to the running count.
+
+        A word that continues one from the previous text is not recounted.
+        """
+        if not text:
+            return
+        words = len(text.split())
+        if self._in_word and not text[0].isspace():
+            words -= 1
+        self.word_count += words
+        self._in_word = not text[-1].isspace()
+
+
+def count_words(chunks):
+    """
+    Return the number of words in an html document.
+
+    chunks: an iterable of strings that make up the document.
+    """
+    counter = StreamingWordCounter()
+    for chunk in chunks:
+        counter.feed(chunk)
+    counter.close()
+    return counter.word_count
+
+
+def iter_decoded(byte_chunks, encoding):
+    """
+    Yield strings decoded from an iterable of byte strings.
+
+    A character split across two chunks is decoded once both have arrived.
+    """
+    try:
+        decoder_class = codecs.getincrementaldecoder(encoding or "utf-8")
+    except LookupError:
+        decoder_class = codecs.getincrementaldecoder("utf-8")
+    decoder = decoder_class(errors="replace")
+    for chunk in byte_chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def count_response_words(page, chunk_size=8192, body=None):
+    """
+    Return the number of words in a response body.
+
+    page: a response object from a website.
+    chunk_size: the number of bytes to read at a time.
+    body: an optional CappedBody to read the body through.
+    """
+    if body is None:
+        body = page.iter_content(chunk_size)
+    return count_words(iter_decoded(body, page.encoding))
+
+
+class CappedBody:
+    """
+    The body of a streamed response, read in chunks up to a size cap.
+
+    page: a streamed response object from a website.
+    max_size: the most bytes of the body to read, or None for no cap.
+    chunk_size: the number of bytes to read at a time.
+    chunks: an optional iterable of the body's chunks,
+    e.g. scheduler.FetchScheduler.iter_body(page).
+    Defaults to page.iter_content(chunk_size).
+
+    Iterating over a CappedBody yields the body's chunks as they arrive,
+    so only one chunk is held in memory at a time.
+    Once max_size bytes have been read the response is closed,
+    the rest of the body is never downloaded, and truncated is set.
+    Reading content instead keeps the (capped) body in memory,
+    and later iterations replay it.
+    prefetch reads ahead a bounded part of the body,
+    which iterating then yields before the rest.
+
+    size: the number of bytes read so far.
+    read_time: the seconds spent waiting on the body so far.
+    """
+    def __init__(self, page, max_size=None, chunk_size=8192, chunks=None):
+        self.page = page
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self._chunks = chunks
+        self.size = 0
+        self.read_time = 0.0
+        self.truncated = False
+        self._content = None
+        self._consumed = False
+        self._stream = None
+        self._held = deque()
+        self._sha1 = hashlib.sha1()
+
+    @property
+    def content(self):
+        """
+        The body as bytes, read in full (up to max_size) if need be.
+        """
+        if self._content is None:
+            self._content = b"".join(iter(self))
+        return self._content
+
+    def prefetch(self, limit):
+        """
+        Read ahead and hold about limit bytes of the body,
+        and return True if that is all of it.
+
+        Reading stops at the first chunk past limit,
+        so no more than limit + chunk_size bytes are held.
+        """
+        if self._content is not None:
+            return len(self._content) <= limit
+        held = sum(len(chunk) for chunk in self._held)
+        for chunk in self._get_stream():
+            self._held.append(chunk)
+            held += len(chunk)
+            if held > limit:
+                return False
+        return held <= limit
+
+    def hexdigest(self):
+        """
+        Return the sha1 hex digest of the body read so far.
+
+        The digest is updated as each chunk streams through,
+        so taking it once the body has been read costs nothing extra.
+        """
+        return self._sha1.hexdigest()
+
+    def __iter__(self):
+        if self._content is not None:
+            content = self._content
+            return (content[i:i + self.chunk_size]
+                    for i in range(0, len(content), self.chunk_size))
+        if self._consumed:
+            raise RuntimeError("the body has already been streamed")
+        self._consumed = True
+        return self._iter_held()
+
+    def _iter_held(self):
+        while self._held:
+            yield self._held.popleft()
+        yield from self._get_stream()
+
+    def _get_stream(self):
+        if self._stream is None:
+            self._stream = self._iter_stream()
+        return self._stream
+
+    def _iter_stream(self):
+        chunks = self._chunks
+        if chunks is None:
+            chunks = self.page.iter_content(self.chunk_size)
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            self.read_time += time.perf_counter() - start
+            if chunk is None:
+                return
+            if self.max_size is not None:
+                remaining = self.max_size - self.size
+                if len(chunk) > remaining:
+                    chunk = chunk[:remaining]
+                    self.truncated = True
+            self.size += len(chunk)
+            self._sha1.update(chunk)
+            if chunk:
+                yield chunk
+            if self.truncated:
+                self.page.close()
+                if hasattr(chunks, "close"):
+                    chunks.close()
+                return
+
+
+def count_body_words(body, encoding, chunk_size=65536):
+    """
+    Return the number of words in a response body.
+
+    body: the body as bytes.
+    encoding: the name of the body's character encoding, or None for utf-8.
+
+    This is a plain function of picklable arguments,
+    so it can be run in a worker process.
+    """
+    chunks = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+    return count_words(iter_decoded(chunks, encoding))
@@ -0,0 +1,450 @@
+"""
+A durable, leased work queue for splitting a crawl between processes.
+
+CrawlCoordinator puts the listings of a run into a WorkQueue,
+kept in the same SQLite database as the run's CrawlStore.
+Any number of CrawlWorkers, in any number of processes,
+lease batches of sites from the queue, crawl them,
+write the site dictionaries to the store and mark the batch done.
+
+A lease lasts lease_seconds, and a worker renews it while it crawls.
+If a worker dies before finishing its batch,
+the lease expires and the batch is handed to another worker.
+Sites are stored by run and site name,
+so a batch crawled twice is only stored once.
+Once the queue is drained, the store holds the merged crawl,
+which CrawlStore.sites returns in ranking order for the report builders.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from crawlstore import CrawlStore
+
+
+class WorkQueue:
+    """
+    SQLite queue of the sites of each crawl run.
+
+    path: the path of the database file.
+    lease_seconds: how long a worker may hold a batch before
+    it can be leased to another worker.
+    max_attempts: the number of times a site is leased before it is
+    given up on and marked failed.
+
+    Each site is pending, leased, done or failed.
+    """
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Transactions are begun explicitly,
+        # so a lease can read and update its items in one of them.
+        self._connection = sqlite3.connect(path, timeout=30,
+                                           isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS work_items ("
+            "run_id TEXT NOT NULL, rank INTEGER NOT NULL, "
+            "site_name TEXT NOT NULL, state TEXT NOT NULL, "
+            "worker_id TEXT, lease_expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (run_id, rank))")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS work_items_state "
+            "ON work_items (run_id, state, rank)")
+
+    def enqueue(self, run_id, listings):
+        """
+        Add the sites of a run to the queue, ranked in the order given.
+
+        listings: a list of websites without their protocols.
+
+        Sites already queued for the run are left as they are,
+        so enqueueing the same listings again is harmless.
+        """
+        rows = ((run_id, rank, site, "pending")
+                for rank, site in enumerate(listings, 1))
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO work_items "
+                "(run_id, rank, site_name, state) VALUES (?, ?, ?, ?)", rows)
+
+    def lease(self, run_id, worker_id, batch_size=25):
+        """
+        Return a list of up to batch_size (rank, site) tuples
+        leased to a worker, lowest rank first.
+
+        Pending sites are leased, as are leased sites whose lease has expired.
+        Sites that have run out of attempts are marked failed instead.
+        An empty list means there is nothing left to lease,
+        though sites leased to other workers may not be done yet.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            self._release_expired(connection, run_id, now)
+            rows = connection.execute(
+                "SELECT rank, site_name FROM work_items "
+                "WHERE run_id = ? AND state = 'pending' "
+                "ORDER BY rank LIMIT ?", (run_id, batch_size)).fetchall()
+            connection.executemany(
+                "UPDATE work_items SET state = 'leased', worker_id = ?, "
+                "lease_expires = ?, attempts = attempts + 1 "
+                "WHERE run_id = ? AND rank = ?",
+                [(worker_id, now + self.lease_seconds, run_id, rank)
+                 for rank, _ in rows])
+        return rows
+
+    def renew(self, run_id, worker_id, ranks):
+        """
+        Extend a worker's leases on sites it is still working on.
+
+        Returns the number of leases the worker still held.
+        """
+        return self._update_leased(
+            run_id, worker_id, ranks,
+            "UPDATE work_items SET lease_expires = ? "
+            "WHERE run_id = ? AND rank = ? AND worker_id = ? "
+            "AND state = 'leased'", time.time() + self.lease_seconds)
+
+    def complete(self, run_id, worker_id, ranks):
+        """
+        Mark sites leased to a worker as done.
+
+        Returns the number of sites marked.
+        Sites whose lease has passed to another worker are left to it.
+        """
+        return self._update_leased(
+            run_id, worker_id, ranks,
+            "UPDATE work_items SET state = 'done', lease_expires = NULL "
+            "WHERE run_id = ? AND rank = ? AND worker_id = ? "
+            "AND state = 'leased'")
+
+    def fail(self, run_id, worker_id, ranks):
+        """
+        Mark sites leased to a worker as failed,
+        e.g. because they could not be accessed.
+
+        Returns the number of sites marked.
+        """
+        return self._update_leased(
+            run_id, worker_id, ranks,
+            "UPDATE work_items SET state = 'failed', lease_expires = NULL "
+            "WHERE run_id = ? AND rank = ? AND worker_id = ? "
+            "AND state = 'leased'")
+
+    def counts(self, run_id):
+        """
+        Return a dictionary of state to the number of sites in it.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT state, COUNT(*) FROM work_items WHERE run_id = ? "
+                "GROUP BY state", (run_id,)).fetchall()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(rows)
+        return counts
+
+    def is_finished(self, run_id):
+        """
+        Return True once every site of a run is done or failed.
+
+        Sites whose lease has expired are put back to pending first,
+        so a run whose worker died isn't left waiting on it.
+        """
+        with self._transaction() as connection:
+            self._release_expired(connection, run_id, time.time())
+        counts = self.counts(run_id)
+        return not counts["pending"] and not counts["leased"]
+
+    def close(self):
+        self._connection.close()
+
+    def _release_expired(self, connection, run_id, now):
+        """
+        Put sites whose lease has expired back to pending,
+        or mark them failed if they have run out of attempts.
+        """
+        connection.execute(
+            "UPDATE work_items SET state = 'failed', worker_id = NULL "
+            "WHERE run_id = ? AND state = 'leased' AND lease_expires < ? "
+            "AND attempts >= ?", (run_id, now, self.max_attempts))
+        connection.execute(
+            "UPDATE work_items SET state = 'pending', worker_id = NULL, "
+            "lease_expires = NULL "
+            "WHERE run_id = ? AND state = 'leased' AND lease_expires < ?",
+            (run_id, now))
+
+    def _update_leased(self, run_id, worker_id, ranks, sql, *values):
+        with self._transaction() as connection:
+            updated = 0
+            for rank in ranks:
+                updated += connection.execute(
+                    sql, values + (run_id, rank, worker_id)).rowcount
+        return updated
+
+    def _transaction(self):
+        return _Transaction(self._connection, self._lock)
+
+
+class _Transaction:
+    """
+    Holds the queue's lock and an immediate transaction,
+    committing it if the block succeeds and rolling it back if not.
+    """
+    def __init__(self, connection, lock):
+        self.connection = connection
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.lock.release()
+            raise
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.connection.execute("COMMIT" if exc_type is None
+                                    else "ROLLBACK")
+        finally:
+            self.lock.release()
+
+
+class _LeaseHeartbeat:
+    """
+    Renews a worker's leases on a batch every interval seconds
+    until the block it is used in ends.
+    """
+    def __init__(self, queue, run_id, worker_id, ranks, interval):
+        self.queue = queue
+        self.run_id = run_id
+        self.worker_id = worker_id
+        self.ranks = ranks
+        self.interval = interval
+        self.renewals = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.queue.renew(self.run_id, self.worker_id, self.ranks)
+            self.renewals += 1
+
+
+class CrawlCoordinator:
+    """
+    Sets up a crawl run to be shared between workers,
+    and gathers the results.
+
+    path: the SQLite database that holds the queue and the store.
+    lease_seconds: how long a worker may hold a batch.
+    max_attempts: the number of times a site is leased before
+    it is given up on.
+    """
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.queue = WorkQueue(path, lease_seconds=lease_seconds,
+                               max_attempts=max_attempts)
+        self.store = CrawlStore(path)
+
+    def start(self, listings, run_id=None):
+        """
+        Queue the listings of a run and return its id.
+
+        listings: the output of ListingsRetriever.get_listings.
+        run_id: the id of an earlier run to continue.
+        If none is given, a new run is started.
+        """
+        run_id = self.store.start_run(run_id)
+        self.queue.enqueue(run_id, listings)
+        return run_id
+
+    def progress(self, run_id):
+        """
+        Return a dictionary of state to the number of sites in it.
+        """
+        return self.queue.counts(run_id)
+
+    def wait(self, run_id, poll_interval=1.0, timeout=None):
+        """
+        Wait until every site of a run is done or failed.
+
+        Returns True if it is, or False if timeout seconds passed first.
+        Sites left by a worker that died are put back to pending
+        once their lease expires, so something still has to crawl them;
+        see drain.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.queue.is_finished(run_id):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def drain(self, run_id, poll_interval=1.0, **worker_options):
+        """
+        Crawl whatever is left of a run in this process,
+        until every site of it is done or failed.
+
+        Sites leased to other workers are waited on,
+        and crawled here if their lease expires first.
+        worker_options: passed on to the CrawlWorker.
+        """
+        with CrawlWorker(self.path, run_id,
+                         lease_seconds=self.queue.lease_seconds,
+                         max_attempts=self.queue.max_attempts,
+                         **worker_options) as worker:
+            while True:
+                worker.run()
+                if self.queue.is_finished(run_id):
+                    return
+                time.sleep(poll_interval)
+
+    def sites(self, run_id):
+        """
+        Return the merged sites of a run, in ranking order.
+
+        The result can be passed to the report builders as their data.
+        """
+        return self.store.sites(run_id)
+
+    def close(self):
+        self.queue.close()
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CrawlWorker:
+    """
+    Crawls batches of a run's sites leased from a WorkQueue.
+
+    path: the SQLite database that holds the queue and the store.
+    run_id: the id of the run to work on.
+    batch_size: the number of sites to lease at a time.
+    worker_id: a name for the worker, unique among the run's workers.
+    Defaults to one made from the host name and process id.
+    lease_seconds: how long a lease lasts.
+    The worker renews its leases every third of that while it crawls,
+    so a slow batch isn't handed to another worker.
+    cache_dir: an optional directory for caching responses between runs.
+    endpoint_cache_path: an optional file for remembering
+    the url each site was found at between runs.
+    These are opened in the worker, so they can be shared between processes.
+    retriever_options: passed on to each SiteRetriever,
+    e.g. max_workers, prewarm or session.
+    """
+    def __init__(self, path, run_id, batch_size=25, worker_id=None,
+                 lease_seconds=300, max_attempts=3, cache_dir=None,
+                 endpoint_cache_path=None, **retriever_options):
+        self.run_id = run_id
+        self.batch_size = batch_size
+        if worker_id is None:
+            worker_id = "{0}-{1}-{2}".format(socket.gethostname(), os.getpid(),
+                                             uuid.uuid4().hex[:8])
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.queue = WorkQueue(path, lease_seconds=lease_seconds,
+                               max_attempts=max_attempts)
+        self.store = CrawlStore(path)
+        self.cache_dir = cache_dir
+        self.endpoint_cache_path = endpoint_cache_path
+        self.retriever_options = retriever_options
+        self.sites_crawled = 0
+        self.sites_failed = 0
+        self.lease_renewals = 0
+
+    def run(self):
+        """
+        Crawl batches until there are none left to lease,
+        and return the number of sites crawled.
+
+        Sites that can't be accessed are marked failed rather than done.
+        """
+        # Imported here so the coordinator doesn't need the network stack.
+        from siteretriever import SiteRetriever
+        options = dict(self.retriever_options)
+        if self.cache_dir is not None:
+            from httpcache import ResponseCache
+            options["cache"] = ResponseCache(self.cache_dir)
+        if self.endpoint_cache_path is not None:
+            from endpointcache import EndpointCache
+            options["endpoint_cache"] = EndpointCache(self.endpoint_cache_path)
+        retriever = SiteRetriever(store=self.store, run_id=self.run_id,
+                                  **options)
+        retriever._start_run()
+        try:
+            self._crawl_batches(retriever)
+        finally:
+            retriever._finish_run()
+        return self.sites_crawled
+
+    def _crawl_batches(self, retriever):
+        while True:
+            batch = self.queue.lease(self.run_id, self.worker_id,
+                                     self.batch_size)
+            if not batch:
+                break
+            ranks = [rank for rank, _ in batch]
+            sites = [site for _, site in batch]
+            print("{0} crawling ranks {1} to {2}...".format(
+                                        self.worker_id, ranks[0], ranks[-1]))
+            heartbeat = _LeaseHeartbeat(self.queue, self.run_id,
+                                        self.worker_id, ranks,
+                                        self.lease_seconds / 3)
+            with heartbeat:
+                site_dicts = retriever.retrieve_sites(sites, ranks)
+            self.lease_renewals += heartbeat.renewals
+            # The results are written before the batch is marked done,
+            # so a crash in between only means the batch is crawled again.
+            self.store.flush()
+            crawled = [rank for rank, site_dict in zip(ranks, site_dicts)
+                       if site_dict is not None]
+            failed = [rank for rank, site_dict in zip(ranks, site_dicts)
+                      if site_dict is None]
+            self.queue.complete(self.run_id, self.worker_id, crawled)
+            self.queue.fail(self.run_id, self.worker_id, failed)
+            self.sites_crawled += len(crawled)
+            self.sites_failed += len(failed)
+
+    def close(self):
+        self.queue.close()
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_worker(path, run_id, **worker_options):
+    """
+    Run a CrawlWorker until the run's queue is drained,
+    and return the number of sites it crawled.
+
+    This is a plain function of picklable arguments,
+    so it can be run in a worker process.
+    """
+    with CrawlWorker(path, run_id, **worker_options) as worker:
+        return worker.run()